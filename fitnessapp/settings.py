@@ -43,11 +43,13 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'strava_info.middleware.RequestMetricsMiddleware',
+    'strava_info.middleware.ReplicaRoutingMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'strava_info.middleware.UserProfileMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -148,19 +150,166 @@ SOCIAL_AUTH_STRAVA_SECRET = env('STRAVA_CLIENT_SECRET')
 SOCIAL_AUTH_STRAVA_KEY = env('STRAVA_CLIENT_ID')
 SOCIAL_AUTH_LOGIN_REDIRECT_URL = 'index'
 SOCIAL_AUTH_STRAVA_SCOPE = ['activity:read_all']
+# The default pipeline, plus the Strava bookkeeping that runs once when a user connects.
+SOCIAL_AUTH_PIPELINE = (
+    'social_core.pipeline.social_auth.social_details',
+    'social_core.pipeline.social_auth.social_uid',
+    'social_core.pipeline.social_auth.auth_allowed',
+    'social_core.pipeline.social_auth.social_user',
+    'social_core.pipeline.user.get_username',
+    'social_core.pipeline.user.create_user',
+    'social_core.pipeline.social_auth.associate_user',
+    'social_core.pipeline.social_auth.load_extra_data',
+    'social_core.pipeline.user.user_details',
+    'strava_info.pipeline.save_strava_connection',
+)
 STRAVA_CB_URL = env('STRAVA_CB_URL')
 STRAVA_CB_LONG_PART = env('STRAVA_CB_LONG_PART')
 STRAVA_SUB_VERIFY_TOKEN=env('STRAVA_SUB_VERIFY_TOKEN')
+# Where the Strava API lives. Only worth changing to point at a stand in (see manage.py bench_ingest).
+STRAVA_API_URL = env('STRAVA_API_URL', default='https://www.strava.com/api/v3')
+STRAVA_OAUTH_URL = env('STRAVA_OAUTH_URL', default='https://www.strava.com/oauth')
+# How many times to retry a call that hit Strava's rate limit, and how many seconds to
+# wait before retrying if Strava doesn't say.
+STRAVA_RATE_LIMIT_RETRIES = 3
+STRAVA_RATE_LIMIT_WAIT = 60
+# The async Strava client used for webhooks: seconds to wait on a call, connections it can
+# have open, and how many webhook events can be in flight at once.
+STRAVA_API_TIMEOUT = 30
+STRAVA_API_MAX_CONNECTIONS = 100
+WEBHOOK_MAX_CONCURRENCY = 100
+# Access tokens are cached in the shared cache if there is one. Refresh them in the background once they're within
+# STRAVA_TOKEN_REFRESH_AHEAD seconds of expiring and stop using them within STRAVA_TOKEN_EXPIRY_MARGIN.
+STRAVA_TOKEN_REFRESH_AHEAD = 600
+STRAVA_TOKEN_EXPIRY_MARGIN = 60
+# How long (seconds) to cache the webhook owner and subscription lookups. They're also
+# forgotten whenever they change. They're only cached if the cache is shared.
+WEBHOOK_LOOKUP_CACHE_TIMEOUT = 3600
+# How long (seconds) to keep a user's rendered home and activity type pages. They also go
+# stale as soon as the user's activities change (see StravaUser.data_version).
+PAGE_CACHE_TIMEOUT = 3600
+# Seconds after new activities come in before their owner's pages are rendered ahead of
+# time. Only one warm-up per user runs in that window, however many activities arrive.
+# Pages are only warmed when CACHE_URL points at a shared cache.
+PAGE_WARM_DELAY = 30
+
+# The reconcile command checks users' activities against Strava a month at a time to catch
+# missed webhooks. It always checks the last RECONCILE_RECENT_MONTHS months and spends the
+# rest of each user's calls on older ones. Listing calls count against Strava's read limit
+# (100 per 15 minutes by default), so leave room for webhooks and downloads.
+RECONCILE_RECENT_MONTHS = 2
+RECONCILE_API_CALLS_PER_USER = 12
+RECONCILE_MAX_API_CALLS = 60
 
 INVITATION_REG_URL_LONG_PART=env('INVITATION_REG_URL_LONG_PART')
 
+# Heatmap tiles are rendered ahead of time and kept on disk, one tile pyramid per user.
+HEATMAP_TILE_DIR = env('HEATMAP_TILE_DIR', default=os.path.join(BASE_DIR, 'heatmap_tiles'))
+HEATMAP_MIN_ZOOM = 3
+HEATMAP_MAX_ZOOM = 14
+# Number of activities that have to pass through a pixel before it is drawn at full brightness.
+HEATMAP_SATURATION = 50
+# Number of activities decoded and rasterized at once when rebuilding a heatmap.
+HEATMAP_BATCH_SIZE = 500
+
+# Activity routes are indexed by the geohash cells they pass through. Precision 5 cells are about 5km across.
+GEO_INDEX_PRECISION = 5
+# Searches over areas bigger than this many cells use the route bounding boxes instead.
+GEO_INDEX_MAX_QUERY_CELLS = 2000
+
+# Repeated routes are found by resampling each route to this many points...
+ROUTE_FINGERPRINT_POINTS = 32
+# ...and only comparing routes that start and end in neighboring geohash cells of this precision (about 1km).
+ROUTE_CELL_PRECISION = 6
+# Two routes match if their points are this many meters apart on average
+ROUTE_MATCH_TOLERANCE_M = 150
+# and their lengths are within this fraction of each other.
+ROUTE_LENGTH_TOLERANCE = 0.1
+ROUTE_BATCH_SIZE = 1000
+
+# Importing a Strava export archive parses the activity files in this many processes...
+IMPORT_WORKERS = os.cpu_count() or 1
+# ...or this many when the archive was uploaded, since then it runs alongside the web server...
+IMPORT_UPLOAD_WORKERS = 2
+# ...inserts this many activities at a time...
+IMPORT_BATCH_SIZE = 500
+# ...and thins each recorded track to this many points, about as coarse as Strava's summary polylines.
+IMPORT_TRACK_MAX_POINTS = 500
+# Activities downloaded from the Strava API are saved this many at a time, a page of the activity list.
+STRAVA_SAVE_BATCH_SIZE = 200
+
+# Raw activity JSON is archived zlib compressed at this level (1 fastest to 9 smallest).
+PAYLOAD_COMPRESSION_LEVEL = 6
+# manage.py rederive rebuilds activities from the archive in this many processes, this many at a time.
+REDERIVE_WORKERS = IMPORT_WORKERS
+REDERIVE_CHUNK_SIZE = 500
+
+# The year to date charts have a point every this many days unless the request asks for
+# ?step=1 to 31. Weekly points keep a 20 year chart to about 1000 numbers.
+YTD_CHART_STEP = 7
+
+# The gear page warns that gear is nearly due for service at this fraction of its service interval.
+GEAR_SERVICE_WARNING_FRACTION = 0.9
+
+# Exports and searches stream this many activities at a time from a server side cursor.
+EXPORT_CHUNK_SIZE = 2000
+SEARCH_CHUNK_SIZE = 2000
+# Deleting a user's data removes this many rows per transaction, so the table is never locked for long.
+DELETE_CHUNK_SIZE = 1000
+
+# Pie chart colors are handed out from a pool of distinct colors made once per process.
+# The seed keeps the pool the same everywhere. Strava has around 50 sport types.
+PIE_COLOR_POOL_SIZE = 60
+PIE_COLOR_POOL_SEED = 0
+
+# Request metrics. How many requests per view the stats page summarizes, and how many
+# queries a view can make before it gets logged as a warning. Budgets are keyed on the
+# namespaced view name, e.g. 'strava_info:analyze_activity_type'.
+REQUEST_METRICS_WINDOW = 1000
+DEFAULT_VIEW_QUERY_BUDGET = 50
+VIEW_QUERY_BUDGETS = {
+    'strava_info:analyze_activity_type' : 30,
+    'strava_info:heatmap_tile' : 5,
+}
+
 
 
+# A per process memory cache unless CACHE_URL points at a shared one (e.g. redis://...).
+CACHES = {'default': env.cache_url('CACHE_URL', default='locmemcache://')}
+
 # Update database configuration from $DATABASE_URL.
 import dj_database_url
 db_from_env = dj_database_url.config(conn_max_age=500)
 DATABASES['default'].update(db_from_env)
 
+# Analytics reads go to a read replica at $REPLICA_DATABASE_URL if there is one. In tests
+# it mirrors the default database.
+replica_from_env = dj_database_url.config('REPLICA_DATABASE_URL', conn_max_age=500)
+if replica_from_env :
+    DATABASES['replica'] = dict(replica_from_env, TEST={'MIRROR' : 'default'})
+DATABASE_ROUTERS = ['strava_info.routers.ReplicaRouter']
+
+# Optional Postgres partitioning of the activities table for big multi athlete deployments,
+# by hash on site_user_id or by range on start_date (a partition per year). It's done with
+# manage.py partition_activities, never by migrate. These are its defaults.
+ACTIVITY_HASH_PARTITIONS = 16
+ACTIVITY_PARTITION_YEARS_AHEAD = 1
+
+# SQLite just ignores the included (non-key) columns of the chart indexes.
+SILENCED_SYSTEM_CHECKS = ['models.W040']
+
+# The views whose reads can go to the replica, keyed on the namespaced view name, and how
+# long a client's reads stay on the primary after it writes.
+REPLICA_READ_VIEWS = {
+    'strava_info:analyze_activity_type',
+    'strava_info:charts_data',
+    'strava_info:calendar_data',
+    'strava_info:pie_chart_data',
+    'strava_info:annual_charts',
+    'strava_info:annual_pie_chart_data',
+}
+REPLICA_STICKY_SECONDS = 10
+
 
 # The absolute path to the directory where collectstatic will collect static files for deployment.
 STATIC_ROOT = BASE_DIR / 'staticfiles'
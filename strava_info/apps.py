@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class StravaInfoConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'strava_info'
+
+    def ready(self) :
+        # Connect the signal handlers that keep cached lookups fresh.
+        from . import signals
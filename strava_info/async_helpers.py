@@ -0,0 +1,158 @@
+from .strava_client import AsyncStravaClient
+from .strava_helpers import async_handle, store_webhook_activity
+from .heatmap_helpers import add_polylines_to_heatmap
+from .gear_helpers import unnamed_gear_ids, name_gear
+from .page_cache_helpers import queue_page_warming
+from .token_helpers import get_strava_access_token
+from .webhook_helpers import get_webhook_owner
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connections
+import threading
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Webhook events are handled on one event loop running in a background thread. It's
+# shared by every request the process serves, whether it came in through ASGI or WSGI,
+# so waiting on Strava doesn't tie up a thread per event.
+_loop = None
+_loop_lock = threading.Lock()
+_client = None
+_semaphore = None
+
+
+def _get_event_loop() :
+    """
+    Return the background event loop, starting it the first time.
+
+    Returns:
+        AbstractEventLoop: the loop
+    """
+    global _loop
+    with _loop_lock :
+        if _loop is None :
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="strava-webhooks", daemon=True).start()
+        return _loop
+
+
+async def fetch_gear_names_async(site_user, access_token) :
+    """
+    Look up the names of any of a user's gear we haven't named yet, like
+    strava_helpers.fetch_gear_names but through the async client.
+
+    Args:
+        site_user (User): the owner of the gear
+        access_token (str): their access token
+    """
+    import httpx
+    for gear_id in await sync_to_async(unnamed_gear_ids)(site_user) :
+        try :
+            gear = await _client.get_gear(access_token, gear_id)
+        except httpx.HTTPError as e :
+            # We try again the next time.
+            logger.warning("Couldn't get the name of gear " + gear_id + ": " + str(e))
+            return
+        await sync_to_async(name_gear)(site_user, gear_id, gear.get("name") or gear_id)
+
+
+def _update_heatmap(site_user, removed, added) :
+    """
+    Swap an activity's old route for its new one on the heatmap. Runs on a thread of its
+    own, so it closes the database connection it opened.
+    """
+    try :
+        add_polylines_to_heatmap(site_user, removed, sign=-1)
+        add_polylines_to_heatmap(site_user, added)
+    finally :
+        connections.close_all()
+
+
+async def handle_webhook_event(event) :
+    """
+    Handle a webhook event on the background loop.
+
+    Fetching a newly created activity and its gear are the only steps that wait on
+    Strava, so they go through the async client. The database work runs through
+    sync_to_async, which runs it on one shared thread. Drawing the activity on the
+    heatmap is CPU work that doesn't need that thread, so it runs on another one rather
+    than holding up every other event's database work.
+
+    Args:
+        event (dict): data from the webhook
+    """
+    global _client, _semaphore
+    if _client is None :
+        _client = AsyncStravaClient()
+        _semaphore = asyncio.Semaphore(settings.WEBHOOK_MAX_CONCURRENCY)
+    async with _semaphore :
+        if event.get("object_type") == "activity" and event.get("aspect_type") == "create" :
+            site_user = await sync_to_async(get_webhook_owner)(event.get("owner_id"))
+            if site_user is None :
+                logger.debug("Got a webhook for athlete " + str(event.get("owner_id")) + " who isn't one of our users.")
+                return
+            access_token = await sync_to_async(get_strava_access_token)(site_user)
+            r = await _client.get_activity(access_token, event.get("object_id"))
+            stored = await sync_to_async(store_webhook_activity)(site_user, r)
+            if stored is None :
+                return
+            await fetch_gear_names_async(site_user, access_token)
+            await sync_to_async(_update_heatmap, thread_sensitive=False)(site_user, *stored)
+            await sync_to_async(queue_page_warming)(site_user)
+        else :
+            # Nothing else needs to call Strava.
+            await sync_to_async(async_handle)(event)
+
+
+async def iterate_in_thread(iterator) :
+    """
+    Serve a sync iterator to async code, one item at a time.
+
+    Under ASGI, Django reads a sync StreamingHttpResponse into a list before sending
+    any of it. Handing it this instead keeps the response streaming. Each item is
+    fetched through sync_to_async on the request's thread, so database cursors the
+    iterator holds stay on the connection that opened them.
+
+    Args:
+        iterator (iterable): the sync iterator
+
+    Yields:
+        the iterator's items
+    """
+    iterator = iter(iterator)
+    done = object()
+    next_item = sync_to_async(next, thread_sensitive=True)
+    try :
+        while True :
+            item = await next_item(iterator, done)
+            if item is done :
+                return
+            yield item
+    finally :
+        # If the client went away part way through, let the iterator clean up.
+        if hasattr(iterator, "close") :
+            await sync_to_async(iterator.close, thread_sensitive=True)()
+
+
+def _log_failure(future) :
+    if not future.cancelled() and future.exception() :
+        logger.error("Couldn't handle a Strava webhook event", exc_info=future.exception())
+
+
+def enqueue_webhook_event(event) :
+    """
+    Hand a webhook event to the background loop and return right away.
+
+    Safe to call from sync or async code.
+
+    Args:
+        event (dict): data from the webhook
+
+    Returns:
+        Future: done when the event has been handled
+    """
+    future = asyncio.run_coroutine_threadsafe(handle_webhook_event(event), _get_event_loop())
+    future.add_done_callback(_log_failure)
+    return future
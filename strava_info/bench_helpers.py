@@ -0,0 +1,484 @@
+from .models import StravaActivity, StravaUser
+from .geo_helpers import encode_polyline
+from .payload_helpers import archive_payloads
+from .strava_helpers import build_strava_activity, replace_activities, compute_metrics, compute_pie_colors, suggest_similar_activities, get_monthly_charts_data, get_annual_chart_data, get_ytd_chart_data, download_strava_data, async_handle, remove_user_strava_data
+from .middleware import count_queries
+from .async_helpers import enqueue_webhook_event
+from .reconcile_helpers import reconcile_user
+from django.contrib.auth.models import User
+from django.db.models import Count, Sum, Min, Max
+from django.db import connection
+from django.test import Client, RequestFactory
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.urls import reverse
+from social_django.models import UserSocialAuth
+from datetime import datetime, timedelta, timezone
+import numpy as np
+import resource
+import random
+import time
+
+# Rough averages for each sport so the synthetic numbers look like the real thing:
+# (distance in meters, meters per second, meters of climbing per km).
+SPORT_PROFILES = {
+    "Ride" : (40000, 7.0, 12),
+    "VirtualRide" : (30000, 8.0, 8),
+    "Run" : (8000, 3.0, 10),
+    "Walk" : (4000, 1.4, 8),
+    "Hike" : (10000, 1.1, 60),
+    "Swim" : (2000, 0.8, 0),
+    "WeightTraining" : (0, 0, 0),
+}
+
+
+def parse_sport_mix(spec) :
+    """
+    Parse a sport mix like "Ride:6,Run:3,Swim:1" into sport types and normalized weights.
+
+    Args:
+        spec (str): comma separated sport_type:weight pairs
+
+    Returns:
+        dict: sport type to the fraction of activities that are of that type
+    """
+    mix = {}
+    for part in spec.split(",") :
+        sport, _, weight = part.partition(":")
+        mix[sport.strip()] = float(weight or 1)
+    total = sum(mix.values())
+    return {s : w / total for s, w in mix.items()}
+
+
+def make_synthetic_activity(rng, activity_id, start, sport_type, home) :
+    """
+    Make up an activity in the shape the Strava API returns.
+
+    Args:
+        rng (Random): where the randomness comes from, so runs can be repeated
+        activity_id (int): the activity's id
+        start (datetime): when it started (UTC)
+        sport_type (str): the sport type
+        home (tuple): (lat, lng) the athlete's routes start near
+
+    Returns:
+        dict: the activity
+    """
+    mean_dist, mean_speed, climb_per_km = SPORT_PROFILES.get(sport_type, (10000, 3.0, 10))
+    distance = mean_dist * rng.uniform(0.3, 2.0)
+    moving_time = int(distance / mean_speed) if mean_speed else rng.randint(1800, 5400)
+    elev_gain = distance / 1000 * climb_per_km * rng.uniform(0.2, 2.0)
+    result = {
+        "id" : activity_id,
+        "name" : sport_type + " " + start.strftime("%Y-%m-%d"),
+        "distance" : distance,
+        "moving_time" : moving_time,
+        "elapsed_time" : int(moving_time * rng.uniform(1.0, 1.4)),
+        "total_elevation_gain" : elev_gain,
+        "type" : sport_type,
+        "sport_type" : sport_type,
+        "start_date" : start.isoformat(),
+        "start_date_local" : (start - timedelta(hours=5)).replace(tzinfo=timezone.utc).isoformat(),
+        "timezone" : "(GMT-05:00) America/New_York",
+        "utc_offset" : -18000,
+        "location_country" : "United States",
+        "achievement_count" : rng.randint(0, 5),
+        "kudos_count" : rng.randint(0, 20),
+        "average_speed" : distance / moving_time if distance else 0.0,
+        "max_speed" : (distance / moving_time) * rng.uniform(1.5, 3.0) if distance else 0.0,
+        "has_heartrate" : True,
+        "average_heartrate" : rng.uniform(110, 160),
+        "max_heartrate" : rng.uniform(160, 195),
+        "elev_high" : 100 + elev_gain / 3,
+        "elev_low" : 100.0,
+        "pr_count" : rng.randint(0, 3),
+        # Two bikes and a pair of shoes, picked without the rng so the rest of the activity doesn't change.
+        "gear_id" : {"Ride" : "b" + str(activity_id % 2 + 1), "Run" : "g1", "Walk" : "g1"}.get(sport_type),
+    }
+    if distance and mean_speed and sport_type != "VirtualRide" :
+        # A random walk out from home, about as long as the activity.
+        steps = 40
+        step_deg = distance / steps / 111000
+        angles = np.cumsum([rng.uniform(-0.6, 0.6) for _ in range(steps)]) + rng.uniform(0, 2 * np.pi)
+        points = np.array(home) + np.cumsum(np.stack([np.sin(angles), np.cos(angles)], axis=1) * step_deg, axis=0)
+        result["map"] = {"summary_polyline" : encode_polyline(points)}
+        result["start_latlng"] = [float(points[0][0]), float(points[0][1])]
+        result["end_latlng"] = [float(points[-1][0]), float(points[-1][1])]
+    return result
+
+
+def create_synthetic_athlete(username, *, num_activities, years, sport_mix, seed) :
+    """
+    Create a user with a made up but repeatable Strava history, ready for every page to use.
+
+    Args:
+        username (str): the new user's username
+        num_activities (int): how many activities to make up
+        years (int): how many years to spread them over. They end on Jan 1 2023 so runs are repeatable.
+        sport_mix (dict): sport type to fraction of activities
+        seed (int): seed for the random numbers
+
+    Returns:
+        User: the new user
+    """
+    rng = random.Random(seed)
+    user = User.objects.create_user(username=username, password=username)
+    StravaUser.objects.create(user=user, is_strava_verified=True)
+    # The index page wants a Strava login with a couple of token fields.
+    UserSocialAuth.objects.create(user=user, provider="strava", uid="bench-" + username,
+                                  extra_data={"auth_time" : int(time.time()), "expires" : 21600,
+                                              "access_token" : "bench", "refresh_token" : "bench", "token_type" : "Bearer"})
+    home = (rng.uniform(30, 48), rng.uniform(-122, -72))
+    end = datetime(2023, 1, 1, tzinfo=timezone.utc)
+    span = timedelta(days=365 * years).total_seconds()
+    sports = list(sport_mix)
+    weights = [sport_mix[s] for s in sports]
+    results = []
+    for i in range(num_activities) :
+        start = end - timedelta(seconds=rng.uniform(0, span))
+        results.append(make_synthetic_activity(rng, seed * 10**7 + i, start, rng.choices(sports, weights)[0], home))
+    replace_activities([build_strava_activity(r, user) for r in results])
+    archive_payloads(user, results)
+    su = user.stravauser
+    su.has_completed_initial_download = True
+    su.pie_color_palette = compute_pie_colors(user)
+    su.save()
+    return user
+
+
+def time_call(fn, repeat) :
+    """
+    Call fn repeat times and summarize how long each call took and how many queries it ran.
+
+    Args:
+        fn (callable): the thing to time; takes no arguments
+        repeat (int): how many times to call it
+
+    Returns:
+        dict: query count and latency percentiles in milliseconds
+    """
+    times = []
+    queries = []
+    for _ in range(repeat) :
+        start = time.perf_counter()
+        with count_queries() as db :
+            fn()
+        times.append((time.perf_counter() - start) * 1000)
+        queries.append(db["queries"])
+    return {
+        "runs" : repeat,
+        "queries" : {"min" : min(queries), "max" : max(queries)},
+        "ms" : {"mean" : round(float(np.mean(times)), 3),
+                "p50" : round(float(np.percentile(times, 50)), 3),
+                "p90" : round(float(np.percentile(times, 90)), 3),
+                "p99" : round(float(np.percentile(times, 99)), 3),
+                "max" : round(max(times), 3)},
+    }
+
+
+def naive_ytd_chart_data(user, act_type, field) :
+    """
+    Work out each year's running daily total the slow way, a query and a Python loop
+    per year, as a baseline for get_ytd_chart_data.
+
+    Args:
+        user (User): the athlete
+        act_type (str): the sport type
+        field (str): the StravaActivity column to add up
+
+    Returns:
+        dict: year to the running total on each day of the year
+    """
+    acts_qs = StravaActivity.objects.filter(site_user=user, sport_type=act_type)
+    years = acts_qs.aggregate(first=Min("local_year"), last=Max("local_year"))
+    result = {}
+    for year in range(years["first"], years["last"] + 1) :
+        daily = [0.0] * 366
+        for d, v in acts_qs.filter(local_year=year).values_list("local_date", field) :
+            daily[d.timetuple().tm_yday - 1] += v
+        running = []
+        total = 0.0
+        for v in daily :
+            total += v
+            running.append(total)
+        result[year] = running
+    return result
+
+
+def benchmark_athlete(user, repeat) :
+    """
+    Time the helpers and views that do the heavy lifting for one athlete.
+
+    Args:
+        user (User): an athlete made by create_synthetic_athlete
+        repeat (int): how many times to run each one
+
+    Returns:
+        dict: benchmark name to the summary from time_call
+    """
+    request = RequestFactory().get("/")
+    request.user = user
+    client = Client()
+    client.force_login(user)
+    acts_qs = StravaActivity.objects.filter(site_user=user)
+    # Benchmark against the athlete's most common sport.
+    sport = acts_qs.values("sport_type").annotate(n=Count("id")).order_by("-n", "sport_type")[0]["sport_type"]
+    year = acts_qs.order_by("-start_date").first().start_date.year
+    benchmarks = {
+        "compute_metrics" : lambda : compute_metrics(acts_qs.filter(sport_type=sport)),
+        "suggest_similar_activities" : lambda : suggest_similar_activities(request, distance=20, elev_gain=500, activity_type=[sport]),
+        "get_monthly_charts_data" : lambda : get_monthly_charts_data(request, sport, "distance"),
+        "get_annual_chart_data" : lambda : get_annual_chart_data(request, sport, "distance"),
+        "get_ytd_chart_data" : lambda : get_ytd_chart_data(request, sport, "distance", 1),
+        "naive_ytd_chart_data" : lambda : naive_ytd_chart_data(user, sport, "distance_miles"),
+        "pie_chart_data" : lambda : client.get(reverse("strava_info:pie_chart_data")),
+        "annual_pie_chart_data" : lambda : client.get(reverse("strava_info:annual_pie_chart_data", args=[year])),
+        "index" : lambda : client.get(reverse("index")),
+    }
+    return {name : time_call(fn, repeat) for name, fn in benchmarks.items()}
+
+
+def explain_chart_queries(user) :
+    """
+    Return the database's query plans for the queries behind the charts, pies and stats.
+
+    On Postgres these should be index only scans of the local time bucket indexes. The
+    table is vacuumed and analyzed first so the planner knows the index is usable.
+
+    Args:
+        user (User): an athlete made by create_synthetic_athlete
+
+    Returns:
+        dict: query name to its plan, one line per plan step
+    """
+    table = StravaActivity._meta.db_table
+    with connection.cursor() as cursor :
+        cursor.execute(("VACUUM ANALYZE " if connection.vendor == "postgresql" else "ANALYZE ") + table)
+    acts_qs = StravaActivity.objects.filter(site_user=user)
+    sport = acts_qs.values("sport_type").annotate(n=Count("id")).order_by("-n", "sport_type")[0]["sport_type"]
+    year = acts_qs.order_by("-local_year").values_list("local_year", flat=True).first()
+    queries = {
+        "monthly_chart" : acts_qs.filter(sport_type=sport, local_year=year).values("local_month").annotate(total=Sum("distance_miles")).order_by(),
+        "annual_chart" : acts_qs.filter(sport_type=sport).values("local_year").annotate(total=Sum("distance_miles")).order_by("local_year"),
+        "year_list" : acts_qs.values_list("local_year", flat=True).distinct().order_by("-local_year"),
+        "annual_pie" : acts_qs.filter(local_year=year).values("sport_type").annotate(total=Sum("moving_time_sec")).order_by(),
+    }
+    return {name : qs.explain().splitlines() for name, qs in queries.items()}
+
+
+def _peak_rss_mb() :
+    # ru_maxrss is in kilobytes on Linux.
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def _measure_ingest(fn, server, count) :
+    """
+    Run an ingest step and measure its throughput, DB round trips and API calls.
+    """
+    calls_before = dict(server.calls)
+    error = None
+    start = time.perf_counter()
+    with count_queries() as db :
+        try :
+            fn()
+        except Exception as e :
+            # Report the failure instead of losing the rest of the run.
+            error = repr(e)
+    seconds = time.perf_counter() - start
+    return {
+        "items" : count,
+        "seconds" : round(seconds, 3),
+        "per_second" : round(count / seconds, 1) if seconds else None,
+        "db_queries" : db["queries"],
+        "db_ms" : round(db["seconds"] * 1000, 1),
+        "api_calls" : {k : server.calls[k] - calls_before[k] for k in server.calls},
+        "peak_rss_mb" : _peak_rss_mb(),
+        "error" : error,
+    }
+
+
+def benchmark_ingest(server, *, webhook_events, seed=1) :
+    """
+    Drive a full download and a stream of webhook events end to end against a FakeStravaServer.
+
+    The webhook events go through async_handle one at a time and then all at once through
+    the background loop that handle_strava_webhook hands them to.
+
+    The settings have to point the Strava URLs at the server first. The athlete starts with
+    an expired access token so the refresh is part of the run.
+
+    Args:
+        server (FakeStravaServer): the running stand in for Strava
+        webhook_events (int): how many activities to create, rename and delete through async_handle
+        seed (int, optional): seed for the webhook activities. Defaults to 1.
+
+    Returns:
+        dict: step name to its measurements
+    """
+    rng = random.Random(seed)
+    athlete_id = str(seed * 1000 + 1)
+    user = User.objects.create_user(username="ingest-" + athlete_id, password="ingest")
+    StravaUser.objects.create(user=user, is_strava_verified=True)
+    token = server.issue_token(ttl=-1)
+    UserSocialAuth.objects.create(user=user, provider="strava", uid=athlete_id,
+                                  extra_data=dict(token, auth_time=int(time.time()) - 21600, expires=token["expires_in"]))
+    request = RequestFactory().get("/")
+    request.user = user
+    request._messages = CookieStorage(request)
+    report = {"rss_before_mb" : _peak_rss_mb()}
+    report["download"] = _measure_ingest(lambda : download_strava_data(request), server, len(server.activities))
+    report["download"]["saved"] = StravaActivity.objects.filter(site_user=user).count()
+
+    # New activities show up at Strava and we hear about them through webhooks.
+    ids = []
+    for i in range(webhook_events) :
+        act = make_synthetic_activity(rng, seed * 10**7 + 5 * 10**6 + i, datetime(2023, 1, 2, tzinfo=timezone.utc) + timedelta(hours=i),
+                                      "Ride", (40.0, -75.0))
+        server.add_activity(act)
+        ids.append(act["id"])
+
+    def events(aspect_type, **extra) :
+        for object_id in ids :
+            async_handle(dict({"aspect_type" : aspect_type, "object_type" : "activity", "object_id" : object_id, "owner_id" : athlete_id}, **extra))
+
+    report["webhook_create"] = _measure_ingest(lambda : events("create"), server, len(ids))
+    report["webhook_update"] = _measure_ingest(lambda : events("update", updates={"title" : "Renamed"}), server, len(ids))
+    report["webhook_delete"] = _measure_ingest(lambda : events("delete"), server, len(ids))
+
+    # The same again through the async path the webhook view uses, all events in flight at once.
+    # Its database work happens on another thread so it doesn't show up in db_queries.
+    def enqueued(aspect_type) :
+        futures = [enqueue_webhook_event({"aspect_type" : aspect_type, "object_type" : "activity", "object_id" : object_id,
+                                          "owner_id" : athlete_id}) for object_id in ids]
+        for f in futures :
+            f.result()
+
+    report["webhook_create_async"] = _measure_ingest(lambda : enqueued("create"), server, len(ids))
+    report["webhook_delete_async"] = _measure_ingest(lambda : enqueued("delete"), server, len(ids))
+
+    # Now some webhooks go missing: activities are renamed, deleted and created at Strava
+    # without us hearing about it. Reconciliation has to find and repair them.
+    with server.lock :
+        for object_id in ids :
+            server.activities.pop(object_id)
+        existing = sorted(server.activities)
+    missed = rng.sample(existing, min(10, len(existing)))
+    with server.lock :
+        for object_id in missed[:5] :
+            server.activities[object_id][1]["name"] = "Renamed without a webhook"
+        for object_id in missed[5:] :
+            server.activities.pop(object_id)
+    for i in range(5) :
+        server.add_activity(make_synthetic_activity(rng, seed * 10**7 + 6 * 10**6 + i, datetime(2021, 6, 1, tzinfo=timezone.utc) + timedelta(days=i),
+                                                    "Run", (40.0, -75.0)))
+    # A budget big enough to cover the whole history in one run.
+    budget = 10 * len(server.activities)
+    # The second run has nothing to repair, so it shows what checking alone costs.
+    for step in ("reconcile", "reconcile_clean") :
+        reconciled = {}
+        report[step] = _measure_ingest(lambda : reconciled.update(reconcile_user(user, budget)), server, len(server.activities))
+        report[step]["reconciled"] = reconciled
+    with server.lock :
+        theirs = {i : a["name"] for i, (_, a) in server.activities.items()}
+    report["reconcile"]["in_sync"] = theirs == dict(StravaActivity.objects.filter(site_user=user).values_list("activity_id", "name"))
+    user.delete()
+    return report
+
+
+def _fill_expression(field) :
+    """
+    Return the SQL that fills a StravaActivity column for row g of generate_series in fill_activities.
+    It goes through cursor.execute with parameters, hence the %% for modulo.
+    """
+    # Spread the start dates over 8 years.
+    ts = "(TIMESTAMPTZ '2015-01-01 00:00:00+00' + ((g * 7919) %% 252288000) * INTERVAL '1 second')"
+    local = "(" + ts + " AT TIME ZONE 'UTC')"
+    special = {
+        "site_user_id" : "(%s::bigint[])[(1 + g %% %s)::int]",
+        "activity_id" : "g",
+        "name" : "'Activity ' || g",
+        "type" : "(ARRAY['Ride', 'Run', 'Walk', 'Swim'])[(1 + g %% 4)::int]",
+        "sport_type" : "(ARRAY['Ride', 'Run', 'Walk', 'Swim'])[(1 + g %% 4)::int]",
+        "start_date" : ts,
+        "start_date_local" : ts,
+        "local_date" : local + "::date",
+        "local_year" : "EXTRACT(YEAR FROM " + local + ")::int",
+        "local_month" : "EXTRACT(MONTH FROM " + local + ")::int",
+        "local_iso_week" : "EXTRACT(WEEK FROM " + local + ")::int",
+    }
+    if field.column in special :
+        return special[field.column]
+    if field.null :
+        return "NULL"
+    kind = field.get_internal_type()
+    if kind == "FloatField" :
+        return "random() * 1000"
+    if "Integer" in kind :
+        return "g %% 1000"
+    if kind == "BooleanField" :
+        return "false"
+    return "''"
+
+
+def fill_activities(users, rows, batch_size=1000000) :
+    """
+    Insert rows made up activities spread evenly over users with INSERT ... SELECT. Postgres only.
+
+    This is far quicker than building activities, so it's how the partitioning benchmark gets
+    to millions of rows. The numbers are junk but every column is filled in.
+
+    Args:
+        users (list): the users to give the activities to
+        rows (int): how many activities to insert
+        batch_size (int, optional): rows per INSERT. Defaults to 1000000.
+    """
+    fields = [f for f in StravaActivity._meta.concrete_fields if not f.primary_key]
+    columns = ", ".join(connection.ops.quote_name(f.column) for f in fields)
+    # Only site_user_id takes parameters: the user ids and how many there are.
+    select = ", ".join(_fill_expression(f) for f in fields)
+    sql = ("INSERT INTO " + connection.ops.quote_name(StravaActivity._meta.db_table) + " (" + columns + ") SELECT " +
+           select + " FROM generate_series(%s::bigint, %s::bigint) AS g")
+    user_ids = [u.id for u in users]
+    with connection.cursor() as cursor :
+        for start in range(1, rows + 1, batch_size) :
+            cursor.execute(sql, [user_ids, len(user_ids), start, min(start + batch_size - 1, rows)])
+        cursor.execute("ANALYZE " + connection.ops.quote_name(StravaActivity._meta.db_table))
+
+
+def benchmark_per_user_queries(users, repeat) :
+    """
+    Time the kinds of per athlete queries the pages make, going round a sample of athletes.
+
+    Args:
+        users (list): the athletes to query for
+        repeat (int): how many times to run each query
+
+    Returns:
+        dict: query name to the summary from time_call
+    """
+    queries = {
+        "recent" : lambda u : list(StravaActivity.objects.filter(site_user=u).order_by("-start_date")[:5]),
+        "count" : lambda u : StravaActivity.objects.filter(site_user=u).count(),
+        "annual_chart" : lambda u : list(StravaActivity.objects.filter(site_user=u, sport_type="Ride").values("local_year")
+                                         .annotate(total=Sum("distance_miles")).order_by("local_year")),
+        "pie" : lambda u : list(StravaActivity.objects.filter(site_user=u).values("sport_type")
+                                .annotate(total=Sum("moving_time_sec")).order_by()),
+    }
+    results = {}
+    for name, query in queries.items() :
+        turn = iter(users * repeat)
+        results[name] = time_call(lambda : query(next(turn)), repeat)
+    return results
+
+
+def benchmark_account_deletes(users) :
+    """
+    Time remove_user_strava_data for each of users.
+
+    Args:
+        users (list): the athletes whose data to delete
+
+    Returns:
+        dict: the summary from time_call
+    """
+    turn = iter(users)
+    return time_call(lambda : remove_user_strava_data(next(turn)), len(users))
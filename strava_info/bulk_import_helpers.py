@@ -0,0 +1,315 @@
+from .geo_helpers import encode_polyline, thin_track
+from .payload_helpers import archive_payloads
+from .page_cache_helpers import queue_page_warming
+from .strava_helpers import build_strava_activity, replace_activities, finish_full_ingest
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from defusedxml import ElementTree
+from django.conf import settings
+import multiprocessing
+import django
+import zipfile
+import struct
+import gzip
+import csv
+import io
+import logging
+
+logger = logging.getLogger(__name__)
+
+# FIT files store positions in "semicircles".
+SEMICIRCLES_TO_DEGREES = 180.0 / 2**31
+FIT_RECORD_MESSAGE = 20
+FIT_INVALID_SINT32 = 0x7FFFFFFF
+
+
+def _parse_gpx_points(data) :
+    """
+    Return the (lat, lng) of every track point in a GPX file.
+    """
+    points = []
+    for _, elem in ElementTree.iterparse(io.BytesIO(data)) :
+        if elem.tag.endswith("trkpt") :
+            points.append((float(elem.get("lat")), float(elem.get("lon"))))
+        elem.clear()
+    return points
+
+
+def _parse_tcx_points(data) :
+    """
+    Return the (lat, lng) of every track point in a TCX file.
+    """
+    points = []
+    lat = None
+    for _, elem in ElementTree.iterparse(io.BytesIO(data)) :
+        if elem.tag.endswith("LatitudeDegrees") :
+            lat = float(elem.text)
+        elif elem.tag.endswith("LongitudeDegrees") and lat is not None :
+            points.append((lat, float(elem.text)))
+            lat = None
+        elif elem.tag.endswith("Trackpoint") :
+            elem.clear()
+    return points
+
+
+def _parse_fit_points(data) :
+    """
+    Return the (lat, lng) of every record message in a FIT file.
+
+    This only understands as much of the FIT protocol as it takes to pull positions
+    out of record messages and skip over everything else.
+    """
+    header_size = data[0]
+    end = header_size + struct.unpack("<I", data[4:8])[0]
+    pos = header_size
+    definitions = {}
+    points = []
+    while pos < end :
+        record_header = data[pos]
+        pos += 1
+        if record_header & 0x80 :
+            # Compressed timestamp header. Always a data message.
+            local_type = (record_header >> 5) & 0x3
+            is_definition = False
+        else :
+            local_type = record_header & 0x0F
+            is_definition = bool(record_header & 0x40)
+            has_developer_fields = bool(record_header & 0x20)
+        if is_definition :
+            endian = ">" if data[pos+1] == 1 else "<"
+            global_num = struct.unpack(endian + "H", data[pos+2:pos+4])[0]
+            num_fields = data[pos+4]
+            pos += 5
+            fields = []
+            for _ in range(num_fields) :
+                fields.append((data[pos], data[pos+1]))
+                pos += 3
+            developer_size = 0
+            if has_developer_fields :
+                num_dev_fields = data[pos]
+                pos += 1
+                for _ in range(num_dev_fields) :
+                    developer_size += data[pos+1]
+                    pos += 3
+            definitions[local_type] = (endian, global_num, fields, developer_size)
+        else :
+            endian, global_num, fields, developer_size = definitions[local_type]
+            position = {}
+            for field_num, size in fields :
+                if global_num == FIT_RECORD_MESSAGE and field_num in (0, 1) and size == 4 :
+                    value = struct.unpack(endian + "i", data[pos:pos+4])[0]
+                    if value != FIT_INVALID_SINT32 :
+                        position[field_num] = value * SEMICIRCLES_TO_DEGREES
+                pos += size
+            pos += developer_size
+            if len(position) == 2 :
+                points.append((position[0], position[1]))
+    return points
+
+
+def parse_export_track(zip_path, member) :
+    """
+    Pull the route out of one GPX, TCX or FIT file inside a Strava export archive.
+
+    This runs in a worker process, so it opens the archive itself and hands back
+    only the small summary of the route that we store.
+
+    Args:
+        zip_path (str): path of the export archive
+        member (str): name of the file inside the archive
+
+    Returns:
+        dict: map.summary_polyline, start_latlng and end_latlng of the route (empty if there isn't one)
+    """
+    import numpy as np
+    try :
+        with zipfile.ZipFile(zip_path) as zf :
+            data = zf.read(member)
+        name = member.lower()
+        if name.endswith(".gz") :
+            data = gzip.decompress(data)
+            name = name[:-3]
+        if name.endswith(".gpx") :
+            points = _parse_gpx_points(data)
+        elif name.endswith(".tcx") :
+            # Garmin pads TCX files with leading whitespace, which XML parsers reject.
+            points = _parse_tcx_points(data.lstrip())
+        elif name.endswith(".fit") :
+            points = _parse_fit_points(data)
+        else :
+            points = []
+    except Exception as e :
+        # One bad file shouldn't sink the whole import.
+        logger.warning("Couldn't parse " + member + " from the export: " + str(e))
+        return {}
+    if not points :
+        return {}
+    points = thin_track(np.array(points), settings.IMPORT_TRACK_MAX_POINTS)
+    return {
+        "map" : {"summary_polyline" : encode_polyline(points)},
+        "start_latlng" : [float(points[0][0]), float(points[0][1])],
+        "end_latlng" : [float(points[-1][0]), float(points[-1][1])],
+    }
+
+
+def _to_float(value) :
+    try :
+        return float(value)
+    except (TypeError, ValueError) :
+        return None
+
+
+def export_row_to_result(row) :
+    """
+    Convert a row of an export's activities.csv to the shape the Strava API returns.
+
+    That lets the import reuse build_strava_activity's field mapping. activities.csv repeats
+    some column names (the later copies are the ones in SI units), and the export only gives
+    start times in UTC, so the local start time is the UTC one.
+
+    Args:
+        row (dict): column name to list of values (one per column with that name)
+
+    Returns:
+        dict: the activity in Strava API form
+    """
+    def last(col) :
+        return _to_float(row.get(col, [None])[-1])
+    date_str = row["Activity Date"][0]
+    try :
+        start = datetime.strptime(date_str, "%b %d, %Y, %I:%M:%S %p")
+    except ValueError :
+        from dateutil import parser
+        start = parser.parse(date_str)
+    start = start.replace(tzinfo=timezone.utc).isoformat()
+    # The first Distance column is in km, the second (if it's there) is in meters.
+    distances = row.get("Distance", [])
+    distance = _to_float(distances[-1]) if len(distances) > 1 else (_to_float(distances[0]) or 0.0) * 1000 if distances else None
+    act_type = row.get("Activity Type", ["Unknown"])[0].replace(" ", "").replace("-", "")
+    result = {
+        "id" : int(row["Activity ID"][0]),
+        "name" : row.get("Activity Name", [""])[0],
+        "type" : act_type,
+        "sport_type" : act_type,
+        "start_date" : start,
+        "start_date_local" : start,
+        "timezone" : "",
+        "utc_offset" : 0,
+        "location_country" : "",
+        "achievement_count" : 0,
+        "kudos_count" : 0,
+        "pr_count" : 0,
+        "has_heartrate" : last("Average Heart Rate") is not None,
+    }
+    values = {
+        "distance" : distance,
+        "elapsed_time" : last("Elapsed Time"),
+        "moving_time" : last("Moving Time"),
+        "total_elevation_gain" : last("Elevation Gain"),
+        "elev_high" : last("Elevation High"),
+        "elev_low" : last("Elevation Low"),
+        "average_speed" : last("Average Speed"),
+        "max_speed" : last("Max Speed"),
+        "average_cadence" : last("Average Cadence"),
+        "average_heartrate" : last("Average Heart Rate"),
+        "max_heartrate" : last("Max Heart Rate"),
+        "average_watts" : last("Average Watts"),
+        "max_watts" : last("Max Watts"),
+        "weighted_average_watts" : last("Weighted Average Power"),
+        "kilojoules" : last("Total Work") / 1000 if last("Total Work") is not None else None,
+        "suffer_score" : _to_float(row.get("Relative Effort", [None])[0]),
+        "average_temp" : last("Average Temperature"),
+    }
+    # Leave out anything that's blank so the field mapping falls back on its defaults.
+    result.update({k : v for k, v in values.items() if v is not None})
+    for k in ("elapsed_time", "moving_time") :
+        if k in result :
+            result[k] = int(result[k])
+    return result
+
+
+def iter_export_rows(zf) :
+    """
+    Stream the rows of an export's activities.csv straight out of the archive.
+
+    Args:
+        zf (ZipFile): the open export archive
+
+    Yields:
+        dict: column name to list of values
+    """
+    with zf.open("activities.csv") as f :
+        reader = csv.reader(io.TextIOWrapper(f, encoding="utf-8-sig", newline=""))
+        header = next(reader)
+        for values in reader :
+            row = {}
+            for col, v in zip(header, values) :
+                row.setdefault(col, []).append(v)
+            yield row
+
+
+def _save_import_batch(user, results) :
+    """
+    Replace any copies of a batch of activities we already have, bulk insert the batch and archive it.
+    """
+    replace_activities([build_strava_activity(r, user) for r in results])
+    archive_payloads(user, results)
+
+
+def import_strava_export(user, zip_path, workers=None, batch_size=None) :
+    """
+    Import a user's history from a Strava bulk export archive without any API calls.
+
+    activities.csv and the activity files are streamed out of the archive without
+    extracting it. The activity files are parsed in a process pool and the activities
+    are bulk inserted a batch at a time. Once everything is in, the derived data
+    (heatmap, route clusters and pie colors) is rebuilt.
+
+    The pool's processes are spawned rather than forked, since this can run on a thread
+    of a web server process, and forking a process with other threads running (and
+    open database connections) can leave the child deadlocked on a lock it copied.
+
+    Args:
+        user (User): the user whose history this is
+        zip_path (str): path of the export archive
+        workers (int, optional): number of parsing processes. Defaults to settings.IMPORT_WORKERS.
+        batch_size (int, optional): activities per insert. Defaults to settings.IMPORT_BATCH_SIZE.
+
+    Returns:
+        int: the number of activities imported
+    """
+    workers = workers or settings.IMPORT_WORKERS
+    batch_size = batch_size or settings.IMPORT_BATCH_SIZE
+    count = 0
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"), initializer=django.setup)
+    with zipfile.ZipFile(zip_path) as zf, pool :
+        members = set(zf.namelist())
+        batch = []
+
+        def flush(batch) :
+            # Parse the batch's activity files in parallel, then save it.
+            with_files = [r for r in batch if r["_filename"]]
+            files = [r["_filename"] for r in with_files]
+            tracks = pool.map(parse_export_track, [zip_path] * len(files), files, chunksize=16)
+            for r, track in zip(with_files, tracks) :
+                r.update(track)
+            for r in batch :
+                del r["_filename"]
+            _save_import_batch(user, batch)
+
+        for row in iter_export_rows(zf) :
+            result = export_row_to_result(row)
+            filename = row.get("Filename", [""])[0]
+            result["_filename"] = filename if filename in members else ""
+            batch.append(result)
+            if len(batch) >= batch_size :
+                flush(batch)
+                count += len(batch)
+                batch = []
+        if batch :
+            flush(batch)
+            count += len(batch)
+    finish_full_ingest(user)
+    queue_page_warming(user)
+    logger.info("Imported " + str(count) + " activities for " + user.username)
+    return count
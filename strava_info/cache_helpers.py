@@ -0,0 +1,22 @@
+from django.conf import settings
+
+# Cache backends whose contents only the process that wrote them can see.
+PROCESS_LOCAL_CACHE_BACKENDS = {
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+}
+
+
+def shared_cache_configured() :
+    """
+    Return whether the default cache is shared by every process, e.g. because CACHE_URL
+    points at redis or memcached.
+
+    Anything one process caches for another to use, or forgets on another's behalf, only
+    works with a shared cache. With the default per process memory cache, callers should
+    go to the database instead.
+
+    Returns:
+        bool: True if the default cache is shared
+    """
+    return settings.CACHES["default"]["BACKEND"] not in PROCESS_LOCAL_CACHE_BACKENDS
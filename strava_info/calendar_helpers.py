@@ -0,0 +1,73 @@
+from .models import DailyTotal
+from django.db.models import F
+import datetime
+
+# The calendar data gives days as the number of days since this one.
+CALENDAR_EPOCH = datetime.date(1970, 1, 1)
+
+
+def update_daily_totals(user, removed=(), added=()) :
+    """
+    Keep a user's per day, per sport type totals up to date as activities come and go.
+
+    Like the gear totals, this costs one update per day and sport type whose totals
+    changed, and days left without any activities are dropped.
+
+    Args:
+        user (User): the owner of the activities
+        removed (iterable, optional): (local_date, sport_type, distance_meters, moving_time_sec) of activities that went away
+        added (iterable, optional): (local_date, sport_type, distance_meters, moving_time_sec) of activities that were saved
+    """
+    net = {}
+    for sign, acts in ((-1, removed), (1, added)) :
+        for day, sport_type, distance, moving in acts :
+            totals = net.setdefault((day, sport_type), [0.0, 0, 0])
+            totals[0] += sign * distance
+            totals[1] += sign * moving
+            totals[2] += sign
+    net = {k : t for k, t in net.items() if any(t)}
+    if not net :
+        return
+    DailyTotal.objects.bulk_create([DailyTotal(site_user=user, local_date=d, sport_type=s) for d, s in net], ignore_conflicts=True)
+    for (day, sport_type), (distance, moving, count) in net.items() :
+        days = DailyTotal.objects.filter(site_user=user, local_date=day, sport_type=sport_type)
+        days.update(distance_meters=F("distance_meters") + distance, moving_time_sec=F("moving_time_sec") + moving,
+                    activity_count=F("activity_count") + count)
+        if count < 0 :
+            days.filter(activity_count=0).delete()
+
+
+def get_calendar_data(user, imperial) :
+    """
+    Return a user's daily totals for the whole of their history in a compact form.
+
+    Rather than an object per day, each sport type gets parallel arrays: the days
+    (as days since CALENDAR_EPOCH) that had any activities, and the distance,
+    moving time and activity count on each of them.
+
+    Args:
+        user (User): the user
+        imperial (bool): give distances in miles rather than km
+
+    Returns:
+        dict: the calendar data, ready to be sent as JSON
+    """
+    to_units = 0.000621371 if imperial else 0.001
+    epoch = CALENDAR_EPOCH.toordinal()
+    series = {}
+    rows = (DailyTotal.objects.filter(site_user=user).order_by("sport_type", "local_date")
+            .values_list("sport_type", "local_date", "distance_meters", "moving_time_sec", "activity_count"))
+    for sport_type, day, distance, moving, count in rows.iterator() :
+        s = series.get(sport_type)
+        if s is None :
+            s = series[sport_type] = {"days" : [], "distance" : [], "moving_time" : [], "count" : []}
+        s["days"].append(day.toordinal() - epoch)
+        s["distance"].append(round(distance * to_units, 1))
+        s["moving_time"].append(round(moving / 60))
+        s["count"].append(count)
+    return {
+        "epoch" : CALENDAR_EPOCH.isoformat(),
+        "units" : {"distance" : "miles" if imperial else "km", "moving_time" : "minutes"},
+        "sport_types" : list(series),
+        "series" : list(series.values()),
+    }
@@ -0,0 +1,182 @@
+from .models import StravaActivity
+from .spatial_helpers import refine_activities_by_area, ACTIVITY_TRACK_FIELDS
+from django.conf import settings
+from django.db import models
+import csv
+import io
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Fields that only exist for NerdDat's own bookkeeping and aren't worth exporting.
+EXPORT_EXCLUDED_FIELDS = {"id", "site_user", "route_cluster", "min_lat", "max_lat", "min_lng", "max_lng"}
+
+# The Parquet type of each kind of model field, found by walking this list with isinstance.
+# Subclasses have to come before their parents, e.g. DateTimeField is a DateField.
+PARQUET_TYPES = [
+    (models.BooleanField, lambda pa : pa.bool_()),
+    (models.IntegerField, lambda pa : pa.int64()),
+    (models.FloatField, lambda pa : pa.float64()),
+    (models.DateTimeField, lambda pa : pa.timestamp("us", tz="UTC")),
+    (models.DateField, lambda pa : pa.date32()),
+    (models.CharField, lambda pa : pa.string()),
+    (models.TextField, lambda pa : pa.string()),
+]
+
+
+def export_fields() :
+    """
+    Return the StravaActivity fields that go into an export, in model order.
+
+    Returns:
+        list: model fields
+    """
+    return [f for f in StravaActivity._meta.concrete_fields if f.name not in EXPORT_EXCLUDED_FIELDS]
+
+
+def iter_export_chunks(acts_qs, *, bbox=None, near=None, chunk_size=None) :
+    """
+    Stream a QuerySet of activities a chunk at a time.
+
+    The rows come from a server side cursor so only one chunk is ever in memory.
+    If the search was for a place, each chunk is checked against the routes.
+
+    Args:
+        acts_qs (QuerySet): the activities to export
+        bbox (tuple, optional): (south, west, north, east) the routes have to pass through. Defaults to None.
+        near (tuple, optional): (lat, lng, radius in meters) the routes have to pass near. Defaults to None.
+        chunk_size (int, optional): rows per chunk. Defaults to settings.EXPORT_CHUNK_SIZE.
+
+    Yields:
+        list: lists of StravaActivities
+    """
+    chunk_size = chunk_size or settings.EXPORT_CHUNK_SIZE
+    names = [f.name for f in export_fields()]
+    if bbox or near :
+        # Refining needs the route even if it isn't exported.
+        names += ACTIVITY_TRACK_FIELDS
+    chunk = []
+    for a in acts_qs.order_by("start_date").only(*names).iterator(chunk_size=chunk_size) :
+        chunk.append(a)
+        if len(chunk) >= chunk_size :
+            yield refine_activities_by_area(chunk, bbox=bbox, near=near) if bbox or near else chunk
+            chunk = []
+    if chunk :
+        yield refine_activities_by_area(chunk, bbox=bbox, near=near) if bbox or near else chunk
+
+
+def stream_activities_csv(acts_qs, **kwargs) :
+    """
+    Stream activities as CSV text, one chunk of rows at a time.
+
+    Args:
+        acts_qs (QuerySet): the activities to export
+        **kwargs: passed on to iter_export_chunks
+
+    Yields:
+        str: CSV text
+    """
+    fields = export_fields()
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow([f.name for f in fields])
+    yield buf.getvalue()
+    for chunk in iter_export_chunks(acts_qs, **kwargs) :
+        buf.seek(0)
+        buf.truncate()
+        for a in chunk :
+            writer.writerow([f.value_from_object(a) for f in fields])
+        yield buf.getvalue()
+
+
+class _ParquetSink :
+    """
+    A write only file that hands back whatever has been written to it since the last drain.
+    """
+    def __init__(self) :
+        self.parts = []
+        self.closed = False
+
+    def write(self, data) :
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self) :
+        pass
+
+    def drain(self) :
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+def parquet_available() :
+    """
+    Return whether pyarrow, which Parquet exports need, is installed.
+
+    Returns:
+        bool: True if Parquet exports can be made
+    """
+    try :
+        import pyarrow
+    except ImportError :
+        return False
+    return True
+
+
+def parquet_type(field, pa) :
+    """
+    Return the Parquet type an exported field is written as.
+
+    Args:
+        field (Field): a model field from export_fields
+        pa (module): pyarrow
+
+    Returns:
+        DataType: the pyarrow type
+
+    Raises:
+        TypeError: if there's no Parquet type for that kind of field
+    """
+    for field_class, make_type in PARQUET_TYPES :
+        if isinstance(field, field_class) :
+            return make_type(pa)
+    raise TypeError("No Parquet type for " + field.name + " (" + type(field).__name__ + ")")
+
+
+def parquet_schema() :
+    """
+    Return the schema of Parquet exports. Needs pyarrow.
+
+    Returns:
+        Schema: a column for each exported field
+    """
+    import pyarrow as pa
+    return pa.schema([(f.name, parquet_type(f, pa)) for f in export_fields()])
+
+
+def stream_activities_parquet(acts_qs, **kwargs) :
+    """
+    Stream activities as a Parquet file with one row group per chunk.
+
+    Needs pyarrow (see parquet_available).
+
+    Args:
+        acts_qs (QuerySet): the activities to export
+        **kwargs: passed on to iter_export_chunks
+
+    Yields:
+        bytes: pieces of the Parquet file
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    fields = export_fields()
+    schema = parquet_schema()
+    sink = _ParquetSink()
+    writer = pq.ParquetWriter(sink, schema)
+    for chunk in iter_export_chunks(acts_qs, **kwargs) :
+        columns = {f.name : [f.value_from_object(a) for a in chunk] for f in fields}
+        writer.write_table(pa.table(columns, schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
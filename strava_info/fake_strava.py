@@ -0,0 +1,152 @@
+from .bench_helpers import make_synthetic_activity
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from datetime import datetime, timedelta, timezone
+import threading
+import secrets
+import random
+import json
+import time
+
+
+class FakeStravaServer :
+    """
+    A local stand in for the parts of the Strava API that ingest uses:
+    /api/v3/activities, /api/v3/activities/<id>, /api/v3/gear/<id> and /oauth/token.
+
+    It serves made up activities for one athlete and can be made slow, made to
+    answer some calls with 429s, and made to hand out tokens that expire quickly.
+    Use it as a context manager and point STRAVA_API_URL and STRAVA_OAUTH_URL at
+    api_url and oauth_url.
+
+    Args:
+        num_activities (int): how many activities the athlete has
+        seed (int, optional): seed for the made up activities. Defaults to 1.
+        latency (float, optional): seconds to wait before answering each call. Defaults to 0.
+        rate_limit_every (int, optional): answer every nth API call with a 429. Defaults to 0 (never).
+        retry_after (float, optional): the Retry-After sent with 429s. Defaults to 0.
+        token_ttl (int, optional): seconds before a newly issued access token expires. Defaults to 21600.
+    """
+    def __init__(self, num_activities, *, seed=1, latency=0, rate_limit_every=0, retry_after=0, token_ttl=21600) :
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.token_ttl = token_ttl
+        self.lock = threading.Lock()
+        self.calls = {"activities" : 0, "activity" : 0, "gear" : 0, "token" : 0, "rate_limited" : 0, "unauthorized" : 0}
+        self.tokens = {}
+        self.refresh_token = secrets.token_hex(20)
+        rng = random.Random(seed)
+        home = (rng.uniform(30, 48), rng.uniform(-122, -72))
+        end = datetime(2023, 1, 1, tzinfo=timezone.utc)
+        self.activities = {}
+        for i in range(num_activities) :
+            start = end - timedelta(seconds=rng.uniform(0, 5 * 365 * 86400))
+            self.add_activity(make_synthetic_activity(rng, seed * 10**7 + i, start, rng.choice(["Ride", "Run", "Walk"]), home))
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        base = "http://127.0.0.1:" + str(self.httpd.server_address[1])
+        self.api_url = base + "/api/v3"
+        self.oauth_url = base + "/oauth"
+
+    def add_activity(self, activity) :
+        """
+        Add an activity, e.g. to be fetched after a webhook create event.
+        """
+        start = datetime.fromisoformat(activity["start_date"]).timestamp()
+        with self.lock :
+            self.activities[activity["id"]] = (start, activity)
+
+    def issue_token(self, ttl=None) :
+        """
+        Hand out a new access token.
+
+        Returns:
+            dict: the token fields /oauth/token returns
+        """
+        expires_at = int(time.time() + (self.token_ttl if ttl is None else ttl))
+        token = secrets.token_hex(20)
+        with self.lock :
+            self.tokens[token] = expires_at
+        return {"token_type" : "Bearer", "access_token" : token, "expires_at" : expires_at,
+                "expires_in" : expires_at - int(time.time()), "refresh_token" : self.refresh_token}
+
+    def __enter__(self) :
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc) :
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _count(self, key) :
+        with self.lock :
+            self.calls[key] += 1
+            return sum(self.calls[k] for k in ("activities", "activity", "gear"))
+
+    def _handler_class(self) :
+        server = self
+
+        class Handler(BaseHTTPRequestHandler) :
+            def log_message(self, *args) :
+                pass
+
+            def _send(self, status, body, headers=None) :
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for k, v in (headers or {}).items() :
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self) :
+                time.sleep(server.latency)
+                form = parse_qs(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8"))
+                if urlparse(self.path).path != "/oauth/token" :
+                    return self._send(404, {"message" : "Record Not Found"})
+                server._count("token")
+                if form.get("refresh_token", [None])[0] != server.refresh_token :
+                    return self._send(400, {"message" : "Bad Request", "errors" : [{"field" : "refresh_token", "code" : "invalid"}]})
+                self._send(200, server.issue_token())
+
+            def do_GET(self) :
+                time.sleep(server.latency)
+                url = urlparse(self.path)
+                query = {k : v[0] for k, v in parse_qs(url.query).items()}
+                if url.path == "/api/v3/activities" :
+                    n = server._count("activities")
+                elif url.path.startswith("/api/v3/activities/") :
+                    n = server._count("activity")
+                elif url.path.startswith("/api/v3/gear/") :
+                    n = server._count("gear")
+                else :
+                    return self._send(404, {"message" : "Record Not Found"})
+                if server.rate_limit_every and n % server.rate_limit_every == 0 :
+                    server._count("rate_limited")
+                    return self._send(429, {"message" : "Rate Limit Exceeded"}, {"Retry-After" : str(server.retry_after)})
+                token = query.get("access_token") or self.headers.get("Authorization", "").replace("Bearer ", "")
+                with server.lock :
+                    expires_at = server.tokens.get(token, 0)
+                if expires_at < time.time() :
+                    server._count("unauthorized")
+                    return self._send(401, {"message" : "Authorization Error", "errors" : [{"field" : "access_token", "code" : "invalid"}]})
+                if url.path == "/api/v3/activities" :
+                    after = int(query.get("after", 0))
+                    before = int(query.get("before", 2**62))
+                    per_page = int(query.get("per_page", 30))
+                    page = int(query.get("page", 1))
+                    with server.lock :
+                        activities = sorted(server.activities.values(), key=lambda sa : sa[0])
+                    acts = [a for start, a in activities if after < start < before]
+                    return self._send(200, acts[(page - 1) * per_page : page * per_page])
+                if url.path.startswith("/api/v3/gear/") :
+                    gear_id = url.path.rsplit("/", 1)[1]
+                    return self._send(200, {"id" : gear_id, "name" : "Gear " + gear_id})
+                with server.lock :
+                    found = server.activities.get(int(url.path.rsplit("/", 1)[1]))
+                if found :
+                    return self._send(200, found[1])
+                self._send(404, {"message" : "Record Not Found"})
+
+        return Handler
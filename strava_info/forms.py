@@ -1,6 +1,7 @@
 from django import forms
 from crispy_forms.helper import FormHelper
 from crispy_forms.layout import Layout, Submit, Row, Column, Reset
+import zipfile
 
 class StravaSearchForm(forms.Form) :
 
@@ -20,10 +21,33 @@ class StravaSearchForm(forms.Form) :
     moving_time_min = forms.IntegerField(min_value=0, required=False, label="Moving Time (min)")
     start_date = forms.DateField(widget=forms.widgets.DateInput(attrs={'type': 'date'}), label="Start Date", required=False)
     end_date = forms.DateField(widget=forms.widgets.DateInput(attrs={'type': 'date'}), label="End Date", required=False)
+    near_lat = forms.FloatField(min_value=-90.0, max_value=90.0, required=False, label="Passes Near Latitude")
+    near_lng = forms.FloatField(min_value=-180.0, max_value=180.0, required=False, label="Passes Near Longitude")
+    bounding_box = forms.CharField(max_length=100, required=False, label="Or Passes Through Box (south,west,north,east)")
+    
+    def clean_bounding_box(self) :
+        box = self.cleaned_data["bounding_box"]
+        if not box :
+            return None
+        try :
+            south, west, north, east = [float(v) for v in box.split(",")]
+        except ValueError :
+            raise forms.ValidationError("Enter four comma separated numbers: south,west,north,east.")
+        if not (-90 <= south <= north <= 90 and -180 <= west <= east <= 180) :
+            raise forms.ValidationError("That isn't a valid box.")
+        return (south, west, north, east)
+    
+    def clean(self) :
+        cleaned_data = super().clean()
+        near = [cleaned_data.get(f) for f in ("near_lat", "near_lng", "radius")]
+        if any(v is not None for v in near) and not all(v is not None for v in near) :
+            raise forms.ValidationError("To search near a place, fill in its latitude, longitude and a radius.")
+        return cleaned_data
 
 class ImperialStravaSearchForm(StravaSearchForm) :
     distance = forms.DecimalField(min_value=0.0, required=False, label="Distance in Miles")
     elev_gain = forms.DecimalField(min_value=0.0, required=False, label="Elevation Gain in Feet")
+    radius = forms.DecimalField(min_value=0.0, required=False, label="Within Radius in Miles")
     
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -41,10 +65,46 @@ class ImperialStravaSearchForm(StravaSearchForm) :
                 Column('elapsed_time_min'),
                 Column('moving_time_min'),
             ),
+            Row(
+                Column('near_lat'),
+                Column('near_lng'),
+                Column('radius'),
+                Column('bounding_box'),
+            ),
             Submit('submit', 'Search'),
         )
     
 class MetricStravaSearchForm(StravaSearchForm) :
     distance = forms.DecimalField(min_value=0.0, required=False, label="Distance in Kilometers")
     elev_gain = forms.DecimalField(min_value=0.0, required=False, label="Elevation Gain in Meters")
-    
\ No newline at end of file
+    radius = forms.DecimalField(min_value=0.0, required=False, label="Within Radius in Kilometers")
+    
+
+class GearServiceForm(forms.Form) :
+    # In the user's preferred distance units. Blank turns the service alerts off.
+    service_interval = forms.DecimalField(min_value=0.0, required=False)
+    serviced = forms.BooleanField(required=False)
+
+class StravaExportUploadForm(forms.Form) :
+    export_file = forms.FileField(label="Strava Export Archive (export_*.zip)")
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.helper = FormHelper()
+        self.helper.layout = Layout(
+            Row(
+                Column('export_file'),
+            ),
+            Submit('submit', 'Import'),
+        )
+    
+    def clean_export_file(self) :
+        export_file = self.cleaned_data["export_file"]
+        # Only the zip's directory is read here, not the activities.
+        if not zipfile.is_zipfile(export_file) :
+            raise forms.ValidationError("That isn't a zip archive. Upload the export_*.zip file Strava emailed you.")
+        with zipfile.ZipFile(export_file) as zf :
+            if "activities.csv" not in zf.namelist() :
+                raise forms.ValidationError("That archive doesn't have an activities.csv. Upload the export_*.zip file Strava emailed you.")
+        export_file.seek(0)
+        return export_file
@@ -0,0 +1,81 @@
+from .models import Gear
+from django.conf import settings
+from django.db.models import F
+
+
+def update_gear_totals(user, removed=(), added=()) :
+    """
+    Keep the running totals of a user's gear up to date as activities come and go.
+
+    Each activity only changes its own gear's totals, so this costs one update per gear
+    whose totals actually changed, however long the user's history is. Saving an activity
+    again with the same gear and numbers doesn't touch the database at all.
+
+    Args:
+        user (User): the owner of the activities
+        removed (iterable, optional): (gear_id, distance_meters, moving_time_sec) of activities that went away
+        added (iterable, optional): (gear_id, distance_meters, moving_time_sec) of activities that were saved
+    """
+    net = {}
+    for sign, acts in ((-1, removed), (1, added)) :
+        for gear_id, distance, moving in acts :
+            if not gear_id :
+                continue
+            totals = net.setdefault(gear_id, [0.0, 0, 0])
+            totals[0] += sign * distance
+            totals[1] += sign * moving
+            totals[2] += sign
+    net = {g : t for g, t in net.items() if any(t)}
+    if not net :
+        return
+    # Make rows for any gear we haven't seen before.
+    Gear.objects.bulk_create([Gear(site_user=user, gear_id=g) for g in net], ignore_conflicts=True)
+    for gear_id, (distance, moving, count) in net.items() :
+        Gear.objects.filter(site_user=user, gear_id=gear_id).update(distance_meters=F("distance_meters") + distance,
+                                                                    moving_time_sec=F("moving_time_sec") + moving,
+                                                                    activity_count=F("activity_count") + count)
+
+
+def unnamed_gear_ids(user) :
+    """
+    Return the ids of a user's gear whose names we haven't fetched from Strava yet.
+
+    Args:
+        user (User): the owner of the gear
+
+    Returns:
+        list: the gear ids
+    """
+    return list(Gear.objects.filter(site_user=user, name="").values_list("gear_id", flat=True))
+
+
+def name_gear(user, gear_id, name) :
+    """
+    Save the name Strava gave one of a user's gear.
+
+    Args:
+        user (User): the owner of the gear
+        gear_id (str): Strava's id for the gear
+        name (str): its name
+    """
+    Gear.objects.filter(site_user=user, gear_id=gear_id).update(name=name)
+
+
+def gear_service_status(gear) :
+    """
+    Work out how far a piece of gear has gone since its last service and whether it's due.
+
+    Args:
+        gear (Gear): the gear
+
+    Returns:
+        tuple: (meters since the last service, "due", "soon" or "" if it isn't due or has no interval)
+    """
+    since = gear.distance_meters - gear.serviced_at_m
+    if not gear.service_interval_m :
+        return since, ""
+    if since >= gear.service_interval_m :
+        return since, "due"
+    if since >= gear.service_interval_m * settings.GEAR_SERVICE_WARNING_FRACTION :
+        return since, "soon"
+    return since, ""
@@ -0,0 +1,467 @@
+import math
+
+# NumPy is imported inside the functions that use it. This module is imported by every
+# page, but only ingest, heatmaps and place searches need NumPy.
+
+# Web Mercator tiles are 256 pixels on a side.
+TILE_SIZE = 256
+# Web Mercator can't represent the poles so clamp latitudes to this.
+MAX_MERCATOR_LAT = 85.05112878
+
+def decode_polyline(polyline) :
+    """
+    Decode a Google encoded polyline (the format Strava uses for map.summary_polyline).
+
+    Args:
+        polyline (str): the encoded polyline
+
+    Returns:
+        ndarray: N x 2 array of (lat, lng) points in degrees
+    """
+    import numpy as np
+    if not polyline :
+        return np.empty((0, 2))
+    coords = []
+    index = 0
+    lat = 0
+    lng = 0
+    length = len(polyline)
+    while index < length :
+        # Each point is a pair of deltas from the previous point.
+        deltas = []
+        for _ in range(2) :
+            shift = 0
+            result = 0
+            while True :
+                b = ord(polyline[index]) - 63
+                index += 1
+                result |= (b & 0x1f) << shift
+                shift += 5
+                if b < 0x20 :
+                    break
+            deltas.append(~(result >> 1) if result & 1 else result >> 1)
+        lat += deltas[0]
+        lng += deltas[1]
+        coords.append((lat, lng))
+    return np.array(coords, dtype=np.float64) / 1e5
+
+
+def decode_polylines(polylines) :
+    """
+    Decode a batch of encoded polylines into one flat array of points.
+
+    Args:
+        polylines (iterable): encoded polyline strings
+
+    Returns:
+        tuple: (points, offsets) where points is an N x 2 array of (lat, lng) and
+               the points of the i-th polyline are points[offsets[i]:offsets[i+1]]
+    """
+    import numpy as np
+    decoded = [decode_polyline(p) for p in polylines]
+    offsets = np.zeros(len(decoded) + 1, dtype=np.int64)
+    if decoded :
+        offsets[1:] = np.cumsum([len(d) for d in decoded])
+        points = np.concatenate(decoded) if offsets[-1] > 0 else np.empty((0, 2))
+    else :
+        points = np.empty((0, 2))
+    return points, offsets
+
+
+def latlng_to_global_pixels(lat, lng, zoom) :
+    """
+    Project latitudes and longitudes to global Web Mercator pixel coordinates.
+
+    Args:
+        lat (ndarray): latitudes in degrees
+        lng (ndarray): longitudes in degrees
+        zoom (int): the zoom level
+
+    Returns:
+        tuple: (x, y) float arrays of pixel coordinates at the zoom level
+    """
+    import numpy as np
+    world = TILE_SIZE * (1 << zoom)
+    lat = np.clip(lat, -MAX_MERCATOR_LAT, MAX_MERCATOR_LAT)
+    x = (lng + 180.0) / 360.0 * world
+    sin_lat = np.sin(np.radians(lat))
+    y = (0.5 - np.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * world
+    # Keep everything on the map.
+    x = np.clip(x, 0, world - 1)
+    y = np.clip(y, 0, world - 1)
+    return x, y
+
+
+def densify_track(x, y) :
+    """
+    Fill in the gaps between consecutive pixel coordinates so that the track is continuous.
+
+    Each segment is sampled at (at most) one pixel steps, which is what we need in
+    order to rasterize the line rather than just its vertices.
+
+    Args:
+        x (ndarray): pixel x coordinates of a single track
+        y (ndarray): pixel y coordinates of a single track
+
+    Returns:
+        tuple: (x, y) integer arrays of the pixels the track passes through
+    """
+    import numpy as np
+    if len(x) < 2 :
+        return x.astype(np.int64), y.astype(np.int64)
+    dx = np.diff(x)
+    dy = np.diff(y)
+    # Number of samples needed per segment.
+    steps = np.maximum(np.ceil(np.maximum(np.abs(dx), np.abs(dy))), 1).astype(np.int64)
+    seg = np.repeat(np.arange(len(dx)), steps)
+    # Position of each sample inside its segment (0 up to, but not including, 1).
+    starts = np.cumsum(steps) - steps
+    t = (np.arange(steps.sum()) - np.repeat(starts, steps)) / np.repeat(steps, steps)
+    xs = np.concatenate([x[seg] + dx[seg] * t, x[-1:]])
+    ys = np.concatenate([y[seg] + dy[seg] * t, y[-1:]])
+    return xs.astype(np.int64), ys.astype(np.int64)
+
+
+# Geohash uses its own base 32 alphabet.
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+EARTH_RADIUS_M = 6371008.8
+
+def geohash_grid_shape(precision) :
+    """
+    Return how many rows and columns the geohash grid has at a precision.
+
+    Geohash interleaves longitude and latitude bits (starting with longitude) so at a
+    given precision the world is divided into an equal angle grid.
+
+    Args:
+        precision (int): number of geohash characters
+
+    Returns:
+        tuple: (rows, cols) of the grid
+    """
+    bits = 5 * precision
+    return 1 << (bits // 2), 1 << ((bits + 1) // 2)
+
+
+def latlng_to_geo_grid(lat, lng, precision) :
+    """
+    Convert latitudes and longitudes to fractional geohash grid coordinates.
+
+    Args:
+        lat (ndarray): latitudes in degrees
+        lng (ndarray): longitudes in degrees
+        precision (int): number of geohash characters
+
+    Returns:
+        tuple: (col, row) float arrays. The integer parts are the cell a point falls in.
+    """
+    import numpy as np
+    rows, cols = geohash_grid_shape(precision)
+    col = np.clip((np.asarray(lng) + 180.0) / 360.0 * cols, 0, cols - 1e-9)
+    row = np.clip((np.asarray(lat) + 90.0) / 180.0 * rows, 0, rows - 1e-9)
+    return col, row
+
+
+def geohash_from_grid(col, row, precision) :
+    """
+    Encode integer geohash grid cells as geohash strings.
+
+    Args:
+        col (ndarray): integer grid columns (longitude)
+        row (ndarray): integer grid rows (latitude)
+        precision (int): number of geohash characters
+
+    Returns:
+        list: geohash strings
+    """
+    import numpy as np
+    col = np.asarray(col, dtype=np.int64)
+    row = np.asarray(row, dtype=np.int64)
+    bits = 5 * precision
+    lng_bits = (bits + 1) // 2
+    lat_bits = bits // 2
+    code = np.zeros(col.shape, dtype=np.int64)
+    # Interleave the bits, most significant first, starting with longitude.
+    for i in range(bits) :
+        if i % 2 == 0 :
+            bit = (col >> (lng_bits - 1 - i // 2)) & 1
+        else :
+            bit = (row >> (lat_bits - 1 - i // 2)) & 1
+        code = (code << 1) | bit
+    alphabet = np.array(list(GEOHASH_ALPHABET))
+    chars = [alphabet[(code >> (5 * (precision - 1 - c))) & 31] for c in range(precision)]
+    return ["".join(t) for t in zip(*chars)] if precision > 0 else []
+
+
+def track_geohash_cells(points, precision) :
+    """
+    Return every geohash cell a track passes through.
+
+    The track is densified in grid space so that cells that a long straight
+    segment crosses are included even if no vertex falls inside them.
+
+    Args:
+        points (ndarray): N x 2 array of (lat, lng) points
+        precision (int): number of geohash characters
+
+    Returns:
+        list: distinct geohash strings
+    """
+    import numpy as np
+    if len(points) == 0 :
+        return []
+    col, row = latlng_to_geo_grid(points[:, 0], points[:, 1], precision)
+    col, row = densify_track(col, row)
+    cells = np.unique(np.stack([col, row]), axis=1)
+    return geohash_from_grid(cells[0], cells[1], precision)
+
+
+def bbox_geohash_cells(south, west, north, east, precision) :
+    """
+    Return every geohash cell that overlaps a bounding box.
+
+    Args:
+        south (float): southern latitude
+        west (float): western longitude
+        north (float): northern latitude
+        east (float): eastern longitude
+        precision (int): number of geohash characters
+
+    Returns:
+        list: geohash strings
+    """
+    import numpy as np
+    col0, row0 = latlng_to_geo_grid(south, west, precision)
+    col1, row1 = latlng_to_geo_grid(north, east, precision)
+    cols, rows = np.meshgrid(np.arange(int(col0), int(col1) + 1), np.arange(int(row0), int(row1) + 1))
+    return geohash_from_grid(cols.ravel(), rows.ravel(), precision)
+
+
+def bbox_geohash_cell_count(south, west, north, east, precision) :
+    """
+    Return how many geohash cells bbox_geohash_cells would return, without building them.
+    """
+    col0, row0 = latlng_to_geo_grid(south, west, precision)
+    col1, row1 = latlng_to_geo_grid(north, east, precision)
+    return (int(col1) - int(col0) + 1) * (int(row1) - int(row0) + 1)
+
+
+def radius_to_bbox(lat, lng, radius_m) :
+    """
+    Return the bounding box that contains a circle on the earth.
+
+    Args:
+        lat (float): latitude of the center
+        lng (float): longitude of the center
+        radius_m (float): radius in meters
+
+    Returns:
+        tuple: (south, west, north, east)
+    """
+    dlat = math.degrees(radius_m / EARTH_RADIUS_M)
+    # Don't blow up near the poles.
+    dlng = math.degrees(radius_m / (EARTH_RADIUS_M * max(math.cos(math.radians(lat)), 1e-6)))
+    return (max(lat - dlat, -90.0), max(lng - dlng, -180.0), min(lat + dlat, 90.0), min(lng + dlng, 180.0))
+
+
+def track_within_radius(points, lat, lng, radius_m) :
+    """
+    Check whether any part of a track comes within a distance of a point.
+
+    Distances are measured to the track's segments (not just its vertices) using a
+    local flat earth projection around the point, which is plenty accurate at the
+    distances people search over.
+
+    Args:
+        points (ndarray): N x 2 array of (lat, lng) points
+        lat (float): latitude of the point
+        lng (float): longitude of the point
+        radius_m (float): distance in meters
+
+    Returns:
+        bool: True if the track passes within radius_m of the point
+    """
+    import numpy as np
+    if len(points) == 0 :
+        return False
+    m_per_deg = math.radians(1) * EARTH_RADIUS_M
+    x = (points[:, 1] - lng) * m_per_deg * math.cos(math.radians(lat))
+    y = (points[:, 0] - lat) * m_per_deg
+    if len(points) == 1 :
+        return bool(np.hypot(x[0], y[0]) <= radius_m)
+    ax, ay = x[:-1], y[:-1]
+    dx, dy = np.diff(x), np.diff(y)
+    seg_len2 = dx * dx + dy * dy
+    t = np.where(seg_len2 > 0, -(ax * dx + ay * dy) / np.where(seg_len2 > 0, seg_len2, 1), 0.0)
+    t = np.clip(t, 0.0, 1.0)
+    return bool((np.hypot(ax + t * dx, ay + t * dy) <= radius_m).any())
+
+
+def track_intersects_bbox(points, south, west, north, east) :
+    """
+    Check whether any part of a track passes through a bounding box.
+
+    Each segment is clipped against the box (Liang-Barsky) so a segment that
+    crosses the box counts even if neither of its ends is inside it.
+
+    Args:
+        points (ndarray): N x 2 array of (lat, lng) points
+        south (float): southern latitude
+        west (float): western longitude
+        north (float): northern latitude
+        east (float): eastern longitude
+
+    Returns:
+        bool: True if the track passes through the box
+    """
+    import numpy as np
+    if len(points) == 0 :
+        return False
+    lat = points[:, 0]
+    lng = points[:, 1]
+    inside = (lat >= south) & (lat <= north) & (lng >= west) & (lng <= east)
+    if inside.any() :
+        return True
+    if len(points) == 1 :
+        return False
+    x0, y0 = lng[:-1], lat[:-1]
+    dx, dy = np.diff(lng), np.diff(lat)
+    t0 = np.zeros(len(dx))
+    t1 = np.ones(len(dx))
+    ok = np.ones(len(dx), dtype=bool)
+    for p, q in ((-dx, x0 - west), (dx, east - x0), (-dy, y0 - south), (dy, north - y0)) :
+        with np.errstate(divide="ignore", invalid="ignore") :
+            r = q / p
+        ok &= ~((p == 0) & (q < 0))
+        t0 = np.where(p < 0, np.maximum(t0, r), t0)
+        t1 = np.where(p > 0, np.minimum(t1, r), t1)
+    return bool((ok & (t0 <= t1)).any())
+
+
+def point_geohash_neighborhood(lat, lng, precision) :
+    """
+    Return the geohash cell a point falls in along with the eight cells around it.
+
+    Args:
+        lat (float): latitude in degrees
+        lng (float): longitude in degrees
+        precision (int): number of geohash characters
+
+    Returns:
+        list: geohash strings with the point's own cell first
+    """
+    rows, cols = geohash_grid_shape(precision)
+    col, row = latlng_to_geo_grid(lat, lng, precision)
+    col, row = int(col), int(row)
+    cells = [(col, row)] + [((col + dc) % cols, row + dr) for dr in (-1, 0, 1) for dc in (-1, 0, 1)
+                            if (dc or dr) and 0 <= row + dr < rows]
+    return geohash_from_grid([c for c, _ in cells], [r for _, r in cells], precision)
+
+
+def _local_meters(points, lat0) :
+    """
+    Project points to a flat earth approximation in meters around a latitude.
+    """
+    import numpy as np
+    m_per_deg = math.radians(1) * EARTH_RADIUS_M
+    return np.column_stack([points[:, 1] * m_per_deg * math.cos(math.radians(lat0)), points[:, 0] * m_per_deg])
+
+
+def track_length_m(points) :
+    """
+    Return the length of a track in meters.
+
+    Args:
+        points (ndarray): N x 2 array of (lat, lng) points
+
+    Returns:
+        float: length in meters
+    """
+    import numpy as np
+    if len(points) < 2 :
+        return 0.0
+    xy = _local_meters(points, points[:, 0].mean())
+    return float(np.hypot(*np.diff(xy, axis=0).T).sum())
+
+
+def resample_track(points, n) :
+    """
+    Resample a track to n points spaced evenly along its length.
+
+    This throws away the detail of how densely the track was recorded so two
+    recordings of the same route can be compared point for point.
+
+    Args:
+        points (ndarray): M x 2 array of (lat, lng) points with M >= 2
+        n (int): number of points to return
+
+    Returns:
+        ndarray: n x 2 array of (lat, lng) points
+    """
+    import numpy as np
+    xy = _local_meters(points, points[:, 0].mean())
+    dist = np.concatenate([[0.0], np.cumsum(np.hypot(*np.diff(xy, axis=0).T))])
+    targets = np.linspace(0.0, dist[-1], n)
+    return np.column_stack([np.interp(targets, dist, points[:, 0]), np.interp(targets, dist, points[:, 1])])
+
+
+def mean_track_separation_m(a, b) :
+    """
+    Return the average distance in meters between matching points of two resampled tracks.
+
+    Args:
+        a (ndarray): n x 2 array of (lat, lng) points
+        b (ndarray): n x 2 array of (lat, lng) points
+
+    Returns:
+        float: average separation in meters
+    """
+    import numpy as np
+    lat0 = (a[:, 0].mean() + b[:, 0].mean()) / 2
+    return float(np.hypot(*(_local_meters(a, lat0) - _local_meters(b, lat0)).T).mean())
+
+
+def encode_polyline(points) :
+    """
+    Encode points as a Google encoded polyline (the inverse of decode_polyline).
+
+    Args:
+        points (ndarray): N x 2 array of (lat, lng) points in degrees
+
+    Returns:
+        str: the encoded polyline
+    """
+    import numpy as np
+    chunks = []
+    prev_lat = 0
+    prev_lng = 0
+    for lat, lng in np.round(np.asarray(points) * 1e5).astype(np.int64) :
+        for delta in (lat - prev_lat, lng - prev_lng) :
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20 :
+                chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            chunks.append(chr(value + 63))
+        prev_lat, prev_lng = lat, lng
+    return "".join(chunks)
+
+
+def thin_track(points, max_points) :
+    """
+    Thin a recorded track down to at most max_points points, always keeping the last one.
+
+    Strava's summary polylines are coarse, so a track recorded every second is
+    thinned before it's stored as one.
+
+    Args:
+        points (ndarray): N x 2 array of (lat, lng) points
+        max_points (int): the most points to keep
+
+    Returns:
+        ndarray: the thinned points
+    """
+    import numpy as np
+    if len(points) <= max_points :
+        return points
+    idx = np.unique(np.linspace(0, len(points) - 1, max_points).round().astype(np.int64))
+    return points[idx]
@@ -0,0 +1,281 @@
+from .models import StravaActivity, StravaUser
+from .geo_helpers import decode_polylines, latlng_to_global_pixels, densify_track, TILE_SIZE
+from django.conf import settings
+from django.db import connections, router
+from contextlib import contextmanager
+from pathlib import Path
+import threading
+import os
+import shutil
+import io
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Tiles are read, modified and written back, so don't let two threads or processes
+# (say a download and a webhook) update the same user's tiles at once.
+_user_locks = {}
+_user_locks_lock = threading.Lock()
+# The first key of the Postgres advisory locks on users' tiles, so they can't collide
+# with other advisory locks keyed on user ids.
+HEATMAP_LOCK_NAMESPACE = 0x4E44
+
+
+def _get_user_lock(user) :
+    """
+    Return the lock that guards a user's heatmap tiles.
+
+    Args:
+        user (User): the user who owns the tiles
+
+    Returns:
+        Lock: the user's lock
+    """
+    with _user_locks_lock :
+        return _user_locks.setdefault(user.id, threading.Lock())
+
+
+@contextmanager
+def _tile_lock(user) :
+    """
+    Hold the lock on a user's tiles: their thread lock within this process and, on
+    Postgres, an advisory lock keyed on the user for other processes. Other databases
+    only get the thread lock.
+
+    The advisory lock doesn't touch any rows, so saving the user's StravaUser (or
+    anything else) isn't held up while their tiles are drawn.
+
+    Args:
+        user (User): the user who owns the tiles
+    """
+    conn = connections[router.db_for_write(StravaUser)]
+    with _get_user_lock(user) :
+        if conn.vendor != "postgresql" :
+            yield
+            return
+        with conn.cursor() as cursor :
+            cursor.execute("SELECT pg_advisory_lock(%s, %s)", [HEATMAP_LOCK_NAMESPACE, user.id])
+        try :
+            yield
+        finally :
+            with conn.cursor() as cursor :
+                cursor.execute("SELECT pg_advisory_unlock(%s, %s)", [HEATMAP_LOCK_NAMESPACE, user.id])
+
+
+def heatmap_dir(user) :
+    """
+    Return the directory that holds a user's heatmap tile pyramid.
+
+    Args:
+        user (User): the user who owns the tiles
+
+    Returns:
+        Path: the user's tile directory
+    """
+    return Path(settings.HEATMAP_TILE_DIR) / str(user.id)
+
+
+def _tile_path(user, z, x, y, ext) :
+    return heatmap_dir(user) / str(z) / str(x) / (str(y) + ext)
+
+
+def _load_counts(path) :
+    """
+    Load a tile's count array from disk, or return an empty one if there isn't one yet.
+    """
+    import numpy as np
+    if path.exists() :
+        with np.load(path) as f :
+            return f["counts"]
+    return np.zeros((TILE_SIZE, TILE_SIZE), dtype=np.uint32)
+
+
+def _save_counts(path, counts) :
+    """
+    Save a tile's count array. It's written next to the tile and moved into place so a
+    reader in another process never sees half a file.
+    """
+    import numpy as np
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.stem + "." + str(os.getpid()) + "." + str(threading.get_ident()) + ".tmp.npz")
+    np.savez_compressed(tmp, counts=counts)
+    os.replace(tmp, path)
+
+
+def add_polylines_to_heatmap(user, polylines, sign=1) :
+    """
+    Add (or with sign=-1, remove) a batch of activities to a user's heatmap tiles.
+
+    Every zoom level between HEATMAP_MIN_ZOOM and HEATMAP_MAX_ZOOM is updated. Each
+    activity counts at most once per pixel so a pixel's count is the number of activities
+    that passed through it. Only the tiles the activities touch are read and rewritten,
+    and any PNGs rendered from those tiles are thrown away so they get re-rendered.
+
+    Args:
+        user (User): the user who owns the activities
+        polylines (list): encoded summary polylines of the activities
+        sign (int, optional): 1 to add the activities, -1 to remove them. Defaults to 1.
+    """
+    import numpy as np
+    polylines = [p for p in polylines if p]
+    if not polylines :
+        return
+    min_zoom = settings.HEATMAP_MIN_ZOOM
+    max_zoom = settings.HEATMAP_MAX_ZOOM
+    points, offsets = decode_polylines(polylines)
+    # Project everything once at the highest zoom. Lower zooms are just bit shifts of these.
+    all_x, all_y = latlng_to_global_pixels(points[:, 0], points[:, 1], max_zoom)
+    keys_by_zoom = {z : [] for z in range(min_zoom, max_zoom+1)}
+    for i in range(len(polylines)) :
+        start, end = offsets[i], offsets[i+1]
+        if end == start :
+            continue
+        px, py = densify_track(all_x[start:end], all_y[start:end])
+        for z in range(min_zoom, max_zoom+1) :
+            shift = max_zoom - z
+            world = TILE_SIZE << z
+            # One key per pixel and only count each pixel once per activity.
+            keys_by_zoom[z].append(np.unique((py >> shift) * world + (px >> shift)))
+
+    with _tile_lock(user) :
+        for z, key_list in keys_by_zoom.items() :
+            if not key_list :
+                continue
+            world = TILE_SIZE << z
+            keys, counts = np.unique(np.concatenate(key_list), return_counts=True)
+            gy = keys // world
+            gx = keys % world
+            tile_ids = (gy // TILE_SIZE) * (1 << z) + (gx // TILE_SIZE)
+            # Group the pixels by tile so that each tile is read and written once.
+            order = np.argsort(tile_ids, kind="stable")
+            tile_ids, gx, gy, counts = tile_ids[order], gx[order], gy[order], counts[order]
+            boundaries = np.flatnonzero(np.diff(tile_ids)) + 1
+            for idx in np.split(np.arange(len(tile_ids)), boundaries) :
+                tx = int(gx[idx[0]] // TILE_SIZE)
+                ty = int(gy[idx[0]] // TILE_SIZE)
+                path = _tile_path(user, z, tx, ty, ".npz")
+                tile = _load_counts(path).astype(np.int64)
+                tile[gy[idx] % TILE_SIZE, gx[idx] % TILE_SIZE] += sign * counts[idx]
+                tile = np.clip(tile, 0, None)
+                if tile.any() :
+                    _save_counts(path, tile.astype(np.uint32))
+                elif path.exists() :
+                    path.unlink()
+                # The rendered image is now stale.
+                _tile_path(user, z, tx, ty, ".png").unlink(missing_ok=True)
+
+
+def rebuild_user_heatmap(user, batch_size=None) :
+    """
+    Throw away a user's heatmap tiles and build them again from all of their activities.
+
+    The polylines are streamed from the database and rasterized in batches so memory
+    stays bounded no matter how many activities the user has.
+
+    Args:
+        user (User): the user whose heatmap we are building
+        batch_size (int, optional): number of activities to rasterize at once. Defaults to settings.HEATMAP_BATCH_SIZE.
+    """
+    batch_size = batch_size or settings.HEATMAP_BATCH_SIZE
+    delete_user_heatmap(user)
+    polylines = (StravaActivity.objects.filter(site_user=user)
+                 .exclude(summary_polyline="")
+                 .values_list("summary_polyline", flat=True)
+                 .iterator(chunk_size=batch_size))
+    batch = []
+    for p in polylines :
+        batch.append(p)
+        if len(batch) >= batch_size :
+            add_polylines_to_heatmap(user, batch)
+            batch = []
+    add_polylines_to_heatmap(user, batch)
+
+
+def delete_user_heatmap(user) :
+    """
+    Delete all of a user's heatmap tiles.
+
+    Args:
+        user (User): the user whose tiles we are deleting
+    """
+    with _tile_lock(user) :
+        shutil.rmtree(heatmap_dir(user), ignore_errors=True)
+
+
+def _counts_to_png(counts) :
+    """
+    Color a tile's count array and encode it as a PNG.
+
+    Counts are put on a log scale that saturates at HEATMAP_SATURATION activities so
+    that colors mean the same thing on every tile. Pixels no activity passed through
+    are transparent.
+    """
+    import numpy as np
+    from PIL import Image
+    t = np.log1p(counts) / np.log1p(settings.HEATMAP_SATURATION)
+    t = np.clip(t, 0.0, 1.0)
+    rgba = np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+    # Go from red through orange and yellow to white as the count grows.
+    rgba[..., 0] = 255
+    rgba[..., 1] = np.clip(t * 2, 0, 1) * 255
+    rgba[..., 2] = np.clip(t * 2 - 1, 0, 1) * 255
+    rgba[..., 3] = np.where(counts > 0, 140 + 115 * t, 0)
+    buf = io.BytesIO()
+    Image.fromarray(rgba, mode="RGBA").save(buf, format="PNG", optimize=True)
+    return buf.getvalue()
+
+
+def _file_stamp(path) :
+    """
+    Return something that changes whenever a file is replaced, or None if it doesn't exist.
+    """
+    try :
+        st = path.stat()
+    except FileNotFoundError :
+        return None
+    return (st.st_ino, st.st_mtime_ns)
+
+
+_empty_tile_png = None
+
+def render_heatmap_tile(user, z, x, y) :
+    """
+    Return the PNG for one of a user's heatmap tiles.
+
+    PNGs are rendered from the count arrays the first time they are asked for and
+    cached next to them on disk until the counts change. This only takes the in process
+    lock, so tile requests don't touch the database. If another process changes the
+    counts while we render, the PNG we wrote is thrown away again.
+
+    Args:
+        user (User): the user who owns the tile
+        z (int): zoom level
+        x (int): tile column
+        y (int): tile row
+
+    Returns:
+        bytes: PNG image data
+    """
+    global _empty_tile_png
+    import numpy as np
+    png_path = _tile_path(user, z, x, y, ".png")
+    counts_path = _tile_path(user, z, x, y, ".npz")
+    with _get_user_lock(user) :
+        if png_path.exists() :
+            return png_path.read_bytes()
+        try :
+            before = _file_stamp(counts_path)
+            png = _counts_to_png(_load_counts(counts_path)) if before else None
+        except FileNotFoundError :
+            # It was removed as we read it.
+            png = None
+        if png is not None :
+            png_path.write_bytes(png)
+            # The counts changed under us, so the PNG may already be stale.
+            if _file_stamp(counts_path) != before :
+                png_path.unlink(missing_ok=True)
+            return png
+    # Nobody has been here. Every user shares the same blank tile.
+    if _empty_tile_png is None :
+        _empty_tile_png = _counts_to_png(np.zeros((TILE_SIZE, TILE_SIZE), dtype=np.uint32))
+    return _empty_tile_png
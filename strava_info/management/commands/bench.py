@@ -0,0 +1,64 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from strava_info.bench_helpers import parse_sport_mix, create_synthetic_athlete, benchmark_athlete, explain_chart_queries
+import datetime
+import platform
+import json
+import sys
+
+
+class Command(BaseCommand) :
+    help = ("Benchmark NerdDat's heavy helpers and views against synthetic athletes. "
+            "Runs in a throwaway test database made from the configured one (SQLite or Postgres).")
+
+    def add_arguments(self, parser) :
+        parser.add_argument("--athletes", type=int, default=1, help="number of synthetic athletes")
+        parser.add_argument("--activities", type=int, action="append", help="activities per athlete (repeat to bench several sizes)")
+        parser.add_argument("--years", type=int, default=5, help="years each athlete's history spans")
+        parser.add_argument("--sport-mix", default="Ride:6,Run:3,Swim:1", help="sport_type:weight pairs, e.g. Ride:6,Run:3,Swim:1")
+        parser.add_argument("--seed", type=int, default=1, help="seed for the synthetic data")
+        parser.add_argument("--repeat", type=int, default=10, help="times to run each benchmark")
+        parser.add_argument("--explain", action="store_true", help="include the query plans of the chart queries in the report")
+        parser.add_argument("--keepdb", action="store_true", help="keep the test database between runs")
+        parser.add_argument("--output", default="-", help="file to write the JSON report to, or - for stdout")
+
+    def handle(self, *args, **options) :
+        try :
+            sport_mix = parse_sport_mix(options["sport_mix"])
+        except ValueError :
+            raise CommandError("Couldn't understand --sport-mix " + options["sport_mix"])
+        sizes = options["activities"] or [1000]
+        # Never touch the real data. Build a test database like manage.py test does.
+        old_name = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options["keepdb"])
+        try :
+            report = {
+                "started" : datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "database" : connection.vendor,
+                "python" : platform.python_version(),
+                "options" : {k : options[k] for k in ("athletes", "years", "sport_mix", "seed", "repeat")},
+                "runs" : [],
+            }
+            for size in sizes :
+                for a in range(options["athletes"]) :
+                    seed = options["seed"] + a
+                    username = "bench-" + str(size) + "-" + str(seed)
+                    self.stderr.write("Creating " + username + " with " + str(size) + " activities")
+                    user = create_synthetic_athlete(username, num_activities=size, years=options["years"],
+                                                    sport_mix=sport_mix, seed=seed)
+                    self.stderr.write("Benchmarking " + username)
+                    run = {"athlete" : username, "activities" : size,
+                           "results" : benchmark_athlete(user, options["repeat"])}
+                    if options["explain"] :
+                        run["plans"] = explain_chart_queries(user)
+                    report["runs"].append(run)
+                    user.delete()
+        finally :
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options["keepdb"])
+        out = sys.stdout if options["output"] == "-" else open(options["output"], "w")
+        try :
+            json.dump(report, out, indent=2)
+            out.write("\n")
+        finally :
+            if out is not sys.stdout :
+                out.close()
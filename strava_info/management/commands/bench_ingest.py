@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import override_settings
+from strava_info.fake_strava import FakeStravaServer
+from strava_info.bench_helpers import benchmark_ingest
+import datetime
+import platform
+import tempfile
+import json
+import sys
+
+
+class Command(BaseCommand) :
+    help = ("Benchmark a full Strava download and webhook handling end to end against a local stand in for the Strava API. "
+            "Runs in a throwaway test database made from the configured one.")
+
+    def add_arguments(self, parser) :
+        parser.add_argument("--activities", type=int, default=2000, help="activities the fake athlete has")
+        parser.add_argument("--webhook-events", type=int, default=50, help="activities to create, update and delete through webhooks")
+        parser.add_argument("--latency", type=float, default=0.0, help="seconds the fake API waits before each answer")
+        parser.add_argument("--rate-limit-every", type=int, default=0, help="answer every nth API call with a 429 (0 for never)")
+        parser.add_argument("--retry-after", type=float, default=0.0, help="Retry-After seconds sent with 429s")
+        parser.add_argument("--token-ttl", type=int, default=21600, help="seconds before tokens the fake API issues expire")
+        parser.add_argument("--seed", type=int, default=1, help="seed for the synthetic data")
+        parser.add_argument("--keepdb", action="store_true", help="keep the test database between runs")
+        parser.add_argument("--output", default="-", help="file to write the JSON report to, or - for stdout")
+
+    def handle(self, *args, **options) :
+        # Never touch the real data. Build a test database like manage.py test does.
+        old_name = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options["keepdb"])
+        try :
+            self.stderr.write("Making up " + str(options["activities"]) + " activities")
+            with FakeStravaServer(options["activities"], seed=options["seed"], latency=options["latency"],
+                                  rate_limit_every=options["rate_limit_every"], retry_after=options["retry_after"],
+                                  token_ttl=options["token_ttl"]) as server, tempfile.TemporaryDirectory() as tile_dir :
+                with override_settings(STRAVA_API_URL=server.api_url, STRAVA_OAUTH_URL=server.oauth_url,
+                                       STRAVA_RATE_LIMIT_WAIT=options["retry_after"], HEATMAP_TILE_DIR=tile_dir) :
+                    self.stderr.write("Ingesting from " + server.api_url)
+                    results = benchmark_ingest(server, webhook_events=options["webhook_events"], seed=options["seed"])
+        finally :
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options["keepdb"])
+        report = {
+            "started" : datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "database" : connection.vendor,
+            "python" : platform.python_version(),
+            "options" : {k : options[k] for k in ("activities", "webhook_events", "latency", "rate_limit_every",
+                                                  "retry_after", "token_ttl", "seed")},
+            "results" : results,
+        }
+        out = sys.stdout if options["output"] == "-" else open(options["output"], "w")
+        try :
+            json.dump(report, out, indent=2)
+            out.write("\n")
+        finally :
+            if out is not sys.stdout :
+                out.close()
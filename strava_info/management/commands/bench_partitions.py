@@ -0,0 +1,83 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import override_settings
+from strava_info.models import StravaUser, StravaActivity
+from strava_info.bench_helpers import fill_activities, benchmark_per_user_queries, benchmark_account_deletes
+from strava_info.partition_helpers import PARTITION_STRATEGIES, partition_activities
+import datetime
+import platform
+import tempfile
+import random
+import json
+import time
+import sys
+
+
+class Command(BaseCommand) :
+    help = ("Benchmark per athlete queries and account deletion on a big activities table, before and after "
+            "partitioning it. Needs Postgres. Runs in a throwaway test database made from the configured one.")
+
+    def add_arguments(self, parser) :
+        parser.add_argument("--rows", type=int, default=10000000, help="activities in the table")
+        parser.add_argument("--athletes", type=int, default=1000, help="athletes the activities are spread over")
+        parser.add_argument("--strategy", choices=PARTITION_STRATEGIES, default="hash", help="how to partition the table")
+        parser.add_argument("--partitions", type=int, default=None, help="number of hash partitions")
+        parser.add_argument("--sample", type=int, default=20, help="athletes to run the queries for")
+        parser.add_argument("--repeat", type=int, default=50, help="times to run each query")
+        parser.add_argument("--deletes", type=int, default=5, help="accounts to delete each time")
+        parser.add_argument("--seed", type=int, default=1, help="seed for picking athletes")
+        parser.add_argument("--keepdb", action="store_true", help="keep the test database between runs")
+        parser.add_argument("--output", default="-", help="file to write the JSON report to, or - for stdout")
+
+    def measure(self, users, rng, deletes) :
+        sample = rng.sample(users, min(len(users), self.options["sample"]))
+        results = benchmark_per_user_queries(sample, self.options["repeat"])
+        doomed = rng.sample([u for u in users if u not in sample], deletes)
+        results["account_delete"] = benchmark_account_deletes(doomed)
+        for u in doomed :
+            users.remove(u)
+        return results
+
+    def handle(self, *args, **options) :
+        if connection.vendor != "postgresql" :
+            raise CommandError("Partitioning needs Postgres.")
+        self.options = options
+        rng = random.Random(options["seed"])
+        # Never touch the real data. Build a test database like manage.py test does.
+        old_name = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options["keepdb"])
+        try :
+            with tempfile.TemporaryDirectory() as tile_dir, override_settings(HEATMAP_TILE_DIR=tile_dir) :
+                users = User.objects.bulk_create([User(username="partition-" + str(i)) for i in range(options["athletes"])])
+                StravaUser.objects.bulk_create([StravaUser(user=u, has_completed_initial_download=True) for u in users])
+                self.stderr.write("Inserting " + str(options["rows"]) + " activities")
+                start = time.perf_counter()
+                fill_activities(users, options["rows"])
+                report = {
+                    "started" : datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                    "database" : connection.vendor,
+                    "server_version" : connection.pg_version,
+                    "python" : platform.python_version(),
+                    "options" : {k : options[k] for k in ("rows", "athletes", "strategy", "partitions", "sample", "repeat", "deletes", "seed")},
+                    "fill_seconds" : round(time.perf_counter() - start, 1),
+                }
+                self.stderr.write("Benchmarking the plain table")
+                report["unpartitioned"] = self.measure(users, rng, options["deletes"])
+                self.stderr.write("Partitioning by " + options["strategy"])
+                start = time.perf_counter()
+                partition_activities(options["strategy"], partitions=options["partitions"])
+                with connection.cursor() as cursor :
+                    cursor.execute("ANALYZE " + connection.ops.quote_name(StravaActivity._meta.db_table))
+                report["partition_seconds"] = round(time.perf_counter() - start, 1)
+                self.stderr.write("Benchmarking the partitioned table")
+                report[options["strategy"]] = self.measure(users, rng, options["deletes"])
+        finally :
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options["keepdb"])
+        out = sys.stdout if options["output"] == "-" else open(options["output"], "w")
+        try :
+            json.dump(report, out, indent=2)
+            out.write("\n")
+        finally :
+            if out is not sys.stdout :
+                out.close()
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from strava_info.strava_helpers import filter_strava_activities
+from strava_info.export_helpers import stream_activities_csv, stream_activities_parquet, parquet_available
+import datetime
+import sys
+
+
+class Command(BaseCommand) :
+    help = "Export a user's Strava activities as CSV or Parquet without holding them all in memory."
+
+    def add_arguments(self, parser) :
+        parser.add_argument("username", help="the NerdDat user whose activities to export")
+        parser.add_argument("outfile", help="file to write, or - for stdout")
+        parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+        parser.add_argument("--type", action="append", dest="activity_type", help="only this activity type (can be repeated)")
+        parser.add_argument("--title", help="only activities whose title contains this")
+        parser.add_argument("--start-date", type=datetime.date.fromisoformat, help="only activities on or after this YYYY-MM-DD date")
+        parser.add_argument("--end-date", type=datetime.date.fromisoformat, help="only activities on or before this YYYY-MM-DD date")
+        parser.add_argument("--chunk-size", type=int, default=None, help="rows fetched from the database at a time")
+
+    def handle(self, *args, **options) :
+        try :
+            user = User.objects.get(username=options["username"])
+        except User.DoesNotExist :
+            raise CommandError("No user named " + options["username"])
+        acts_qs = filter_strava_activities(user, activity_type=options["activity_type"], activity_title_key=options["title"],
+                                           start_date=options["start_date"], end_date=options["end_date"])
+        if options["format"] == "parquet" :
+            if not parquet_available() :
+                raise CommandError("Parquet exports need pyarrow. Install it or use --format csv.")
+            chunks = stream_activities_parquet(acts_qs, chunk_size=options["chunk_size"])
+        else :
+            chunks = (c.encode("utf-8") for c in stream_activities_csv(acts_qs, chunk_size=options["chunk_size"]))
+        out = sys.stdout.buffer if options["outfile"] == "-" else open(options["outfile"], "wb")
+        try :
+            for chunk in chunks :
+                out.write(chunk)
+        finally :
+            if out is not sys.stdout.buffer :
+                out.close()
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from strava_info.models import StravaUser
+from strava_info.bulk_import_helpers import import_strava_export
+from strava_info.page_cache_helpers import warm_pages_now
+import zipfile
+import time
+
+
+class Command(BaseCommand) :
+    help = "Import a user's history from a Strava bulk export archive without any Strava API calls."
+
+    def add_arguments(self, parser) :
+        parser.add_argument("username", help="the NerdDat user the history belongs to")
+        parser.add_argument("zip_path", help="path of the export_*.zip archive downloaded from Strava")
+        parser.add_argument("--workers", type=int, default=None, help="number of processes parsing activity files")
+        parser.add_argument("--batch-size", type=int, default=None, help="activities per bulk insert")
+
+    def handle(self, *args, **options) :
+        try :
+            user = User.objects.get(username=options["username"])
+        except User.DoesNotExist :
+            raise CommandError("No user named " + options["username"])
+        if not zipfile.is_zipfile(options["zip_path"]) :
+            raise CommandError(options["zip_path"] + " isn't a zip archive")
+        # The import marks the download as done, so make sure there's a StravaUser to mark.
+        StravaUser.objects.get_or_create(user=user)
+        start = time.perf_counter()
+        count = import_strava_export(user, options["zip_path"], workers=options["workers"], batch_size=options["batch_size"])
+        warm_pages_now([user])
+        self.stdout.write(self.style.SUCCESS("Imported " + str(count) + " activities in " +
+                                             str(round(time.perf_counter() - start, 1)) + " seconds"))
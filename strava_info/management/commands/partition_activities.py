@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from strava_info.partition_helpers import (PARTITION_STRATEGIES, get_partition_strategy, list_partitions,
+                                           partition_activities, add_year_partitions)
+import time
+
+
+class Command(BaseCommand) :
+    help = ("Partition the activities table (Postgres only) by hash on the athlete or by range on the start date, "
+            "add yearly partitions to a range partitioned table, or show how it's partitioned.")
+
+    def add_arguments(self, parser) :
+        parser.add_argument("--strategy", choices=PARTITION_STRATEGIES, help="partition the table this way")
+        parser.add_argument("--partitions", type=int, default=None, help="number of hash partitions")
+        parser.add_argument("--years-ahead", type=int, default=None, help="range partitions to make past this year")
+        parser.add_argument("--add-years-through", type=int, default=None, help="make range partitions for every year through this one")
+        parser.add_argument("--dry-run", action="store_true", help="print the SQL instead of running it")
+        parser.add_argument("--database", default="default", help="the database alias")
+
+    def handle(self, *args, **options) :
+        using = options["database"]
+        if connections[using].vendor != "postgresql" :
+            raise CommandError("Partitioning needs Postgres.")
+        try :
+            if options["strategy"] :
+                start = time.perf_counter()
+                statements = partition_activities(options["strategy"], partitions=options["partitions"],
+                                                  years_ahead=options["years_ahead"], using=using, dry_run=options["dry_run"])
+                if options["dry_run"] :
+                    self.stdout.write(";\n".join(statements) + ";")
+                    return
+                self.stdout.write(self.style.SUCCESS("Partitioned by " + options["strategy"] + " in " +
+                                                     str(round(time.perf_counter() - start, 1)) + " seconds"))
+            if options["add_years_through"] :
+                added = add_year_partitions(options["add_years_through"], using=using)
+                self.stdout.write(self.style.SUCCESS("Added partitions for " + (", ".join(map(str, added)) or "no years")))
+        except ValueError as e :
+            raise CommandError(str(e))
+        strategy = get_partition_strategy(using)
+        if not strategy :
+            self.stdout.write("The activities table isn't partitioned.")
+            return
+        self.stdout.write("Partitioned by " + strategy + ":")
+        for name, bounds, rows in list_partitions(using) :
+            self.stdout.write("  " + name + " " + bounds + " (~" + str(max(rows, 0)) + " rows)")
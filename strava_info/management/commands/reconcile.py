@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from strava_info.reconcile_helpers import reconcile_users
+from strava_info.page_cache_helpers import warm_pages_now
+import time
+
+
+class Command(BaseCommand) :
+    help = ("Compare users' activities with Strava a month at a time and repair the months that differ, to catch "
+            "missed webhooks. Meant to be run on a schedule; each run makes at most --max-calls Strava API calls.")
+
+    def add_arguments(self, parser) :
+        parser.add_argument("usernames", nargs="*", help="the users to reconcile (default everyone)")
+        parser.add_argument("--max-calls", type=int, default=None, help="Strava API calls for the whole run")
+        parser.add_argument("--calls-per-user", type=int, default=None, help="Strava API calls for each user")
+
+    def handle(self, *args, **options) :
+        users = None
+        if options["usernames"] :
+            users = User.objects.filter(username__in=options["usernames"])
+            missing = set(options["usernames"]) - set(users.values_list("username", flat=True))
+            if missing :
+                raise CommandError("No user named " + ", ".join(sorted(missing)))
+        start = time.perf_counter()
+        reports = reconcile_users(users, max_calls=options["max_calls"], calls_per_user=options["calls_per_user"])
+        for username, report in reports.items() :
+            self.stdout.write(username + ": " + ", ".join(k + " " + str(v) for k, v in report.items()))
+        warm_pages_now(User.objects.filter(username__in=[u for u, r in reports.items() if r["saved"] or r["deleted"]]))
+        self.stdout.write(self.style.SUCCESS("Reconciled " + str(len(reports)) + " users with " +
+                                             str(sum(r["api_calls"] for r in reports.values())) + " API calls in " +
+                                             str(round(time.perf_counter() - start, 1)) + " seconds"))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from strava_info.rederive_helpers import rederive_activities
+from strava_info.page_cache_helpers import warm_pages_now
+import time
+
+
+class Command(BaseCommand) :
+    help = ("Rebuild activities, their geohash cells, heatmaps, route clusters and pie colors from the "
+            "archived Strava JSON without any Strava API calls.")
+
+    def add_arguments(self, parser) :
+        parser.add_argument("usernames", nargs="*", help="the users to rebuild (default everyone)")
+        parser.add_argument("--workers", type=int, default=None, help="number of processes rebuilding activities")
+        parser.add_argument("--chunk-size", type=int, default=None, help="activities per chunk")
+
+    def handle(self, *args, **options) :
+        users = None
+        if options["usernames"] :
+            users = User.objects.filter(username__in=options["usernames"])
+            missing = set(options["usernames"]) - set(users.values_list("username", flat=True))
+            if missing :
+                raise CommandError("No user named " + ", ".join(sorted(missing)))
+        start = time.perf_counter()
+        counts = rederive_activities(users, workers=options["workers"], chunk_size=options["chunk_size"])
+        warm_pages_now(User.objects.filter(id__in=counts))
+        self.stdout.write(self.style.SUCCESS("Rebuilt " + str(sum(counts.values())) + " activities for " + str(len(counts)) +
+                                             " users in " + str(round(time.perf_counter() - start, 1)) + " seconds"))
@@ -0,0 +1,360 @@
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.db.models import FilteredRelation, Q
+from django.contrib import auth
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.contrib.auth.models import User, AnonymousUser
+from django.utils.crypto import constant_time_compare
+from django.utils.functional import SimpleLazyObject
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from contextlib import contextmanager
+from contextvars import ContextVar
+from collections import deque
+from .routers import start_routing, end_routing
+import threading
+import time
+import json
+import logging
+
+logger = logging.getLogger("strava_info.metrics")
+
+# The metrics kept for every request.
+METRIC_NAMES = ["queries", "db_ms", "total_ms", "cpu_ms", "response_bytes"]
+
+
+class ViewMetrics :
+    """
+    Rolling window of per-request metrics for each view, kept in process.
+
+    Each worker process has its own so the stats page shows what the worker
+    that served it has seen.
+    """
+    def __init__(self, window) :
+        self.window = window
+        self.samples = {}
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    def record(self, view_name, sample) :
+        with self.lock :
+            self.samples.setdefault(view_name, deque(maxlen=self.window)).append(sample)
+            self.totals[view_name] = self.totals.get(view_name, 0) + 1
+
+    def summary(self) :
+        """
+        Return percentiles and a histogram of each metric for each view.
+
+        Returns:
+            dict: view name to {"requests", "window", metric: {"p50", "p90", "p99", "max", "histogram"}}
+        """
+        with self.lock :
+            snapshot = {v : list(s) for v, s in self.samples.items()}
+            totals = dict(self.totals)
+        result = {}
+        for view_name, samples in snapshot.items() :
+            view_stats = {"requests" : totals[view_name], "window" : len(samples)}
+            for m in METRIC_NAMES :
+                values = sorted(s[m] for s in samples if s[m] is not None)
+                if not values :
+                    continue
+                view_stats[m] = {
+                    "p50" : _percentile(values, 50),
+                    "p90" : _percentile(values, 90),
+                    "p99" : _percentile(values, 99),
+                    "max" : values[-1],
+                    "histogram" : _histogram(values),
+                }
+            result[view_name] = view_stats
+        return result
+
+
+def _percentile(sorted_values, p) :
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+
+def _histogram(sorted_values) :
+    """
+    Count values in power of two buckets. The key is the bucket's upper bound.
+    """
+    buckets = {}
+    for v in sorted_values :
+        bound = 1
+        while bound < v :
+            bound *= 2
+        buckets[bound] = buckets.get(bound, 0) + 1
+    return buckets
+
+
+view_metrics = ViewMetrics(settings.REQUEST_METRICS_WINDOW)
+
+
+# The query counts that queries run in the current context add to. This is a ContextVar
+# rather than a wrapper put on the current thread's connections, so the queries of work
+# handed to sync_to_async (which runs it on another thread, in a copy of the context)
+# are counted too.
+_query_counts = ContextVar("query_counts", default=())
+
+
+def _count_query(execute, sql, params, many, context) :
+    counts = [db for db in _query_counts.get() if db["counting"]]
+    if not counts :
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try :
+        return execute(sql, params, many, context)
+    finally :
+        seconds = time.perf_counter() - start
+        for db in counts :
+            db["queries"] += 1
+            db["seconds"] += seconds
+
+
+def _add_query_counter(sender, connection, **kwargs) :
+    if _count_query not in connection.execute_wrappers :
+        connection.execute_wrappers.append(_count_query)
+
+
+# Every connection, on whatever thread, runs its queries through _count_query.
+connection_created.connect(_add_query_counter)
+
+
+def start_counting_queries() :
+    """
+    Start counting the queries run in this context (and copies of it), and the time they take.
+
+    Returns:
+        (dict, Token): "queries" and "seconds", which keep counting until stop_counting_queries,
+            and the token to pass to it
+    """
+    # Connections opened before this module was imported don't have the counter yet.
+    for conn in connections.all() :
+        _add_query_counter(None, conn)
+    db = {"queries" : 0, "seconds" : 0.0, "counting" : True}
+    return db, _query_counts.set(_query_counts.get() + (db,))
+
+
+def stop_counting_queries(db, token) :
+    """
+    Stop counting queries. Can be called from a copy of the context the count was started in.
+
+    Args:
+        db (dict): the counts from start_counting_queries
+        token (Token): the token from start_counting_queries
+    """
+    db["counting"] = False
+    try :
+        _query_counts.reset(token)
+    except ValueError :
+        # We're in a copy of the context (say ASGI closing a response on a thread),
+        # which can't take the counts out of the original. They've stopped anyway.
+        pass
+
+
+@contextmanager
+def count_queries() :
+    """
+    Count the queries run on every database connection, and the time they take, inside a with block.
+
+    Yields:
+        dict: "queries" and "seconds", which keep counting until the block ends
+    """
+    db, token = start_counting_queries()
+    try :
+        yield db
+    finally :
+        stop_counting_queries(db, token)
+
+
+class RequestMetricsMiddleware :
+    """
+    Record, for every request, the number of queries, time spent in the database, total
+    time, CPU time and response size, keyed on the name of the view that handled it.
+
+    Each request is logged as a JSON line and added to view_metrics. Requests that make
+    more queries than their view's budget (VIEW_QUERY_BUDGETS, falling back on
+    DEFAULT_VIEW_QUERY_BUDGET) are logged as warnings. Streamed responses (like exports)
+    are recorded when they're closed, so the queries that feed them are counted.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response) :
+        self.get_response = get_response
+        # Stay async under ASGI so async views (like the webhook) don't get pushed onto a thread.
+        if iscoroutinefunction(get_response) :
+            markcoroutinefunction(self)
+
+    def __call__(self, request) :
+        if iscoroutinefunction(self) :
+            return self.__acall__(request)
+        start = time.perf_counter()
+        cpu_start = time.thread_time()
+        db, token = start_counting_queries()
+        try :
+            response = self.get_response(request)
+        except BaseException :
+            stop_counting_queries(db, token)
+            raise
+        return self.finish(request, response, db, token, start, cpu_start)
+
+    async def __acall__(self, request) :
+        start = time.perf_counter()
+        cpu_start = time.thread_time()
+        db, token = start_counting_queries()
+        try :
+            response = await self.get_response(request)
+        except BaseException :
+            stop_counting_queries(db, token)
+            raise
+        return self.finish(request, response, db, token, start, cpu_start)
+
+    def finish(self, request, response, db, token, start, cpu_start) :
+        """
+        Stop counting and record the request, or for a streamed response, do it once the
+        response has been sent and closed, since its queries run as it's sent.
+        """
+        thread = threading.get_ident()
+
+        def done() :
+            stop_counting_queries(db, token)
+            # Under ASGI the response is closed on another thread, whose CPU time isn't ours.
+            self.record(request, response, db, start, cpu_start if threading.get_ident() == thread else None)
+
+        if response.streaming :
+            # Django calls these when the server closes the response.
+            response._resource_closers.append(done)
+        else :
+            done()
+        return response
+
+    def record(self, request, response, db, start, cpu_start) :
+        """
+        Log a finished request's metrics and add them to view_metrics.
+        """
+        sample = {
+            "queries" : db["queries"],
+            "db_ms" : round(db["seconds"] * 1000, 2),
+            "total_ms" : round((time.perf_counter() - start) * 1000, 2),
+            "cpu_ms" : round((time.thread_time() - cpu_start) * 1000, 2) if cpu_start is not None else None,
+            # We can't know how big a streamed response is without consuming it.
+            "response_bytes" : None if response.streaming else len(response.content),
+        }
+        match = getattr(request, "resolver_match", None)
+        view_name = match.view_name if match else "unresolved"
+        view_metrics.record(view_name, sample)
+        logger.info(json.dumps(dict(sample, view=view_name, method=request.method, status=response.status_code)))
+        budget = settings.VIEW_QUERY_BUDGETS.get(view_name, settings.DEFAULT_VIEW_QUERY_BUDGET)
+        if sample["queries"] > budget :
+            logger.warning(json.dumps({"event" : "query_budget_exceeded", "view" : view_name, "path" : request.path,
+                                       "queries" : sample["queries"], "budget" : budget}))
+
+
+# Set on a response after a write, so the client's reads stay on the primary
+# until the replica has caught up.
+STICKY_PRIMARY_COOKIE = "use_primary"
+
+
+class ReplicaRoutingMiddleware :
+    """
+    Let the views in REPLICA_READ_VIEWS read from the replica (see routers.ReplicaRouter).
+
+    A request that writes, or any POST etc., sets a cookie that keeps that client's
+    reads on the primary for REPLICA_STICKY_SECONDS, so e.g. the charts right after
+    a download or a units switch show the new data.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response) :
+        self.get_response = get_response
+        if iscoroutinefunction(get_response) :
+            markcoroutinefunction(self)
+
+    def __call__(self, request) :
+        if iscoroutinefunction(self) :
+            return self.__acall__(request)
+        request.db_routing, token = start_routing()
+        try :
+            response = self.get_response(request)
+        finally :
+            end_routing(token)
+        return self.stick(request, response)
+
+    async def __acall__(self, request) :
+        request.db_routing, token = start_routing()
+        try :
+            response = await self.get_response(request)
+        finally :
+            end_routing(token)
+        return self.stick(request, response)
+
+    def process_view(self, request, view_func, view_args, view_kwargs) :
+        request.db_routing["use_replica"] = (request.resolver_match.view_name in settings.REPLICA_READ_VIEWS
+                                             and STICKY_PRIMARY_COOKIE not in request.COOKIES)
+
+    def stick(self, request, response) :
+        if request.db_routing["wrote"] or request.method not in ("GET", "HEAD", "OPTIONS") :
+            response.set_cookie(STICKY_PRIMARY_COOKIE, "1", max_age=settings.REPLICA_STICKY_SECONDS,
+                                httponly=True, samesite="Lax")
+        return response
+
+
+def load_user_profile(user_id) :
+    """
+    Load a user with their StravaUser and Strava login (as user.strava_auth, None if they
+    haven't connected) in one query.
+
+    Args:
+        user_id (int): the user's id
+
+    Returns:
+        User: the user, or None if there's no such user
+    """
+    user = (User.objects.annotate(strava_auth=FilteredRelation("social_auth", condition=Q(social_auth__provider="strava")))
+            .select_related("stravauser", "strava_auth").filter(pk=user_id).first())
+    # select_related leaves the filtered relation unset when there's no Strava login.
+    if user is not None and not hasattr(user, "strava_auth") :
+        user.strava_auth = None
+    return user
+
+
+def get_user_profile(request) :
+    """
+    Return the logged in user with their profile loaded by load_user_profile.
+
+    Like django.contrib.auth.get_user, the session has to name one of our authentication
+    backends and its password hash has to still match, or the user is logged out.
+
+    Args:
+        request (HttpRequest): the request, with its session loaded
+
+    Returns:
+        User: the user, or an AnonymousUser
+    """
+    try :
+        user_id = User._meta.pk.to_python(request.session[auth.SESSION_KEY])
+        backend_path = request.session[auth.BACKEND_SESSION_KEY]
+    except KeyError :
+        return AnonymousUser()
+    if backend_path not in settings.AUTHENTICATION_BACKENDS :
+        return AnonymousUser()
+    user = load_user_profile(user_id)
+    backend = auth.load_backend(backend_path)
+    if user is None or (hasattr(backend, "user_can_authenticate") and not backend.user_can_authenticate(user)) :
+        return AnonymousUser()
+    session_hash = request.session.get(auth.HASH_SESSION_KEY)
+    if not (session_hash and constant_time_compare(session_hash, user.get_session_auth_hash())) :
+        request.session.flush()
+        return AnonymousUser()
+    return user
+
+
+class UserProfileMiddleware(AuthenticationMiddleware) :
+    """
+    Authentication middleware whose request.user comes with the profile every view needs
+    (see get_user_profile), so views don't each look up the StravaUser and Strava login.
+    """
+    def process_request(self, request) :
+        super().process_request(request)
+        request.user = SimpleLazyObject(lambda : get_user_profile(request))
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.5 on 2026-10-19 11:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('strava_info', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stravaactivity',
+            name='summary_polyline',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
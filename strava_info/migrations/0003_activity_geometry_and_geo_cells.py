@@ -0,0 +1,81 @@
+# Generated by Django 4.1.5 on 2026-10-19 11:04
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('strava_info', '0002_stravaactivity_summary_polyline'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ActivityGeoCell',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cell', models.CharField(max_length=12)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='stravaactivity',
+            name='end_lat',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='stravaactivity',
+            name='end_lng',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='stravaactivity',
+            name='max_lat',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='stravaactivity',
+            name='max_lng',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='stravaactivity',
+            name='min_lat',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='stravaactivity',
+            name='min_lng',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='stravaactivity',
+            name='start_lat',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='stravaactivity',
+            name='start_lng',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='stravaactivity',
+            index=models.Index(fields=['site_user', 'min_lat', 'max_lat'], name='strava_info_site_us_281d09_idx'),
+        ),
+        migrations.AddField(
+            model_name='activitygeocell',
+            name='activity',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='geo_cells', to='strava_info.stravaactivity'),
+        ),
+        migrations.AddField(
+            model_name='activitygeocell',
+            name='site_user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='activitygeocell',
+            index=models.Index(fields=['site_user', 'cell'], name='strava_info_site_us_f089bb_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.1.5 on 2026-10-19 11:05
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('strava_info', '0003_activity_geometry_and_geo_cells'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RouteCluster',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sport_type', models.CharField(max_length=100)),
+                ('name', models.CharField(max_length=500)),
+                ('start_cell', models.CharField(max_length=12)),
+                ('end_cell', models.CharField(max_length=12)),
+                ('fingerprint', models.JSONField(default=list)),
+                ('distance_meters', models.FloatField()),
+                ('activity_count', models.PositiveIntegerField(default=0)),
+                ('site_user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='stravaactivity',
+            name='route_cluster',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='activities', to='strava_info.routecluster'),
+        ),
+        migrations.AddIndex(
+            model_name='routecluster',
+            index=models.Index(fields=['site_user', 'sport_type', 'start_cell', 'end_cell'], name='strava_info_site_us_7eaa0b_idx'),
+        ),
+    ]
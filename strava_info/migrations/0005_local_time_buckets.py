@@ -0,0 +1,92 @@
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Min, Max
+from django.db.models.functions import TruncDate, ExtractYear, ExtractMonth, ExtractWeek
+import datetime
+
+BACKFILL_CHUNK_SIZE = 5000
+
+
+def backfill_local_buckets(apps, schema_editor) :
+    # Strava's start_date_local is the local time stored as though it were UTC, so the
+    # buckets are its UTC date parts. Go a range of ids at a time to keep each update short.
+    StravaActivity = apps.get_model("strava_info", "StravaActivity")
+    acts = StravaActivity.objects.using(schema_editor.connection.alias)
+    utc = datetime.timezone.utc
+    bounds = acts.aggregate(lo=Min("id"), hi=Max("id"))
+    if bounds["lo"] is None :
+        return
+    for start in range(bounds["lo"], bounds["hi"] + 1, BACKFILL_CHUNK_SIZE) :
+        acts.filter(id__gte=start, id__lt=start + BACKFILL_CHUNK_SIZE).update(
+            local_date=TruncDate("start_date_local", tzinfo=utc),
+            local_year=ExtractYear("start_date_local", tzinfo=utc),
+            local_month=ExtractMonth("start_date_local", tzinfo=utc),
+            local_iso_week=ExtractWeek("start_date_local", tzinfo=utc),
+        )
+
+
+class Migration(migrations.Migration):
+
+    # Commit each backfill chunk on its own rather than holding every row locked until the end.
+    atomic = False
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('strava_info', '0004_route_clusters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stravaactivity',
+            name='local_date',
+            field=models.DateField(null=True),
+        ),
+        migrations.AddField(
+            model_name='stravaactivity',
+            name='local_year',
+            field=models.PositiveSmallIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='stravaactivity',
+            name='local_month',
+            field=models.PositiveSmallIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='stravaactivity',
+            name='local_iso_week',
+            field=models.PositiveSmallIntegerField(null=True),
+        ),
+        migrations.RunPython(backfill_local_buckets, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='stravaactivity',
+            name='local_date',
+            field=models.DateField(),
+        ),
+        migrations.AlterField(
+            model_name='stravaactivity',
+            name='local_year',
+            field=models.PositiveSmallIntegerField(),
+        ),
+        migrations.AlterField(
+            model_name='stravaactivity',
+            name='local_month',
+            field=models.PositiveSmallIntegerField(),
+        ),
+        migrations.AlterField(
+            model_name='stravaactivity',
+            name='local_iso_week',
+            field=models.PositiveSmallIntegerField(),
+        ),
+        migrations.AddIndex(
+            model_name='stravaactivity',
+            index=models.Index(fields=['site_user', 'sport_type', 'local_year', 'local_month'], include=('distance_miles', 'distance_km', 'moving_time_sec', 'elev_gain_ft', 'total_elevation_gain_m'), name='activity_sport_month_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='stravaactivity',
+            index=models.Index(fields=['site_user', 'local_year', 'sport_type'], include=('moving_time_sec',), name='activity_year_sport_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='stravaactivity',
+            index=models.Index(fields=['site_user', 'local_date'], name='activity_local_date_idx'),
+        ),
+    ]
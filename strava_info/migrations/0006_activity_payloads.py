@@ -0,0 +1,27 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('strava_info', '0005_local_time_buckets'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ActivityPayload',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('activity_id', models.PositiveBigIntegerField()),
+                ('payload', models.BinaryField()),
+                ('site_user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='activitypayload',
+            constraint=models.UniqueConstraint(fields=('site_user', 'activity_id'), name='activity_payload_unique'),
+        ),
+    ]
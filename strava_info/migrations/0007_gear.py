@@ -0,0 +1,41 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('strava_info', '0006_activity_payloads'),
+    ]
+
+    # Activities saved before this have no gear_id, and nothing we've stored has it to fill
+    # in (the payload archive starts out empty). The reconcile command picks them up: their
+    # gear no longer matches what Strava lists, so it saves them again, gear totals and all.
+    # Every user is first in line for it after 0009, and its runs work through their whole history.
+    operations = [
+        migrations.AddField(
+            model_name='stravaactivity',
+            name='gear_id',
+            field=models.CharField(blank=True, default='', max_length=50),
+        ),
+        migrations.CreateModel(
+            name='Gear',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('gear_id', models.CharField(max_length=50)),
+                ('name', models.CharField(blank=True, default='', max_length=200)),
+                ('distance_meters', models.FloatField(default=0.0)),
+                ('moving_time_sec', models.PositiveBigIntegerField(default=0)),
+                ('activity_count', models.PositiveIntegerField(default=0)),
+                ('service_interval_m', models.FloatField(blank=True, null=True)),
+                ('serviced_at_m', models.FloatField(default=0.0)),
+                ('site_user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='gear',
+            constraint=models.UniqueConstraint(fields=('site_user', 'gear_id'), name='gear_unique'),
+        ),
+    ]
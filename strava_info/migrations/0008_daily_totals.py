@@ -0,0 +1,52 @@
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Sum, Count
+import django.db.models.deletion
+
+BACKFILL_BATCH_SIZE = 5000
+
+
+def backfill_daily_totals(apps, schema_editor) :
+    # Add up every user's days once. From here on they're kept up to date as activities
+    # are saved and deleted.
+    StravaActivity = apps.get_model("strava_info", "StravaActivity")
+    DailyTotal = apps.get_model("strava_info", "DailyTotal")
+    alias = schema_editor.connection.alias
+    totals = (StravaActivity.objects.using(alias).values("site_user_id", "local_date", "sport_type").order_by()
+              .annotate(distance=Sum("distance_meters"), moving=Sum("moving_time_sec"), count=Count("id")))
+    batch = []
+    for t in totals.iterator(chunk_size=BACKFILL_BATCH_SIZE) :
+        batch.append(DailyTotal(site_user_id=t["site_user_id"], local_date=t["local_date"], sport_type=t["sport_type"],
+                                distance_meters=t["distance"], moving_time_sec=t["moving"], activity_count=t["count"]))
+        if len(batch) >= BACKFILL_BATCH_SIZE :
+            DailyTotal.objects.using(alias).bulk_create(batch)
+            batch = []
+    DailyTotal.objects.using(alias).bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('strava_info', '0007_gear'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyTotal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('local_date', models.DateField()),
+                ('sport_type', models.CharField(max_length=100)),
+                ('distance_meters', models.FloatField(default=0.0)),
+                ('moving_time_sec', models.PositiveBigIntegerField(default=0)),
+                ('activity_count', models.PositiveIntegerField(default=0)),
+                ('site_user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='dailytotal',
+            constraint=models.UniqueConstraint(fields=('site_user', 'local_date', 'sport_type'), name='daily_total_unique'),
+        ),
+        migrations.RunPython(backfill_daily_totals, migrations.RunPython.noop),
+    ]
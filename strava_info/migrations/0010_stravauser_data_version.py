@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('strava_info', '0009_stravauser_reconcile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stravauser',
+            name='data_version',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
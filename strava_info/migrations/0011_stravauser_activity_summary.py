@@ -0,0 +1,33 @@
+from django.db import migrations, models
+
+
+def fill_activity_summaries(apps, schema_editor) :
+    StravaUser = apps.get_model("strava_info", "StravaUser")
+    StravaActivity = apps.get_model("strava_info", "StravaActivity")
+    for su in StravaUser.objects.all().iterator() :
+        acts = StravaActivity.objects.filter(site_user_id=su.user_id)
+        su.activity_types = sorted(set(acts.values_list("sport_type", flat=True)))
+        su.recent_activities = [{"activity_id" : a, "name" : n, "start_date_local" : d.isoformat()}
+                                for a, n, d in acts.order_by("-start_date").values_list("activity_id", "name", "start_date_local")[:5]]
+        su.save(update_fields=["activity_types", "recent_activities"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('strava_info', '0010_stravauser_data_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stravauser',
+            name='activity_types',
+            field=models.JSONField(default=list),
+        ),
+        migrations.AddField(
+            model_name='stravauser',
+            name='recent_activities',
+            field=models.JSONField(default=list),
+        ),
+        migrations.RunPython(fill_activity_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-19 13:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('strava_info', '0011_stravauser_activity_summary'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='stravaactivity',
+            index=models.Index(fields=['site_user', 'start_date'], name='activity_start_date_idx'),
+        ),
+    ]
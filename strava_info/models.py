@@ -13,7 +13,26 @@ class StravaUser(models.Model):
     has_completed_initial_download = models.BooleanField(default=False)
     preferred_units = models.CharField(max_length=10, default="imperial")
     pie_color_palette = models.JSONField(default=dict)
-    
+    # Where the reconcile command got to in the user's history and when it last ran for them.
+    reconcile_cursor = models.DateField(null=True, blank=True)
+    reconciled_at = models.DateTimeField(null=True, blank=True)
+    # Goes up by one whenever the user's activities change. Cached pages are keyed on it.
+    data_version = models.PositiveBigIntegerField(default=0)
+    # The sport types the user has any activities of (sorted) and their five most recent
+    # activities, so pages can show them without querying the activities.
+    activity_types = models.JSONField(default=list)
+    recent_activities = models.JSONField(default=list)
+
+    # Columns kept up to date with queryset updates as activities are saved. A StravaUser
+    # loaded earlier may have stale copies, so saving the whole row leaves them alone.
+    DERIVED_FIELDS = {"data_version", "activity_types", "recent_activities"}
+
+    def save(self, *args, **kwargs) :
+        if not self._state.adding and kwargs.get("update_fields") is None :
+            kwargs["update_fields"] = [f.name for f in self._meta.concrete_fields
+                                       if not f.primary_key and f.name not in self.DERIVED_FIELDS]
+        super().save(*args, **kwargs)
+
 class StravaActivity(models.Model) :
     site_user = models.ForeignKey(User, on_delete=models.CASCADE, default=None)
     activity_id = models.PositiveBigIntegerField()
@@ -59,8 +78,124 @@ class StravaActivity(models.Model) :
     max_speed_mph = models.FloatField()
     max_speed_kph = models.FloatField()
     average_temp = models.FloatField()
+    summary_polyline = models.TextField(default="", blank=True)
+    start_lat = models.FloatField(null=True, blank=True)
+    start_lng = models.FloatField(null=True, blank=True)
+    end_lat = models.FloatField(null=True, blank=True)
+    end_lng = models.FloatField(null=True, blank=True)
+    # Bounding box of the route. Used when a search area is too big for the geohash cells.
+    min_lat = models.FloatField(null=True, blank=True)
+    max_lat = models.FloatField(null=True, blank=True)
+    min_lng = models.FloatField(null=True, blank=True)
+    max_lng = models.FloatField(null=True, blank=True)
+    # Strava's id for the bike or shoes used, or "" if there weren't any.
+    gear_id = models.CharField(max_length=50, default="", blank=True)
+    route_cluster = models.ForeignKey("RouteCluster", on_delete=models.SET_NULL, null=True, blank=True, related_name="activities")
+    # The athlete's local day the activity started on, and the buckets the charts group by.
+    # Stored so the chart queries can use an index instead of extracting them from start_date.
+    local_date = models.DateField()
+    local_year = models.PositiveSmallIntegerField()
+    local_month = models.PositiveSmallIntegerField()
+    local_iso_week = models.PositiveSmallIntegerField()
+    
+    class Meta :
+        indexes = [
+            models.Index(fields=["site_user", "min_lat", "max_lat"]),
+            # The per sport charts and stats. The summed columns are included so Postgres
+            # can answer them from the index alone.
+            models.Index(fields=["site_user", "sport_type", "local_year", "local_month"], name="activity_sport_month_idx",
+                         include=["distance_miles", "distance_km", "moving_time_sec", "elev_gain_ft", "total_elevation_gain_m"]),
+            # The pie charts, which split each year by sport.
+            models.Index(fields=["site_user", "local_year", "sport_type"], name="activity_year_sport_idx",
+                         include=["moving_time_sec"]),
+            models.Index(fields=["site_user", "local_date"], name="activity_local_date_idx"),
+            # The recent activities kept on the StravaUser.
+            models.Index(fields=["site_user", "start_date"], name="activity_start_date_idx"),
+        ]
+    
+    
+class RouteCluster(models.Model) :
+    # A group of a user's activities that all followed (nearly) the same route.
+    site_user = models.ForeignKey(User, on_delete=models.CASCADE)
+    sport_type = models.CharField(max_length=100)
+    # Named after the first activity on the route.
+    name = models.CharField(max_length=500)
+    # Geohash cells of the route's start and end. Used to find candidate clusters for a new activity.
+    start_cell = models.CharField(max_length=12)
+    end_cell = models.CharField(max_length=12)
+    # The resampled route of the first activity as a list of [lat, lng] points.
+    fingerprint = models.JSONField(default=list)
+    distance_meters = models.FloatField()
+    activity_count = models.PositiveIntegerField(default=0)
+    
+    class Meta :
+        indexes = [
+            models.Index(fields=["site_user", "sport_type", "start_cell", "end_cell"]),
+        ]
+    
+
+class ActivityGeoCell(models.Model) :
+    # One row for every geohash cell an activity's route passes through.
+    site_user = models.ForeignKey(User, on_delete=models.CASCADE)
+    activity = models.ForeignKey(StravaActivity, on_delete=models.CASCADE, related_name="geo_cells")
+    cell = models.CharField(max_length=12)
     
+    class Meta :
+        indexes = [
+            models.Index(fields=["site_user", "cell"]),
+        ]
     
+
+class Gear(models.Model) :
+    # A bike or pair of shoes. The totals are kept up to date as activities come and go,
+    # so showing them never means adding up the user's whole history.
+    site_user = models.ForeignKey(User, on_delete=models.CASCADE)
+    gear_id = models.CharField(max_length=50)
+    # Fetched from Strava the first time we see the gear.
+    name = models.CharField(max_length=200, default="", blank=True)
+    distance_meters = models.FloatField(default=0.0)
+    moving_time_sec = models.PositiveBigIntegerField(default=0)
+    activity_count = models.PositiveIntegerField(default=0)
+    # Set by the user. The gear is due for service every service_interval_m meters,
+    # counting from distance_meters when it was last serviced.
+    service_interval_m = models.FloatField(null=True, blank=True)
+    serviced_at_m = models.FloatField(default=0.0)
+    
+    class Meta :
+        constraints = [
+            models.UniqueConstraint(fields=["site_user", "gear_id"], name="gear_unique"),
+        ]
+    
+
+class DailyTotal(models.Model) :
+    # A user's totals for one sport type on one local day, kept up to date as activities
+    # come and go. The calendar reads these instead of the activities.
+    site_user = models.ForeignKey(User, on_delete=models.CASCADE)
+    local_date = models.DateField()
+    sport_type = models.CharField(max_length=100)
+    distance_meters = models.FloatField(default=0.0)
+    moving_time_sec = models.PositiveBigIntegerField(default=0)
+    activity_count = models.PositiveIntegerField(default=0)
+    
+    class Meta :
+        constraints = [
+            models.UniqueConstraint(fields=["site_user", "local_date", "sport_type"], name="daily_total_unique"),
+        ]
+    
+
+class ActivityPayload(models.Model) :
+    # The activity exactly as Strava (or an export) gave it to us, as zlib compressed JSON.
+    # Lets us fill in new fields without downloading everything again.
+    site_user = models.ForeignKey(User, on_delete=models.CASCADE)
+    activity_id = models.PositiveBigIntegerField()
+    payload = models.BinaryField()
+    
+    class Meta :
+        constraints = [
+            models.UniqueConstraint(fields=["site_user", "activity_id"], name="activity_payload_unique"),
+        ]
+    
+
 class WebhookSubscription(models.Model) :
     service = models.CharField(max_length=100)
     sub_id = models.PositiveIntegerField(default=0)
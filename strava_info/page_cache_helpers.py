@@ -0,0 +1,202 @@
+from .models import StravaUser
+from .cache_helpers import shared_cache_configured
+from django.conf import settings
+from django.contrib import messages
+from django.core.cache import cache
+from django.db import connections
+from django.db.models import F
+from django.contrib.messages.storage import default_storage
+from django.http import HttpResponse
+from django.test import RequestFactory
+from django.urls import reverse, resolve
+import functools
+import hashlib
+import importlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Cached pages are keyed on the user's data version (StravaUser.data_version), which
+# moves on whenever their activities change (bump_data_version, or
+# strava_helpers.refresh_activity_summary as activities are saved). Every process sees the new
+# version in the profile it loads for the request, so a page cached by any of them goes
+# stale at once and the old entries just age out.
+_PAGE_KEY = "strava_page:"
+_WARMING_KEY = "strava_page_warming:"
+
+# The charts the warm-up renders for each activity type.
+WARM_CHART_METRICS = ["distance", "moving_time", "elevation_gain"]
+WARM_CHART_TIME_SPANS = ["monthly", "annual"]
+
+
+def bump_data_version(user) :
+    """
+    Mark a user's activity data as changed, so cached pages built from it aren't used.
+
+    Args:
+        user (User): the user whose activities were saved or deleted
+    """
+    StravaUser.objects.filter(user=user).update(data_version=F("data_version") + 1)
+
+
+def page_cache_key(request, view_name, args, kwargs) :
+    """
+    Return the cache key for a page as a particular user sees it.
+
+    Besides the user and the view's arguments, the key covers everything the page's
+    templates read from the user: their data version, units and download state. All of
+    it comes from the profile the request already loaded, so making the key costs no queries.
+
+    Args:
+        request (HttpRequest): the request for the page
+        view_name (str): the name of the view
+        args (tuple): the view's positional arguments
+        kwargs (dict): the view's keyword arguments
+
+    Returns:
+        str: the key, or None if the page shouldn't be cached for this request
+    """
+    user = request.user
+    # The superuser's home page shows the webhook subscription, which isn't versioned.
+    if request.method != "GET" or not user.is_authenticated or user.is_superuser :
+        return None
+    su = getattr(user, "stravauser", None)
+    if su is None :
+        return None
+    parts = [view_name, user.id, user.username, user.first_name, su.pk, su.data_version, getattr(user, "strava_auth", None) is not None,
+             su.is_strava_verified, su.downloading, su.has_completed_initial_download, su.preferred_units, args, sorted(kwargs.items()),
+             sorted(request.GET.lists())]
+    return _PAGE_KEY + hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def cache_page_per_user(view) :
+    """
+    Cache the pages a view renders for each user until their activity data changes.
+
+    A warm request is answered straight from the cache, without touching the ORM or the
+    template engine. Pages are rendered fresh, and not cached, while the user has flash
+    messages waiting, since the base template shows them.
+
+    Args:
+        view (function): the view
+
+    Returns:
+        function: the view with caching
+    """
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs) :
+        key = page_cache_key(request, view.__name__, args, kwargs)
+        if key is None or len(messages.get_messages(request)) :
+            return view(request, *args, **kwargs)
+        cached = cache.get(key)
+        if cached is not None :
+            content, content_type = cached
+            return HttpResponse(content, content_type=content_type)
+        response = view(request, *args, **kwargs)
+        if getattr(response, "status_code", None) == 200 and not response.streaming :
+            cache.set(key, (response.content, response["Content-Type"]), settings.PAGE_CACHE_TIMEOUT)
+        return response
+    return wrapper
+
+
+def queue_page_warming(user) :
+    """
+    Render a user's heaviest pages in the background after new activities come in, so
+    their next visit finds them cached.
+
+    The warm-up runs PAGE_WARM_DELAY seconds later and only one is queued per user until
+    it starts, so a burst of webhook events leads to a single warm-up that sees all of
+    them. Both the queued marker and the pages have to be visible to every worker for this
+    to help, so nothing is queued unless the cache is shared.
+
+    This is for the web processes. A management command would exit before the warm-up
+    ran, so commands call warm_pages_now when they're done instead.
+
+    Args:
+        user (User): the user whose activities changed
+
+    Returns:
+        bool: True if a warm-up was queued, False if one already was or the cache isn't shared
+    """
+    if not shared_cache_configured() :
+        return False
+    # The marker outlives the delay in case the warm-up never starts, e.g. the process exits.
+    if not cache.add(_WARMING_KEY + str(user.id), True, settings.PAGE_WARM_DELAY * 2) :
+        return False
+    t = threading.Timer(settings.PAGE_WARM_DELAY, warm_user_pages, args=[user.id])
+    t.daemon = True
+    t.start()
+    return True
+
+
+def warm_pages_now(users) :
+    """
+    Warm users' pages right away, e.g. at the end of a management command that changed
+    their activities. Does nothing unless the cache is shared, since this process's own
+    cache goes away with it.
+
+    Args:
+        users (iterable): the users
+    """
+    if not shared_cache_configured() :
+        return
+    for user in users :
+        warm_user_pages(user.id)
+
+
+def _warm_request(user, path) :
+    """
+    Build a GET request for a page as the user's browser would send it, with the session
+    and message storage the middleware would have attached.
+    """
+    request = RequestFactory().get(path)
+    request.session = importlib.import_module(settings.SESSION_ENGINE).SessionStore()
+    request.user = user
+    request._messages = default_storage(request)
+    return request
+
+
+def warm_user_pages(user_id) :
+    """
+    Render and cache a user's home page, activity type summaries, monthly and annual
+    charts and pie charts, as they would see them.
+
+    Each page is rendered by resolving its URL and calling its view, so it's cached under
+    exactly the key the user's own request will look for.
+
+    Args:
+        user_id (int): the user's id
+
+    Returns:
+        int: the number of pages rendered
+    """
+    # These import this module.
+    from .middleware import load_user_profile
+    from .strava_helpers import get_strava_activity_type_list
+    from .models import StravaActivity
+
+    # Anything that comes in from now on needs another warm-up.
+    cache.delete(_WARMING_KEY + str(user_id))
+    rendered = 0
+    try :
+        user = load_user_profile(user_id)
+        su = getattr(user, "stravauser", None)
+        if su is None or not su.has_completed_initial_download :
+            return rendered
+        years = StravaActivity.objects.filter(site_user=user).values_list("local_year", flat=True).distinct()
+        pages = [reverse("index"), reverse("strava_info:pie_chart_data")]
+        pages += [reverse("strava_info:annual_pie_chart_data", args=[y]) for y in years]
+        for t in get_strava_activity_type_list(user) :
+            pages.append(reverse("strava_info:analyze_activity_type", args=[t]))
+            pages += [reverse("strava_info:charts_data", args=[t, m, s]) for m in WARM_CHART_METRICS for s in WARM_CHART_TIME_SPANS]
+        for path in pages :
+            match = resolve(path)
+            try :
+                match.func(_warm_request(user, path), *match.args, **match.kwargs)
+                rendered += 1
+            except Exception :
+                logger.exception("Couldn't warm " + path + " for user " + str(user_id))
+    finally :
+        connections.close_all()
+    return rendered
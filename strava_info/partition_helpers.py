@@ -0,0 +1,239 @@
+from .models import StravaActivity
+from django.conf import settings
+from django.db import connections, transaction
+import datetime
+import logging
+
+logger = logging.getLogger(__name__)
+
+# hash spreads athletes over a fixed number of partitions, so every per user query and
+# delete only touches one of them. range puts each year of activities in its own partition.
+PARTITION_STRATEGIES = ("hash", "range")
+
+
+def _table() :
+    return StravaActivity._meta.db_table
+
+
+def _quote(conn, name) :
+    return conn.ops.quote_name(name)
+
+
+def get_partition_strategy(using="default") :
+    """
+    Return how the StravaActivity table is partitioned.
+
+    Args:
+        using (str, optional): the database alias. Defaults to "default".
+
+    Returns:
+        str: "hash" or "range", or None if the table isn't partitioned (or this isn't Postgres)
+    """
+    conn = connections[using]
+    if conn.vendor != "postgresql" :
+        return None
+    with conn.cursor() as cursor :
+        cursor.execute("SELECT p.partstrat FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid "
+                       "WHERE c.relname = %s AND pg_table_is_visible(c.oid)", [_table()])
+        row = cursor.fetchone()
+    return {"h" : "hash", "r" : "range"}.get(row[0]) if row else None
+
+
+def list_partitions(using="default") :
+    """
+    Return the partitions of the StravaActivity table and roughly how many rows each holds.
+
+    Args:
+        using (str, optional): the database alias. Defaults to "default".
+
+    Returns:
+        list: (partition name, bounds, estimated rows) tuples
+    """
+    with connections[using].cursor() as cursor :
+        cursor.execute("SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), c.reltuples::bigint FROM pg_inherits i "
+                       "JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = %s::regclass ORDER BY c.relname", [_table()])
+        return cursor.fetchall()
+
+
+def _partition_key(strategy) :
+    return "site_user_id" if strategy == "hash" else "start_date"
+
+
+def _year_bounds(year) :
+    return "FOR VALUES FROM ('" + str(year) + "-01-01 00:00:00+00') TO ('" + str(year + 1) + "-01-01 00:00:00+00')"
+
+
+def _partition_statements(conn, strategy, partitions, years) :
+    """
+    Return the SQL that makes the partitioned table and its partitions, named after the
+    table with a _partitioned suffix until it replaces it.
+    """
+    table = _table()
+    new = table + "_partitioned"
+    q = lambda name : _quote(conn, name)
+    key = _partition_key(strategy)
+    statements = [
+        "CREATE TABLE " + q(new) + " (LIKE " + q(table) + " INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING IDENTITY INCLUDING STORAGE) "
+        "PARTITION BY " + strategy.upper() + " (" + key + ")",
+        # Postgres needs the partition key in the primary key. ids are still unique, they
+        # all come from the one sequence.
+        "ALTER TABLE " + q(new) + " ADD CONSTRAINT " + q(new + "_pkey") + " PRIMARY KEY (id, " + key + ")",
+    ]
+    if strategy == "hash" :
+        for i in range(partitions) :
+            statements.append("CREATE TABLE " + q(table + "_p" + str(i)) + " PARTITION OF " + q(new) +
+                              " FOR VALUES WITH (MODULUS " + str(partitions) + ", REMAINDER " + str(i) + ")")
+    else :
+        for year in years :
+            statements.append("CREATE TABLE " + q(table + "_y" + str(year)) + " PARTITION OF " + q(new) + " " + _year_bounds(year))
+        # Anything outside the years we made partitions for.
+        statements.append("CREATE TABLE " + q(table + "_default") + " PARTITION OF " + q(new) + " DEFAULT")
+    return statements
+
+
+def partition_activities(strategy, *, partitions=None, years_ahead=None, using="default", dry_run=False) :
+    """
+    Turn the StravaActivity table into a declaratively partitioned Postgres table.
+
+    The rows are copied into a new partitioned table that then takes the old one's
+    name, indexes and foreign keys, so the ORM doesn't know the difference. It all
+    happens in one transaction with the table locked, so run it in a quiet moment.
+
+    Postgres can only point a foreign key at a partitioned table through its whole
+    primary key, which includes the partition key. So foreign keys in other tables that
+    point at the activities (the geohash cells' one) are recreated on (their column,
+    partition key), which needs the other table to have a column of the same name. The
+    geohash cells have site_user_id but no start_date, so only hash partitioning keeps
+    their foreign key and range partitioning is refused.
+
+    Args:
+        strategy (str): "hash" on site_user_id or "range" on start_date by year
+        partitions (int, optional): how many hash partitions. Defaults to settings.ACTIVITY_HASH_PARTITIONS.
+        years_ahead (int, optional): range partitions to make past this year. Defaults to settings.ACTIVITY_PARTITION_YEARS_AHEAD.
+        using (str, optional): the database alias. Defaults to "default".
+        dry_run (bool, optional): only return the SQL, don't run it. Defaults to False.
+
+    Raises:
+        ValueError: if this isn't Postgres, the strategy is unknown, the table is already partitioned
+            or another table's foreign key to it couldn't be kept
+
+    Returns:
+        list: the SQL statements run (or that would be run)
+    """
+    conn = connections[using]
+    if conn.vendor != "postgresql" :
+        raise ValueError("Only Postgres tables can be partitioned.")
+    if strategy not in PARTITION_STRATEGIES :
+        raise ValueError("Unknown partitioning strategy " + str(strategy))
+    if get_partition_strategy(using) :
+        raise ValueError(_table() + " is already partitioned.")
+    partitions = partitions or settings.ACTIVITY_HASH_PARTITIONS
+    years_ahead = settings.ACTIVITY_PARTITION_YEARS_AHEAD if years_ahead is None else years_ahead
+    table = _table()
+    new = table + "_partitioned"
+    q = lambda name : _quote(conn, name)
+    key = _partition_key(strategy)
+    with transaction.atomic(using=using) :
+        with conn.cursor() as cursor :
+            if not dry_run :
+                # Check any deferred foreign keys now. Postgres won't drop a table with checks pending.
+                cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+                cursor.execute("LOCK TABLE " + q(table) + " IN ACCESS EXCLUSIVE MODE")
+            # Everything about the old table that LIKE doesn't copy.
+            cursor.execute("SELECT pg_get_indexdef(indexrelid) FROM pg_index WHERE indrelid = %s::regclass AND NOT indisprimary", [table])
+            index_defs = [r[0] for r in cursor.fetchall()]
+            cursor.execute("SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+                           "WHERE conrelid = %s::regclass AND contype = 'f'", [table])
+            foreign_keys = cursor.fetchall()
+            # Foreign keys in other tables that point at this one, and whether the other table has the partition key.
+            cursor.execute("SELECT r.relname, c.conname, a.attname, c.condeferrable, c.condeferred, "
+                           "EXISTS (SELECT 1 FROM pg_attribute k WHERE k.attrelid = c.conrelid AND k.attname = %s AND NOT k.attisdropped) "
+                           "FROM pg_constraint c JOIN pg_class r ON r.oid = c.conrelid "
+                           "JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = c.conkey[1] "
+                           "WHERE c.confrelid = %s::regclass AND c.contype = 'f' AND c.conrelid <> c.confrelid", [key, table])
+            inbound = cursor.fetchall()
+            for other, name, column, deferrable, deferred, has_key in inbound :
+                if not has_key :
+                    raise ValueError(other + "." + column + " points at " + table + " and " + other + " has no " + key +
+                                     " column, so its foreign key couldn't be kept. Partition by hash instead.")
+            cursor.execute("SELECT attidentity <> '' FROM pg_attribute WHERE attrelid = %s::regclass AND attname = 'id'", [table])
+            identity = cursor.fetchone()[0]
+            cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table])
+            sequence = cursor.fetchone()[0]
+            cursor.execute("SELECT EXTRACT(YEAR FROM MIN(start_date))::int FROM " + q(table))
+            this_year = datetime.date.today().year
+            first_year = cursor.fetchone()[0] or this_year
+            statements = _partition_statements(conn, strategy, partitions, range(first_year, this_year + years_ahead + 1))
+            statements.append("INSERT INTO " + q(new) + " SELECT * FROM " + q(table))
+            if not identity :
+                # A serial id's sequence belongs to the old table. Keep it when that's dropped.
+                statements.append("ALTER SEQUENCE " + sequence + " OWNED BY " + q(new) + ".id")
+            # Take the other tables' foreign keys off the old table so it can go without CASCADE,
+            # which would drop them (or anything else that depends on it) silently.
+            statements += ["ALTER TABLE " + q(other) + " DROP CONSTRAINT " + q(name) for other, name, _, _, _, _ in inbound]
+            statements += [
+                "DROP TABLE " + q(table),
+                "ALTER TABLE " + q(new) + " RENAME TO " + q(table),
+                "ALTER TABLE " + q(table) + " RENAME CONSTRAINT " + q(new + "_pkey") + " TO " + q(table + "_pkey"),
+            ]
+            # The index definitions name the table, which is now the partitioned one.
+            statements += index_defs
+            statements += ["ALTER TABLE " + q(table) + " ADD CONSTRAINT " + q(name) + " " + definition
+                           for name, definition in foreign_keys]
+            statements += ["ALTER TABLE " + q(other) + " ADD CONSTRAINT " + q(name) + " FOREIGN KEY (" + q(column) + ", " + key + ") "
+                           "REFERENCES " + q(table) + " (id, " + key + ")" + (" DEFERRABLE" if deferrable else "") +
+                           (" INITIALLY DEFERRED" if deferred else "")
+                           for other, name, column, deferrable, deferred, _ in inbound]
+            if identity :
+                # The copied identity column has a sequence of its own that starts over.
+                statements.append("SELECT setval(pg_get_serial_sequence('" + table + "', 'id'), "
+                                  "COALESCE((SELECT MAX(id) FROM " + q(table) + "), 0) + 1, false)")
+            if dry_run :
+                transaction.set_rollback(True, using=using)
+                return statements
+            for sql in statements :
+                logger.info(sql)
+                cursor.execute(sql)
+    return statements
+
+
+def add_year_partitions(through_year, using="default") :
+    """
+    Make sure a range partitioned table has a partition for every year through through_year.
+
+    Rows of a new partition's year that landed in the default partition are moved into it.
+
+    Args:
+        through_year (int): the last year that should have its own partition
+        using (str, optional): the database alias. Defaults to "default".
+
+    Raises:
+        ValueError: if the table isn't range partitioned
+
+    Returns:
+        list: the years partitions were made for
+    """
+    if get_partition_strategy(using) != "range" :
+        raise ValueError(_table() + " isn't partitioned by range.")
+    conn = connections[using]
+    table = _table()
+    q = lambda name : _quote(conn, name)
+    existing = {name for name, _, _ in list_partitions(using)}
+    years = [int(name.rsplit("_y", 1)[1]) for name in existing if name.startswith(table + "_y")]
+    added = []
+    for year in range(min(years or [through_year]), through_year + 1) :
+        part = table + "_y" + str(year)
+        if part in existing :
+            continue
+        start = str(year) + "-01-01 00:00:00+00"
+        end = str(year + 1) + "-01-01 00:00:00+00"
+        with transaction.atomic(using=using), conn.cursor() as cursor :
+            # Make it detached, fill it from the default partition and then attach it, since
+            # Postgres won't attach a partition whose rows are still in the default one.
+            cursor.execute("CREATE TABLE " + q(part) + " (LIKE " + q(table) + " INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING STORAGE)")
+            cursor.execute("WITH moved AS (DELETE FROM " + q(table + "_default") + " WHERE start_date >= %s AND start_date < %s "
+                           "RETURNING *) INSERT INTO " + q(part) + " SELECT * FROM moved", [start, end])
+            cursor.execute("ALTER TABLE " + q(table) + " ATTACH PARTITION " + q(part) + " " + _year_bounds(year))
+        added.append(year)
+    return added
+
@@ -0,0 +1,74 @@
+from .models import ActivityPayload
+from django.conf import settings
+import json
+import zlib
+
+
+def compress_payload(result) :
+    """
+    Return an activity's JSON as compact, zlib compressed bytes.
+
+    Args:
+        result (dict): the activity as the Strava API returned it
+
+    Returns:
+        bytes: the compressed JSON
+    """
+    data = json.dumps(result, separators=(",", ":")).encode()
+    return zlib.compress(data, settings.PAYLOAD_COMPRESSION_LEVEL)
+
+
+def decompress_payload(data) :
+    """
+    Turn an archived payload back into the activity's JSON.
+
+    Args:
+        data (bytes): the compressed JSON (memoryview on Postgres)
+
+    Returns:
+        dict: the activity as the Strava API returned it
+    """
+    return json.loads(zlib.decompress(data))
+
+
+def archive_payloads(user, results) :
+    """
+    Keep the raw JSON of some of a user's activities, replacing any older copies.
+
+    Args:
+        user (User): the owner of the activities
+        results (list): the activities as the Strava API returned them
+    """
+    payloads = [ActivityPayload(site_user=user, activity_id=r["id"], payload=compress_payload(r)) for r in results]
+    ActivityPayload.objects.bulk_create(payloads, batch_size=1000, update_conflicts=True,
+                                        unique_fields=["site_user", "activity_id"], update_fields=["payload"])
+
+
+def update_archived_payload(user, activity_id, changes) :
+    """
+    Apply changes a webhook told us about to an activity's archived JSON, so re-deriving
+    it doesn't undo them.
+
+    Args:
+        user (User): the owner of the activity
+        activity_id (int): the Strava id of the activity
+        changes (dict): the keys of the activity JSON to overwrite
+    """
+    archived = ActivityPayload.objects.filter(site_user=user, activity_id=activity_id).first()
+    if archived is None :
+        return
+    result = decompress_payload(archived.payload)
+    result.update(changes)
+    archived.payload = compress_payload(result)
+    archived.save(update_fields=["payload"])
+
+
+def forget_payload(user, activity_id) :
+    """
+    Throw away the archived JSON of a deleted activity.
+
+    Args:
+        user (User): the owner of the activity
+        activity_id (int): the Strava id of the activity
+    """
+    ActivityPayload.objects.filter(site_user=user, activity_id=activity_id).delete()
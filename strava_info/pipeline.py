@@ -0,0 +1,25 @@
+from .models import StravaUser
+from .token_helpers import forget_strava_token
+
+
+def save_strava_connection(backend, user=None, social=None, *args, **kwargs) :
+    """
+    A social auth pipeline step that does the bookkeeping for a Strava connection once, when
+    the user connects, instead of on every page view.
+
+    It records when the access token expires, makes sure the user has a StravaUser marked
+    as verified (they may have deauthorized us before and now come back) and forgets any
+    access token we had cached from an earlier connection.
+
+    Args:
+        backend (BaseAuth): the social auth backend the user came through
+        user (User, optional): the connecting user
+        social (UserSocialAuth, optional): their social auth record, with the new tokens
+    """
+    if backend.name != "strava" or user is None or social is None :
+        return
+    extra_data = social.extra_data
+    extra_data["expires_at"] = extra_data["auth_time"] + extra_data["expires"]
+    social.save()
+    StravaUser.objects.update_or_create(user=user, defaults={"is_strava_verified" : True})
+    forget_strava_token(user)
@@ -0,0 +1,238 @@
+from .models import StravaActivity, StravaUser
+from .strava_helpers import strava_api_get, save_webhook_activity, delete_strava_activity
+from .token_helpers import get_strava_access_token
+from django.conf import settings
+from django.db.models import Min, F
+from django.utils import timezone
+import datetime
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Activities per page when listing a month from Strava. The most Strava allows.
+RECONCILE_PAGE_SIZE = 200
+
+
+def month_windows(first, last) :
+    """
+    Return the calendar months (UTC) from the one containing first to the one containing
+    last, newest first.
+
+    Args:
+        first (datetime): a time in the oldest month
+        last (datetime): a time in the newest month
+
+    Returns:
+        list: (start, end) datetimes of each month, end being the start of the next month
+    """
+    windows = []
+    start = datetime.datetime(last.year, last.month, 1, tzinfo=datetime.timezone.utc)
+    oldest = datetime.datetime(first.year, first.month, 1, tzinfo=datetime.timezone.utc)
+    while start >= oldest :
+        end = datetime.datetime(start.year + start.month // 12, start.month % 12 + 1, 1, tzinfo=datetime.timezone.utc)
+        windows.append((start, end))
+        start = datetime.datetime(start.year - (start.month == 1), (start.month - 2) % 12 + 1, 1, tzinfo=datetime.timezone.utc)
+    return windows
+
+
+def activity_fingerprint(activity_id, name, sport_type, distance, moving_time, elapsed_time, elevation_gain, gear_id, start) :
+    """
+    Return what we compare between our copy of an activity and Strava's.
+
+    These are the fields a missed webhook would leave stale: the title and type (update
+    events), plus the numbers and gear that change when an activity is edited or cropped.
+
+    Returns:
+        tuple: the fingerprint
+    """
+    return (int(activity_id), name or "", sport_type or "Unknown", round(distance or 0.0, 1), moving_time or 0,
+            elapsed_time or 0, round(elevation_gain or 0.0, 1), gear_id or "", int(start.timestamp()))
+
+
+def _strava_fingerprint(r) :
+    start = datetime.datetime.fromisoformat(r["start_date"].replace("Z", "+00:00"))
+    return activity_fingerprint(r["id"], r.get("name"), r.get("sport_type"), r.get("distance"), r.get("moving_time"),
+                                r.get("elapsed_time"), r.get("total_elevation_gain"), r.get("gear_id"), start)
+
+
+def _local_fingerprints(user, start, end) :
+    rows = (StravaActivity.objects.filter(site_user=user, start_date__gte=start, start_date__lt=end)
+            .values_list("activity_id", "name", "sport_type", "distance_meters", "moving_time_sec", "elapsed_time_sec",
+                         "total_elevation_gain_m", "gear_id", "start_date"))
+    return {row[0] : activity_fingerprint(*row) for row in rows}
+
+
+def window_checksum(fingerprints) :
+    """
+    Return a checksum of a month's activity fingerprints that doesn't depend on their order.
+
+    Args:
+        fingerprints (iterable): the fingerprints
+
+    Returns:
+        str: the checksum
+    """
+    return hashlib.sha1(repr(sorted(fingerprints)).encode()).hexdigest()
+
+
+def _list_strava_window(user, start, end, calls_left) :
+    """
+    List a user's Strava activities that started in [start, end).
+
+    Returns:
+        tuple: (the activities or None if the budget ran out or a call failed, API calls made)
+    """
+    url = settings.STRAVA_API_URL + "/activities"
+    results = []
+    calls = 0
+    page = 1
+    while calls < calls_left :
+        payload = {'access_token' : get_strava_access_token(user), 'after' : str(int(start.timestamp()) - 1),
+                   'before' : str(int(end.timestamp())), 'per_page' : str(RECONCILE_PAGE_SIZE), 'page' : str(page)}
+        r = strava_api_get(url, payload)
+        calls += 1
+        if r.status_code != 200 :
+            logger.warning("Strava answered " + str(r.status_code) + " listing activities for " + user.username)
+            return None, calls
+        acts = r.json()
+        results += acts
+        # A short page is the last one, so we don't have to ask for an empty one.
+        if len(acts) < RECONCILE_PAGE_SIZE :
+            return results, calls
+        page += 1
+    return None, calls
+
+
+def reconcile_window(user, start, end, calls_left) :
+    """
+    Compare one month of a user's activities with Strava and repair any differences.
+
+    The month's activities are listed from Strava (a call per 200 activities) and their
+    count and checksum compared with ours. Only if they differ do we look at individual
+    activities: ones that are new or changed at Strava are saved as though a webhook had
+    told us about them, and ones Strava no longer has are deleted.
+
+    Args:
+        user (User): the user
+        start (datetime): start of the month
+        end (datetime): start of the next month
+        calls_left (int): the most API calls this may make
+
+    Returns:
+        dict: api_calls made, whether the month was checked (False if the budget ran out
+            or Strava didn't answer), whether it differed, and the number saved and deleted
+    """
+    result = {"api_calls" : 0, "checked" : False, "differed" : False, "saved" : 0, "deleted" : 0}
+    theirs, result["api_calls"] = _list_strava_window(user, start, end, calls_left)
+    if theirs is None :
+        return result
+    result["checked"] = True
+    by_id = {int(r["id"]) : r for r in theirs}
+    their_prints = {i : _strava_fingerprint(r) for i, r in by_id.items()}
+    our_prints = _local_fingerprints(user, start, end)
+    if len(their_prints) == len(our_prints) and window_checksum(their_prints.values()) == window_checksum(our_prints.values()) :
+        return result
+    result["differed"] = True
+    for activity_id, fingerprint in their_prints.items() :
+        if our_prints.get(activity_id) != fingerprint :
+            save_webhook_activity(user, by_id[activity_id])
+            result["saved"] += 1
+    for activity_id in our_prints.keys() - their_prints.keys() :
+        delete_strava_activity(user, activity_id)
+        result["deleted"] += 1
+    logger.info("Reconciled " + start.strftime("%Y-%m") + " for " + user.username + ": saved " + str(result["saved"]) +
+                ", deleted " + str(result["deleted"]))
+    return result
+
+
+def reconcile_user(user, max_calls) :
+    """
+    Check as much of a user's history against Strava as a budget of API calls allows.
+
+    Missed webhooks are most likely to be recent, so the last RECONCILE_RECENT_MONTHS
+    months are checked every time. The rest of the budget goes to older months, newest
+    first, carrying on from where the last run stopped (StravaUser.reconcile_cursor) and
+    starting again from the top once it reaches the user's first activity. So repeated
+    runs eventually cover the whole history.
+
+    Args:
+        user (User): the user
+        max_calls (int): the most API calls to make
+
+    Returns:
+        dict: api_calls made and the number of months checked, months that differed,
+            activities saved and activities deleted
+    """
+    report = {"api_calls" : 0, "windows_checked" : 0, "windows_differed" : 0, "saved" : 0, "deleted" : 0}
+    su = user.stravauser
+    first = StravaActivity.objects.filter(site_user=user).aggregate(Min("start_date"))["start_date__min"]
+    now = timezone.now()
+    windows = month_windows(first or now, now)
+    recent = windows[:settings.RECONCILE_RECENT_MONTHS]
+    older = windows[settings.RECONCILE_RECENT_MONTHS:]
+    # Carry on from the cursor, then wrap around to the newest of the older months.
+    cursor = su.reconcile_cursor
+    skip = [w for w in older if cursor is not None and w[0].date() > cursor]
+    queue = recent + older[len(skip):] + skip
+    cursor = None
+    for start, end in queue :
+        if report["api_calls"] >= max_calls :
+            break
+        result = reconcile_window(user, start, end, max_calls - report["api_calls"])
+        report["api_calls"] += result["api_calls"]
+        if not result["checked"] :
+            break
+        report["windows_checked"] += 1
+        report["windows_differed"] += result["differed"]
+        report["saved"] += result["saved"]
+        report["deleted"] += result["deleted"]
+        if (start, end) in older :
+            # The next run starts with the month before this one.
+            cursor = (start - datetime.timedelta(days=1)).date()
+    if cursor is not None :
+        su.reconcile_cursor = cursor
+    su.reconciled_at = now
+    # Only these fields, so we don't undo anything saved while we were running.
+    su.save(update_fields=["reconcile_cursor", "reconciled_at"])
+    return report
+
+
+def reconcile_users(users=None, max_calls=None, calls_per_user=None) :
+    """
+    Reconcile users' activities with Strava within a budget of API calls for the whole run.
+
+    Users who were reconciled longest ago (or never) go first, so when the budget doesn't
+    stretch to everyone the ones left out are first in line next time.
+
+    Args:
+        users (QuerySet, optional): the users to reconcile. Defaults to everyone who has
+            downloaded their Strava data and is still connected.
+        max_calls (int, optional): API calls for the whole run. Defaults to settings.RECONCILE_MAX_API_CALLS.
+        calls_per_user (int, optional): API calls for each user. Defaults to settings.RECONCILE_API_CALLS_PER_USER.
+
+    Returns:
+        dict: username to that user's report from reconcile_user
+    """
+    max_calls = max_calls or settings.RECONCILE_MAX_API_CALLS
+    calls_per_user = calls_per_user or settings.RECONCILE_API_CALLS_PER_USER
+    sus = StravaUser.objects.filter(is_strava_verified=True, has_completed_initial_download=True, downloading=False,
+                                    user__social_auth__provider="strava")
+    if users is not None :
+        sus = sus.filter(user__in=users)
+    reports = {}
+    calls = 0
+    for su in sus.select_related("user").order_by(F("reconciled_at").asc(nulls_first=True), "id") :
+        if calls >= max_calls :
+            break
+        budget = min(calls_per_user, max_calls - calls)
+        try :
+            reports[su.user.username] = reconcile_user(su.user, budget)
+        except Exception :
+            # Don't let one user's problem stop everyone else's reconciliation. We don't
+            # know how many calls it made, so count all it was allowed.
+            logger.exception("Couldn't reconcile " + su.user.username)
+            calls += budget
+            continue
+        calls += reports[su.user.username]["api_calls"]
+    return reports
@@ -0,0 +1,92 @@
+from .models import ActivityPayload
+from .payload_helpers import decompress_payload
+from .strava_helpers import build_strava_activity, replace_activities, finish_full_ingest
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from django.conf import settings
+from django.contrib.auth.models import User
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def derive_activities(user_id, payloads) :
+    """
+    Build the activities of one user from their archived JSON.
+
+    This runs in a worker process. It only does the CPU work (decompressing, field
+    mapping, route geometry) and hands the unsaved activities back to be saved.
+
+    Args:
+        user_id (int): id of the owner of the activities
+        payloads (list): their compressed JSON
+
+    Returns:
+        tuple: (user_id, list of (StravaActivity, points of its route) pairs)
+    """
+    user = User(id=user_id)
+    return user_id, [build_strava_activity(decompress_payload(p), user) for p in payloads]
+
+
+def _payload_chunks(users, chunk_size) :
+    """
+    Stream the archive as (user id, list of payloads) chunks that never mix users.
+    """
+    qs = ActivityPayload.objects.order_by("site_user_id", "activity_id")
+    if users is not None :
+        qs = qs.filter(site_user__in=users)
+    chunk = []
+    chunk_user = None
+    for user_id, payload in qs.values_list("site_user_id", "payload").iterator(chunk_size=chunk_size) :
+        if chunk and (user_id != chunk_user or len(chunk) >= chunk_size) :
+            yield chunk_user, chunk
+            chunk = []
+        chunk_user = user_id
+        # Postgres hands back memoryviews, which can't be sent to another process.
+        chunk.append(bytes(payload))
+    if chunk :
+        yield chunk_user, chunk
+
+
+def _map_in_order(pool, fn, chunks, window) :
+    """
+    Like pool.map, but only reads window chunks ahead so the whole archive is never in memory.
+    """
+    pending = deque()
+    for args in chunks :
+        pending.append(pool.submit(fn, *args))
+        if len(pending) >= window :
+            yield pending.popleft().result()
+    while pending :
+        yield pending.popleft().result()
+
+
+def rederive_activities(users=None, workers=None, chunk_size=None) :
+    """
+    Rebuild activities from their archived Strava JSON without any API calls.
+
+    The archive is streamed a chunk at a time through a process pool that rebuilds
+    the activities, and each chunk replaces the stored copies of its activities
+    (and their geohash cells). Then everything derived from a user's whole history
+    (heatmap, route clusters and pie colors) is rebuilt for each user that had any.
+    Activities saved before the archive existed are left alone.
+
+    Args:
+        users (QuerySet, optional): the users to rebuild. Defaults to everyone.
+        workers (int, optional): number of processes. Defaults to settings.REDERIVE_WORKERS.
+        chunk_size (int, optional): activities per chunk. Defaults to settings.REDERIVE_CHUNK_SIZE.
+
+    Returns:
+        dict: user id to the number of activities rebuilt
+    """
+    workers = workers or settings.REDERIVE_WORKERS
+    chunk_size = chunk_size or settings.REDERIVE_CHUNK_SIZE
+    counts = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool :
+        for user_id, built in _map_in_order(pool, derive_activities, _payload_chunks(users, chunk_size), workers * 2) :
+            replace_activities(built)
+            counts[user_id] = counts.get(user_id, 0) + len(built)
+    for user in User.objects.filter(id__in=counts).select_related("stravauser") :
+        finish_full_ingest(user)
+        logger.info("Rebuilt " + str(counts[user.id]) + " activities for " + user.username)
+    return counts
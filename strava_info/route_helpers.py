@@ -0,0 +1,158 @@
+from .models import StravaActivity, RouteCluster
+from .geo_helpers import decode_polyline, resample_track, track_length_m, mean_track_separation_m, point_geohash_neighborhood
+from django.conf import settings
+from django.db.models import F
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def route_fingerprint(polyline) :
+    """
+    Reduce an activity's route to something that can be compared with other routes.
+
+    Args:
+        polyline (str): the activity's encoded summary polyline
+
+    Returns:
+        tuple: (fingerprint, length in meters) where fingerprint is the route resampled to
+               ROUTE_FINGERPRINT_POINTS points, or (None, 0.0) if there is no usable route
+    """
+    points = decode_polyline(polyline)
+    length = track_length_m(points)
+    if length == 0.0 :
+        return None, 0.0
+    return resample_track(points, settings.ROUTE_FINGERPRINT_POINTS), length
+
+
+def _route_cells(fingerprint) :
+    """
+    Return the geohash neighborhoods of a route's start and end.
+    """
+    precision = settings.ROUTE_CELL_PRECISION
+    start_cells = point_geohash_neighborhood(fingerprint[0][0], fingerprint[0][1], precision)
+    end_cells = point_geohash_neighborhood(fingerprint[-1][0], fingerprint[-1][1], precision)
+    return start_cells, end_cells
+
+
+def find_matching_cluster(candidates, fingerprint, length) :
+    """
+    Return the first candidate cluster whose route matches a fingerprint.
+
+    Two routes match if their lengths are close and their resampled points are,
+    on average, within ROUTE_MATCH_TOLERANCE_M of each other.
+
+    Args:
+        candidates (iterable): RouteClusters that start and end near the route
+        fingerprint (ndarray): the route's fingerprint
+        length (float): the route's length in meters
+
+    Returns:
+        RouteCluster: the matching cluster, or None if nothing matches
+    """
+    import numpy as np
+    for c in candidates :
+        if abs(length - c.distance_meters) > settings.ROUTE_LENGTH_TOLERANCE * c.distance_meters :
+            continue
+        if mean_track_separation_m(fingerprint, np.array(c.fingerprint)) <= settings.ROUTE_MATCH_TOLERANCE_M :
+            return c
+    return None
+
+
+def _new_cluster(user_id, sport_type, name, fingerprint, length, start_cell, end_cell) :
+    return RouteCluster(site_user_id=user_id, sport_type=sport_type, name=name, start_cell=start_cell, end_cell=end_cell,
+                        fingerprint=fingerprint.round(6).tolist(), distance_meters=length, activity_count=0)
+
+
+def assign_activity_to_cluster(act) :
+    """
+    Put a newly saved activity in the cluster of routes it matches, creating one if needed.
+
+    Only clusters of the same sport type that start and end in (or next to) the same
+    geohash cells are compared, so this costs a single indexed query.
+
+    Args:
+        act (StravaActivity): the saved activity
+
+    Returns:
+        RouteCluster: the activity's cluster, or None if the activity has no route
+    """
+    fingerprint, length = route_fingerprint(act.summary_polyline)
+    if fingerprint is None :
+        return None
+    start_cells, end_cells = _route_cells(fingerprint)
+    candidates = RouteCluster.objects.filter(site_user_id=act.site_user_id, sport_type=act.sport_type,
+                                             start_cell__in=start_cells, end_cell__in=end_cells)
+    cluster = find_matching_cluster(candidates, fingerprint, length)
+    if cluster is None :
+        cluster = _new_cluster(act.site_user_id, act.sport_type, act.name, fingerprint, length, start_cells[0], end_cells[0])
+        cluster.save()
+    RouteCluster.objects.filter(id=cluster.id).update(activity_count=F("activity_count") + 1)
+    StravaActivity.objects.filter(id=act.id).update(route_cluster=cluster)
+    act.route_cluster = cluster
+    return cluster
+
+
+def remove_activity_from_cluster(cluster_id) :
+    """
+    Update a cluster's count after one of its activities has been deleted.
+
+    Clusters left with no activities are deleted.
+
+    Args:
+        cluster_id (int): id of the deleted activity's cluster (may be None)
+    """
+    if cluster_id is None :
+        return
+    RouteCluster.objects.filter(id=cluster_id).update(activity_count=F("activity_count") - 1)
+    RouteCluster.objects.filter(id=cluster_id, activity_count=0).delete()
+
+
+def cluster_user_routes(user, batch_size=None) :
+    """
+    Throw away a user's route clusters and cluster all of their activities again.
+
+    Activities are streamed in date order and matched against an in memory index of
+    clusters keyed on (sport type, start cell, end cell), so each activity is only
+    compared with the handful of clusters that start and end near it.
+
+    Args:
+        user (User): the user whose routes we are clustering
+        batch_size (int, optional): rows fetched and written at a time. Defaults to settings.ROUTE_BATCH_SIZE.
+    """
+    batch_size = batch_size or settings.ROUTE_BATCH_SIZE
+    StravaActivity.objects.filter(site_user=user).update(route_cluster=None)
+    RouteCluster.objects.filter(site_user=user).delete()
+    index = {}
+    clusters = []
+    assignments = []
+    acts = (StravaActivity.objects.filter(site_user=user).exclude(summary_polyline="").order_by("start_date")
+            .values_list("id", "sport_type", "name", "summary_polyline").iterator(chunk_size=batch_size))
+    for act_id, sport_type, name, polyline in acts :
+        fingerprint, length = route_fingerprint(polyline)
+        if fingerprint is None :
+            continue
+        start_cells, end_cells = _route_cells(fingerprint)
+        candidates = [c for s in start_cells for e in end_cells for c in index.get((sport_type, s, e), [])]
+        cluster = find_matching_cluster(candidates, fingerprint, length)
+        if cluster is None :
+            cluster = _new_cluster(user.id, sport_type, name, fingerprint, length, start_cells[0], end_cells[0])
+            index.setdefault((sport_type, start_cells[0], end_cells[0]), []).append(cluster)
+            clusters.append(cluster)
+        cluster.activity_count += 1
+        assignments.append((act_id, cluster))
+    RouteCluster.objects.bulk_create(clusters, batch_size=batch_size)
+    StravaActivity.objects.bulk_update([StravaActivity(id=act_id, route_cluster=c) for act_id, c in assignments],
+                                       ["route_cluster"], batch_size=batch_size)
+
+
+def assign_unclustered_activities(user) :
+    """
+    Put each of a user's activities that isn't in a cluster yet into one.
+
+    Args:
+        user (User): the user whose activities we are clustering
+    """
+    acts = StravaActivity.objects.filter(site_user=user, route_cluster=None).exclude(summary_polyline="").order_by("start_date")
+    for a in acts.only("id", "site_user_id", "sport_type", "name", "summary_polyline").iterator(chunk_size=settings.ROUTE_BATCH_SIZE) :
+        assign_activity_to_cluster(a)
@@ -0,0 +1,61 @@
+from django.conf import settings
+import contextvars
+
+# The alias of the read replica in DATABASES.
+REPLICA_DATABASE = "replica"
+
+# Apps whose reads never go to the replica. A session written on login has to be
+# there on the very next request.
+PRIMARY_ONLY_APPS = {"sessions"}
+
+# The current request's routing state, set by ReplicaRoutingMiddleware. Threads
+# started outside a request (downloads, webhooks) don't have one, so they only
+# ever use the primary.
+_routing_state = contextvars.ContextVar("strava_info_routing_state", default=None)
+
+
+def start_routing() :
+    """
+    Start tracking database routing for a request. Its reads stay on the primary
+    until use_replica is set in the returned state.
+
+    Returns:
+        tuple: the request's state dict and a token for end_routing
+    """
+    state = {"use_replica" : False, "wrote" : False}
+    return state, _routing_state.set(state)
+
+
+def end_routing(token) :
+    _routing_state.reset(token)
+
+
+class ReplicaRouter :
+    """
+    Send the reads of the analytics views in REPLICA_READ_VIEWS to the read replica.
+
+    Everything else, and every write, goes to the primary. Once a request writes,
+    the rest of its reads go to the primary too so it sees its own changes. Without a
+    replica configured this router leaves everything on the primary.
+    """
+    def db_for_read(self, model, **hints) :
+        state = _routing_state.get()
+        if (state and state["use_replica"] and not state["wrote"] and REPLICA_DATABASE in settings.DATABASES
+                and model._meta.app_label not in PRIMARY_ONLY_APPS) :
+            return REPLICA_DATABASE
+        return "default"
+
+    def db_for_write(self, model, **hints) :
+        state = _routing_state.get()
+        # Saving the session isn't a change the user needs to read back from the replica.
+        if state is not None and model._meta.app_label not in PRIMARY_ONLY_APPS :
+            state["wrote"] = True
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints) :
+        # The replica holds the same data as the primary.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints) :
+        # The replica gets its schema from the primary by replication.
+        return db == "default"
@@ -0,0 +1,22 @@
+from .models import WebhookSubscription
+from .webhook_helpers import forget_webhook_owner, forget_webhook_subscription_id
+from social_django.models import UserSocialAuth
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+
+@receiver([post_save, post_delete], sender=UserSocialAuth)
+def strava_login_changed(sender, instance, **kwargs) :
+    """
+    Forget the cached webhook owner when a user connects or disconnects Strava.
+    """
+    if instance.provider == "strava" :
+        forget_webhook_owner(instance.uid)
+
+
+@receiver([post_save, post_delete], sender=WebhookSubscription)
+def webhook_subscription_changed(sender, instance, **kwargs) :
+    """
+    Forget the cached subscription id when we subscribe or unsubscribe.
+    """
+    forget_webhook_subscription_id()
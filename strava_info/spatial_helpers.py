@@ -0,0 +1,148 @@
+from .models import StravaActivity, ActivityGeoCell
+from .geo_helpers import (decode_polyline, track_geohash_cells, bbox_geohash_cells, bbox_geohash_cell_count,
+                          radius_to_bbox, track_within_radius, track_intersects_bbox)
+from django.conf import settings
+import logging
+
+# The fields activity_track reads, for loading activities with .only().
+ACTIVITY_TRACK_FIELDS = ["summary_polyline", "start_lat", "start_lng", "end_lat", "end_lng"]
+
+logger = logging.getLogger(__name__)
+
+
+def activity_track(act) :
+    """
+    Return the points of an activity's route.
+
+    Manual activities don't have a polyline, so fall back on the start and end points.
+
+    Args:
+        act (StravaActivity): the activity
+
+    Returns:
+        ndarray: N x 2 array of (lat, lng) points
+    """
+    import numpy as np
+    points = decode_polyline(act.summary_polyline)
+    if len(points) == 0 :
+        ends = [(lat, lng) for lat, lng in ((act.start_lat, act.start_lng), (act.end_lat, act.end_lng)) if lat is not None and lng is not None]
+        points = np.array(ends, dtype=np.float64).reshape(-1, 2)
+    return points
+
+
+def set_activity_geometry(sa, result) :
+    """
+    Fill in the start, end and bounding box fields of an activity that hasn't been saved yet.
+
+    Args:
+        sa (StravaActivity): the activity
+        result (dict): Json data for the activity obtained from a call to the Strava API
+
+    Returns:
+        ndarray: the points of the activity's route
+    """
+    start = result.get("start_latlng") or []
+    end = result.get("end_latlng") or []
+    sa.start_lat, sa.start_lng = (start[0], start[1]) if len(start) == 2 else (None, None)
+    sa.end_lat, sa.end_lng = (end[0], end[1]) if len(end) == 2 else (None, None)
+    points = activity_track(sa)
+    if len(points) > 0 :
+        sa.min_lat, sa.min_lng = points.min(axis=0)
+        sa.max_lat, sa.max_lng = points.max(axis=0)
+    else :
+        sa.min_lat = sa.min_lng = sa.max_lat = sa.max_lng = None
+    return points
+
+
+def index_activity_cells(sa, points) :
+    """
+    Record the geohash cells a saved activity's route passes through.
+
+    Args:
+        sa (StravaActivity): the saved activity
+        points (ndarray): the points of the activity's route
+    """
+    bulk_index_activity_cells([(sa, points)])
+
+
+def bulk_index_activity_cells(acts_and_points, batch_size=1000) :
+    """
+    Record the geohash cells of many saved activities with as few inserts as possible.
+
+    Args:
+        acts_and_points (list): (StravaActivity, points of its route) pairs
+        batch_size (int, optional): rows per insert. Defaults to 1000.
+    """
+    cells = []
+    for sa, points in acts_and_points :
+        cells += [ActivityGeoCell(site_user_id=sa.site_user_id, activity=sa, cell=c)
+                  for c in track_geohash_cells(points, settings.GEO_INDEX_PRECISION)]
+    ActivityGeoCell.objects.bulk_create(cells, batch_size=batch_size)
+
+
+def filter_activities_by_area(acts_qs, user, *, bbox=None, near=None) :
+    """
+    Narrow a QuerySet down to activities whose bounding area might pass through a place.
+
+    The place is either a bounding box or a circle around a point. The candidates come from
+    the indexed geohash cell table (or, if the area covers too many cells, the indexed
+    bounding box columns) so this never has to look at every activity. The candidates
+    still have to be checked against their routes with refine_activities_by_area.
+
+    Args:
+        acts_qs (QuerySet): the StravaActivities to narrow down
+        user (User): the owner of the activities
+        bbox (tuple, optional): (south, west, north, east) in degrees. Defaults to None.
+        near (tuple, optional): (lat, lng, radius in meters). Defaults to None.
+
+    Returns:
+        QuerySet: the candidate activities
+    """
+    for area in (bbox, radius_to_bbox(*near) if near else None) :
+        if not area :
+            continue
+        south, west, north, east = area
+        precision = settings.GEO_INDEX_PRECISION
+        if bbox_geohash_cell_count(south, west, north, east, precision) <= settings.GEO_INDEX_MAX_QUERY_CELLS :
+            cells = bbox_geohash_cells(south, west, north, east, precision)
+            ids = ActivityGeoCell.objects.filter(site_user=user, cell__in=cells).values("activity_id")
+            acts_qs = acts_qs.filter(id__in=ids)
+        else :
+            # The area is so big that listing the cells would cost more than it saves.
+            acts_qs = acts_qs.filter(min_lat__lte=north, max_lat__gte=south, min_lng__lte=east, max_lng__gte=west)
+    return acts_qs
+
+
+def refine_activities_by_area(acts, *, bbox=None, near=None) :
+    """
+    Keep only the activities whose routes actually pass through a place.
+
+    Args:
+        acts (iterable): candidate StravaActivities from filter_activities_by_area
+        bbox (tuple, optional): (south, west, north, east) in degrees. Defaults to None.
+        near (tuple, optional): (lat, lng, radius in meters). Defaults to None.
+
+    Returns:
+        list: the activities that pass through the place
+    """
+    return [a for a in acts if activity_passes_through(a, bbox=bbox, near=near)]
+
+
+def activity_passes_through(act, *, bbox=None, near=None) :
+    """
+    Check whether an activity's route actually passes through a place.
+
+    Args:
+        act (StravaActivity): the activity, with at least its route and end points loaded
+        bbox (tuple, optional): (south, west, north, east) in degrees. Defaults to None.
+        near (tuple, optional): (lat, lng, radius in meters). Defaults to None.
+
+    Returns:
+        bool: True if the route passes through the place
+    """
+    points = activity_track(act)
+    if bbox and not track_intersects_bbox(points, *bbox) :
+        return False
+    if near and not track_within_radius(points, *near) :
+        return False
+    return True
@@ -0,0 +1,81 @@
+from django.conf import settings
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncStravaClient :
+    """
+    An async client for the Strava API calls that ingest makes.
+
+    One client holds a pool of connections, so many calls can be in flight at once
+    without a thread each. The base URL comes from settings.STRAVA_API_URL unless
+    given, which is how the fake Strava server gets targeted. A client belongs to the
+    event loop it was first used on.
+
+    Args:
+        api_url (str, optional): base URL of the API. Defaults to settings.STRAVA_API_URL.
+        timeout (float, optional): seconds to wait on each call. Defaults to settings.STRAVA_API_TIMEOUT.
+    """
+    def __init__(self, api_url=None, timeout=None) :
+        # httpx is only needed once webhooks start coming in.
+        import httpx
+        self.api_url = api_url or settings.STRAVA_API_URL
+        self.http = httpx.AsyncClient(timeout=timeout or settings.STRAVA_API_TIMEOUT,
+                                      limits=httpx.Limits(max_connections=settings.STRAVA_API_MAX_CONNECTIONS))
+
+    async def get(self, path, access_token, params=None) :
+        """
+        Make a GET call, waiting and retrying if we hit the rate limit (like strava_api_get).
+
+        Args:
+            path (str): the path under the API's base URL, e.g. "/activities"
+            access_token (str): the athlete's access token
+            params (dict, optional): query parameters. Defaults to None.
+
+        Raises:
+            httpx.HTTPError: if the call fails or Strava says no
+
+        Returns:
+            the decoded JSON response
+        """
+        headers = {"Authorization" : "Bearer " + access_token}
+        for attempt in range(settings.STRAVA_RATE_LIMIT_RETRIES + 1) :
+            r = await self.http.get(self.api_url + path, params=params, headers=headers)
+            if r.status_code != 429 or attempt == settings.STRAVA_RATE_LIMIT_RETRIES :
+                break
+            wait = float(r.headers.get("Retry-After", settings.STRAVA_RATE_LIMIT_WAIT))
+            logger.warning("Hit the Strava rate limit. Retrying in " + str(wait) + " seconds.")
+            await asyncio.sleep(wait)
+        r.raise_for_status()
+        return r.json()
+
+    async def get_activity(self, access_token, activity_id) :
+        """
+        Return one of the athlete's activities.
+
+        Args:
+            access_token (str): the athlete's access token
+            activity_id (int): the activity's id
+
+        Returns:
+            dict: the activity
+        """
+        return await self.get("/activities/" + str(activity_id), access_token)
+
+    async def get_gear(self, access_token, gear_id) :
+        """
+        Return one of the athlete's bikes or pairs of shoes.
+
+        Args:
+            access_token (str): the athlete's access token
+            gear_id (str): Strava's id for the gear
+
+        Returns:
+            dict: the gear
+        """
+        return await self.get("/gear/" + gear_id, access_token)
+
+    async def aclose(self) :
+        await self.http.aclose()
@@ -1,34 +1,46 @@
-from .models import StravaActivity, StravaUser, WebhookSubscription
+from .models import StravaActivity, StravaUser, WebhookSubscription, RouteCluster, ActivityGeoCell, ActivityPayload, Gear, DailyTotal
 from social_django.models import UserSocialAuth
 import requests
-from dateutil import parser
-import pytz
-import distinctipy
+import datetime
+import calendar
 from django.conf import settings
 import time
+import functools
 from django.contrib import messages
-from django.db.models import Sum, Max, Min, Avg
+from django.db.models import Sum, Max, Min, Avg, F
+from django.db import transaction
 from django.http import JsonResponse
+from django.utils.dateparse import parse_datetime
 from django.contrib.auth.models import User
 import logging
+from .heatmap_helpers import add_polylines_to_heatmap, rebuild_user_heatmap, delete_user_heatmap
+from .spatial_helpers import set_activity_geometry, index_activity_cells, bulk_index_activity_cells, filter_activities_by_area, activity_passes_through, ACTIVITY_TRACK_FIELDS
+from .gear_helpers import update_gear_totals, unnamed_gear_ids, name_gear
+from .calendar_helpers import update_daily_totals
+from .page_cache_helpers import bump_data_version, queue_page_warming
+from .payload_helpers import archive_payloads, update_archived_payload, forget_payload
+from .token_helpers import get_strava_access_token, forget_strava_token
+from .webhook_helpers import get_webhook_owner
+from .route_helpers import assign_activity_to_cluster, remove_activity_from_cluster, cluster_user_routes, assign_unclustered_activities
 
 #logging.basicConfig(format='%(asctime)s %(levelname)s:%(message)s', level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-def save_strava_activity(result, the_user) :
-    """Save the details of a user's Strava activity to the database.
+# What an activity adds to the running totals of its gear and its day.
+ROLLUP_FIELDS = ("gear_id", "local_date", "sport_type", "distance_meters", "moving_time_sec")
+
+def build_strava_activity(result, the_user) :
+    """Build (but don't save) a StravaActivity from a user's Strava activity data.
     
-    Save each relevant piece of activity data to a StravaActivity model.
+    Copy each relevant piece of activity data to a StravaActivity model.
 
     Args:
         result (dict): Json data for a single activity obtained from a call to the Strava API
         the_user (User): The user associated with the Strava activity
+
+    Returns:
+        tuple: (StravaActivity, the points of the activity's route)
     """
-    # Check if the activity already exists. If so, delete
-    # it and save the new activity.
-    StravaActivity.objects.filter(site_user=the_user, activity_id=result.get("id")).delete()
-    
-    # Now create the new StravaActivity and save it.
     sa = StravaActivity()
     sa.site_user = the_user
     sa.activity_id = result.get("id")
@@ -41,6 +53,7 @@ def save_strava_activity(result, the_user) :
     sa.sport_type = result.get("sport_type", "Unknown")
     sa.start_date = result.get("start_date")
     sa.start_date_local = result.get("start_date_local")
+    set_local_buckets(sa)
     sa.timezone = result.get("timezone")
     sa.utc_offset = result.get("utc_offset")
     sa.location_country = result.get("location_country")
@@ -74,17 +87,149 @@ def save_strava_activity(result, the_user) :
     sa.max_speed_mph = result.get('max_speed',0.0) * 2.23694
     sa.max_speed_kph = result.get('max_speed',0.0) * 3.6
     sa.average_temp = result.get("average_temp",0.0)
+    # Strava sends null when no gear was used.
+    sa.gear_id = result.get("gear_id") or ""
+    # Strava sends null for the map of manual activities.
+    sa.summary_polyline = (result.get("map") or {}).get("summary_polyline") or ""
+    points = set_activity_geometry(sa, result)
+    return sa, points
+
+def set_local_buckets(sa) :
+    """
+    Fill in the local date, year, month and ISO week of an activity from its start_date_local.
+
+    Strava gives the local start time as though it were UTC, so its date is the athlete's
+    local date.
+
+    Args:
+        sa (StravaActivity): the activity, with start_date_local set to a datetime or an ISO 8601 string
+    """
+    local = sa.start_date_local
+    if isinstance(local, str) :
+        # fromisoformat doesn't take a trailing Z before Python 3.11.
+        local = datetime.datetime.fromisoformat(local.replace("Z", "+00:00"))
+    sa.local_date = local.date()
+    sa.local_year = local.year
+    sa.local_month = local.month
+    sa.local_iso_week = local.isocalendar()[1]
+
+def save_strava_activity(result, the_user) :
+    """Save the details of a user's Strava activity to the database.
+    
+    Save each relevant piece of activity data to a StravaActivity model.
+
+    Args:
+        result (dict): Json data for a single activity obtained from a call to the Strava API
+        the_user (User): The user associated with the Strava activity
+
+    Returns:
+        StravaActivity: the saved activity
+    """
+    # Check if the activity already exists. If so, delete
+    # it and save the new activity.
+    old = StravaActivity.objects.filter(site_user=the_user, activity_id=result.get("id"))
+    removed = list(old.values_list(*ROLLUP_FIELDS))
+    old.delete()
+    
+    # Now create the new StravaActivity and save it.
+    sa, points = build_strava_activity(result, the_user)
     sa.save()
+    update_rollups(the_user, removed, [rollup_row(sa)])
+    # Index the route so we can quickly find activities that pass through a place.
+    index_activity_cells(sa, points)
+    # Keep everything Strava sent, not just the fields we use today.
+    archive_payloads(the_user, [result])
+    return sa
+
+def replace_activities(built) :
+    """Replace any copies we have of a batch of built activities and bulk insert them.
+
+    Args:
+        built (list): (StravaActivity, points of its route) pairs from build_strava_activity, all for one user
+    """
+    user = built[0][0].site_user
+    with transaction.atomic() :
+        old = StravaActivity.objects.filter(site_user=user, activity_id__in=[sa.activity_id for sa, _ in built])
+        removed = list(old.values_list(*ROLLUP_FIELDS))
+        old.delete()
+        StravaActivity.objects.bulk_create([sa for sa, _ in built], batch_size=len(built))
+        bulk_index_activity_cells(built)
+        update_rollups(user, removed, [rollup_row(sa) for sa, _ in built])
+
+def rollup_row(sa) :
+    """Return what an activity adds to the running totals, in the order of ROLLUP_FIELDS."""
+    return tuple(getattr(sa, f) for f in ROLLUP_FIELDS)
+
+def update_rollups(user, removed=(), added=()) :
+    """Keep the running totals of a user's gear and days up to date as activities come and go.
+
+    Every path that saves or deletes activities comes through here, so this is also where
+    the user's cached pages are made stale.
+
+    Args:
+        user (User): the owner of the activities
+        removed (iterable, optional): ROLLUP_FIELDS of activities that went away
+        added (iterable, optional): ROLLUP_FIELDS of activities that were saved
+    """
+    update_gear_totals(user, [(g, d, m) for g, _, _, d, m in removed], [(g, d, m) for g, _, _, d, m in added])
+    update_daily_totals(user, [r[1:] for r in removed], [r[1:] for r in added])
+    refresh_activity_summary(user, [r[2] for r in removed], [r[2] for r in added])
+
+def refresh_activity_summary(user, removed_types=(), added_types=()) :
+    """Bring the activity types and recent activities stored on a user's StravaUser up to
+    date, and move their data version on so cached pages are made stale.
+
+    The types of saved activities are merged into the stored list. The database is only
+    asked about a type when an activity of that type went away, to see if it was the last one.
+
+    Args:
+        user (User): the user whose activities changed
+        removed_types (iterable, optional): sport types of activities that went away
+        added_types (iterable, optional): sport types of activities that were saved
+    """
+    acts = StravaActivity.objects.filter(site_user=user)
+    added_types = set(added_types)
+    gone = set(removed_types) - added_types
+    recent = [{"activity_id" : a, "name" : n, "start_date_local" : d.isoformat()}
+              for a, n, d in acts.order_by("-start_date").values_list("activity_id", "name", "start_date_local")[:5]]
+    with transaction.atomic() :
+        # Lock the row so two writers don't each drop the other's new type.
+        stored = StravaUser.objects.select_for_update().filter(user=user).values_list("activity_types", flat=True).first()
+        types = set(stored or []) | added_types
+        if gone :
+            types -= gone - set(acts.filter(sport_type__in=gone).values_list("sport_type", flat=True).distinct())
+        StravaUser.objects.filter(user=user).update(activity_types=sorted(types), recent_activities=recent,
+                                                    data_version=F("data_version") + 1)
+
+def get_recent_activities(su) :
+    """Return a user's five most recent activities as stored on their StravaUser.
+
+    Args:
+        su (StravaUser): the user's StravaUser
+
+    Returns:
+        list: dicts with the activity_id, name and start_date_local (a datetime) of each activity
+    """
+    return [dict(a, start_date_local=parse_datetime(a["start_date_local"])) for a in su.recent_activities]
 
 def save_strava_data(results, the_user) :
     """Save a list of Strava activity Json results to the database.
 
+    The activities are built in memory and bulk inserted STRAVA_SAVE_BATCH_SIZE at a
+    time, with one archive write and one set of running total updates for each batch.
+
     Args:
         results (list): List of dictionaries of Json data retrieved by a call to the Strava API
         the_user (User): The user associated with the Strava data.
     """
-    for result in results :
-        save_strava_activity(result, the_user)
+    # An activity can show up on two pages if the list changed while we were paging
+    # through it. Keep the last copy so each batch has one of each.
+    results = list({r["id"] : r for r in results if r.get("id")}.values())
+    batch_size = settings.STRAVA_SAVE_BATCH_SIZE
+    for i in range(0, len(results), batch_size) :
+        batch = results[i:i+batch_size]
+        replace_activities([build_strava_activity(r, the_user) for r in batch])
+        archive_payloads(the_user, batch)
         
 
 def get_strava_activity_type_list(user) :
@@ -102,8 +247,8 @@ def get_strava_activity_type_list(user) :
         try :
             su = user.stravauser
             if su.is_strava_verified and su.has_completed_initial_download :
-                all_acts = StravaActivity.objects.filter(site_user=user)
-                type_list = all_acts.values_list('sport_type', flat=True).distinct()
+                # Kept up to date as activities are saved (see refresh_activity_summary).
+                type_list = list(su.activity_types)
         except StravaUser.DoesNotExist as e :
             pass
     return type_list
@@ -127,8 +272,7 @@ def download_strava_data(request, start_from=None) :
         # Just in case, though, return an empty list.
         return []
     
-    # Here we need to get the user's access and refresh tokens from the DB.
-    # If access_token has expired, use the refresh_token to get the new access_token
+    # Make sure we have a good access token before we start.
     try :
         check_and_refresh_access_token(request.user)
     except requests.exceptions.RequestException as e :
@@ -136,15 +280,11 @@ def download_strava_data(request, start_from=None) :
         return []
     # Get the data
     page = 1
-    url = "https://www.strava.com/api/v3/activities"
+    url = settings.STRAVA_API_URL + "/activities"
     if not start_from :
         # We don't have a start_from date specified so create a Datetime
-        # object representing the beginning of time.
-        # Set the timezone to UTC
-        start_date = "January 1, 1970"
-        startDT = parser.parse(start_date)
-        timezone = pytz.timezone("UTC")
-        startDT = timezone.localize(startDT)
+        # object representing the beginning of time (in UTC).
+        startDT = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
     else :
         # We do have a start_from DateTime specified so we're good to go.
         startDT = start_from
@@ -157,11 +297,13 @@ def download_strava_data(request, start_from=None) :
         # There could be many many activities so get them a page at a time.        
         # We're going to get 200 at a time.
         #payload = {'access_token': su.access_token, 'after': start_stamp, 'per_page' : '200', 'page': str(page)}
-        payload = {'access_token': strava_login.extra_data['access_token'],
-                   'after': start_stamp, 'per_page' : '200',
-                   'page': str(page)}
         try:
-            r = requests.get(url, params = payload)
+            # A long download can outlast the token, so get it for each page.
+            # It comes from the token cache so this is cheap.
+            payload = {'access_token': get_strava_access_token(request.user),
+                       'after': start_stamp, 'per_page' : '200',
+                       'page': str(page)}
+            r = strava_api_get(url, payload)
         except requests.exceptions.RequestException as e:
             # Couldn't make the connection.
             # Return an empty list for now.
@@ -175,73 +317,182 @@ def download_strava_data(request, start_from=None) :
         # increment page.
         page += 1
 
+    if start_from :
+        # We may already have some of these, e.g. an activity that starts on the second we
+        # asked from. Take their old routes off before the new copies are drawn on.
+        remove_stored_routes(request.user, [r["id"] for r in results if r.get("id")])
     # Now that you have it all, save it.
     save_strava_data(results, request.user)
+    fetch_gear_names(request.user)
+    if not start_from :
+        finish_full_ingest(request.user)
+    else :
+        # After an update we only need to draw the new activities on top of the
+        # existing heatmap tiles and put them in route clusters.
+        add_polylines_to_heatmap(request.user, [(r.get("map") or {}).get("summary_polyline") for r in results])
+        assign_unclustered_activities(request.user)
+        su.has_completed_initial_download = True
+        su.downloading = False
+        su.save()
+        # Only the new activities can have brought new activity types.
+        add_pie_colors(request.user, [r.get("sport_type", "Unknown") for r in results])
+
+    # Have the pages they're about to look at ready for them.
+    queue_page_warming(request.user)
+    if not start_from :
+        messages.success(request, "Sucessfully downloaded!")
+    else :
+        messages.success(request, "Sucessfully updated! Found " + str(len(results)) + " new activities.")
+    
+
+
+def strava_api_get(url, params) :
+    """
+    Make a GET call to the Strava API, waiting and retrying if we hit the rate limit.
+
+    Args:
+        url (str): the API URL
+        params (dict): the query parameters
+
+    Returns:
+        Response: the last response we got
+    """
+    for attempt in range(settings.STRAVA_RATE_LIMIT_RETRIES + 1) :
+        r = requests.get(url, params=params)
+        if r.status_code != 429 or attempt == settings.STRAVA_RATE_LIMIT_RETRIES :
+            return r
+        wait = float(r.headers.get("Retry-After", settings.STRAVA_RATE_LIMIT_WAIT))
+        logger.warning("Hit the Strava rate limit. Retrying in " + str(wait) + " seconds.")
+        time.sleep(wait)
+
+
+def finish_full_ingest(user) :
+    """
+    Rebuild everything derived from a user's whole history after a full download or import.
+
+    Args:
+        user (User): the user whose data was just loaded
+    """
+    # Bring the user's heatmap tiles and route clusters up to date.
+    rebuild_user_heatmap(user)
+    cluster_user_routes(user)
+    su = user.stravauser
     # Indicate that the user has completed the initial download and that they are no longer downloading.
     # This will tell the index page that it should display some summary info about the user's data.
     su.has_completed_initial_download = True
     su.downloading = False
     # Update the user's pie chart color dictionary. The colors are based on the types of activities they user
     # has engaged in on Strava.
-    su.pie_color_palette = compute_pie_colors(request.user)
+    su.pie_color_palette = compute_pie_colors(user)
     su.save()
+    bump_data_version(user)
 
-    if not start_from :
-        messages.success(request, "Sucessfully downloaded!")
-    else :
-        messages.success(request, "Sucessfully updated! Found " + str(len(results)) + " new activities.")
-    
+
+def fetch_gear_names(user) :
+    """
+    Look up the names of any of a user's gear we haven't named yet.
+
+    Names are only fetched once, so this usually makes no API calls at all. If Strava
+    can't be reached we try again the next time.
+
+    Args:
+        user (User): the owner of the gear
+    """
+    for gear_id in unnamed_gear_ids(user) :
+        try :
+            payload = {'access_token': get_strava_access_token(user)}
+            r = strava_api_get(settings.STRAVA_API_URL + "/gear/" + gear_id, payload)
+        except requests.exceptions.RequestException as e :
+            logger.warning("Couldn't get the name of gear " + gear_id + ": " + str(e))
+            return
+        if not r.ok :
+            logger.warning("Couldn't get the name of gear " + gear_id + ": " + str(r.status_code))
+            return
+        name_gear(user, gear_id, r.json().get("name") or gear_id)
 
 
 def check_and_refresh_access_token(user) :
     """
     Check if the user's Strava access token has expired and update it as needed.
 
+    See token_helpers.get_strava_access_token, which does the work.
+
     Args:
         user (User): The currently logged in User
+
+    Returns:
+        str: a good access token
     """
-    strava_soc = user.social_auth.get(provider='strava')
-    # See if the access token has expired.
-    logger.debug("Checking if we need new tokens")
-    if strava_soc.extra_data['expires_at'] < time.time():
-        logger.debug("We do.")
-        # It has expired.
-        # Make Strava auth API call with current refresh token
-        # and get the response that has the new token.
-        try :
-            response = requests.post(
-                url = 'https://www.strava.com/oauth/token',
-                data = {
-                    'client_id': settings.SOCIAL_AUTH_STRAVA_KEY,
-                    'client_secret': settings.SOCIAL_AUTH_STRAVA_SECRET,
-                    'grant_type': 'refresh_token',
-                    'refresh_token': strava_soc.extra_data['refresh_token']
-                }
-            )
-        except requests.exceptions.RequestException as e:
-            raise(e)
-        # Replace the old strava_tokens with the response.
-        tokens = response.json()
-        strava_soc.extra_data["token_type"] = tokens["token_type"]
-        strava_soc.extra_data["access_token"] = tokens['access_token']
-        strava_soc.extra_data["auth_time"] = time.time()
-        strava_soc.extra_data["expires_at"] = tokens['expires_at']
-        strava_soc.extra_data["expires"] = tokens['expires_in']
-        strava_soc.extra_data["refresh_token"] = tokens['refresh_token']
-        strava_soc.save()
-        logger.debug("new refresh token in strava_soc = " + strava_soc.extra_data["refresh_token"])
-        logger.debug("in tokens it is " + tokens["refresh_token"])
-        # stravauser.token_type = tokens["token_type"]
-        # stravauser.access_token = tokens['access_token']
-        # stravauser.expires_at = tokens['expires_at']
-        # stravauser.expires_in = tokens['expires_in']
-        # stravauser.refresh_token = tokens['refresh_token']
-        # stravauser.save()
+    return get_strava_access_token(user)
         
 
+# The first pie chart colors handed out. Users who have done seven or fewer
+# activity types only ever see these.
+PIE_DEFAULT_COLORS = [(54/255, 162/255, 235/255),(255/255, 99/255, 132/255), (255/255, 159/255, 64/255), (255/255, 205/255, 86/255),
+                      (75/255, 192/255, 192/255), (153/255, 102/255, 255/255), (201/255, 203/255, 207/255)]
+WHITE = (1.0, 1.0, 1.0)
+BLACK = (0.0, 0.0, 0.0)
+
+
+def _rgb_to_hex(c) :
+    return "#" + hex_val(c[0])+hex_val(c[1])+hex_val(c[2])
+
+
+def _hex_to_rgb(h) :
+    return tuple(int(h[i:i+2], 16)/255 for i in (1, 3, 5))
+
+
+@functools.lru_cache(maxsize=None)
+def pie_color_pool() :
+    """
+    Return the pool of distinct colors that pie chart colors are handed out from.
+
+    distinctipy is slow, so the pool is generated once per process. It's seeded
+    (settings.PIE_COLOR_POOL_SEED) so every process comes up with the same pool.
+
+    Returns:
+        tuple: hex colors, the default colors first
+    """
+    import distinctipy
+    # Don't include any of the the default colors or white and black.
+    extra = distinctipy.get_colors(settings.PIE_COLOR_POOL_SIZE - len(PIE_DEFAULT_COLORS), exclude_colors=PIE_DEFAULT_COLORS + [WHITE, BLACK],
+                                   pastel_factor=0.7, rng=settings.PIE_COLOR_POOL_SEED)
+    return tuple(_rgb_to_hex(c) for c in PIE_DEFAULT_COLORS + extra)
+
+
+def extend_pie_colors(palette, sport_types) :
+    """
+    Give each sport type that doesn't have a pie chart color yet the next unused color in the pool.
+
+    Types that already have a color keep it.
+
+    Args:
+        palette (dict): sport type to hex color
+        sport_types (iterable): sport types that need a color
+
+    Returns:
+        tuple: (the extended palette, whether anything was added)
+    """
+    new_types = sorted(set(sport_types) - set(palette))
+    if not new_types :
+        return palette, False
+    palette = dict(palette)
+    used = set(palette.values())
+    free = [c for c in pie_color_pool() if c not in used]
+    if len(free) < len(new_types) :
+        # More activity types than the pool has colors. That shouldn't happen, but make some more if it does.
+        import distinctipy
+        exclude_cols = [_hex_to_rgb(c) for c in used.union(pie_color_pool())] + [WHITE, BLACK]
+        extra = distinctipy.get_colors(len(new_types) - len(free), exclude_colors=exclude_cols, pastel_factor=0.7, rng=settings.PIE_COLOR_POOL_SEED)
+        free += [_rgb_to_hex(c) for c in extra]
+    for t, c in zip(new_types, free) :
+        palette[t] = c
+    return palette, True
+
+
 def compute_pie_colors(user) :
     """
-    Generate a dictionary of distinct colors representing each Strava Activity type the user has recorded.
+    Return the user's pie chart colors with a color for every Strava Activity type the user has recorded.
 
     Args:
         user (User): the logged in user
@@ -249,31 +500,30 @@ def compute_pie_colors(user) :
     Returns:
         dict : keys are activity types; values are colors
     """
-    # If the number of activities is less than or equal to the length of
-    # these default colors, just use them and don't generate any others.
-    default_colors = [(54/255, 162/255, 235/255),(255/255, 99/255, 132/255), (255/255, 159/255, 64/255), (255/255, 205/255, 86/255),
-                      (75/255, 192/255, 192/255), (153/255, 102/255, 255/255), (201/255, 203/255, 207/255)]
-    WHITE = (1.0, 1.0, 1.0)
-    BLACK = (0.0, 0.0, 0.0)
-    white_black = [WHITE, BLACK]
-    # If we need to generate new colors don't include any of the
-    # the default colors or white and black.
-    exclude_cols = default_colors + white_black
-    types = get_strava_activity_type_list(user)
-    n = len(types)
-    # The dict that we will return.
-    colors = {}
-    if n <= len(default_colors) :
-        # We can just use the default colors.
-        list_of_colors = default_colors
-    else :
-        # Use the default colors and add more as needed using distinctipy.
-        list_of_colors = default_colors + distinctipy.get_colors(n-len(default_colors), exclude_colors=exclude_cols, pastel_factor=0.7)
-    # Fill in the dictionary converting to hex as we go.
-    for i,t in enumerate(types) :
-        c = list_of_colors[i]
-        colors[t] = "#" + hex_val(c[0])+hex_val(c[1])+hex_val(c[2])
-    return colors
+    # Don't go through get_strava_activity_type_list. An imported history can
+    # exist before the user has connected to Strava.
+    types = StravaActivity.objects.filter(site_user=user).values_list('sport_type', flat=True).distinct()
+    palette, _ = extend_pie_colors(user.stravauser.pie_color_palette, types)
+    return palette
+
+
+def add_pie_colors(user, sport_types) :
+    """
+    Make sure the user's pie chart palette has a color for each of these activity types.
+
+    Unlike compute_pie_colors this doesn't look at the user's activities, so it's
+    cheap enough to call for every new activity. The palette is only saved if it changed.
+
+    Args:
+        user (User): the user whose palette it is
+        sport_types (iterable): activity types the user now has
+    """
+    su = user.stravauser
+    su.pie_color_palette, changed = extend_pie_colors(su.pie_color_palette, sport_types)
+    if changed :
+        su.save(update_fields=["pie_color_palette"])
+        # The cached pie charts have the old palette.
+        bump_data_version(user)
 
 
 def hex_val(y) :
@@ -307,6 +557,33 @@ def hex_val(y) :
     return l+r 
 
 
+def delete_in_chunks(qs, chunk_size=None) :
+    """
+    Delete the rows of a QuerySet chunk_size at a time, each chunk in its own transaction.
+
+    A plain delete() loads every row (and every row that points at them) into memory
+    and deletes them all in one transaction. This never holds more than one chunk of
+    primary keys and only locks a chunk of rows at a time. The rows are deleted with
+    straight DELETEs, so nothing may point at them and no delete signals are sent;
+    delete the rows that point at them first.
+
+    Args:
+        qs (QuerySet): the rows to delete
+        chunk_size (int, optional): rows per transaction. Defaults to settings.DELETE_CHUNK_SIZE.
+
+    Returns:
+        int: the number of rows deleted
+    """
+    chunk_size = chunk_size or settings.DELETE_CHUNK_SIZE
+    deleted = 0
+    while True :
+        with transaction.atomic(using=qs.db) :
+            pks = list(qs.order_by("pk").values_list("pk", flat=True)[:chunk_size])
+            if not pks :
+                return deleted
+            deleted += qs.model.objects.filter(pk__in=pks)._raw_delete(qs.db)
+
+
 def remove_user_strava_data(user, deauthorized_strava=False) :
     """
     Delete all of a user's stored Strava data and remove Strava authorization if the user has revoked access.
@@ -316,9 +593,17 @@ def remove_user_strava_data(user, deauthorized_strava=False) :
         deauthorized_strava (bool, optional): Flag stating if the user has revoked Strava access. Defaults to False.
     """
     
-    # Get all of this user's StavaActivities and delete them.
-    all_acts = StravaActivity.objects.filter(site_user=user)
-    all_acts.all().delete()
+    # Delete all of this user's StravaActivities a chunk at a time. The geohash cells point
+    # at the activities so they have to go first.
+    delete_in_chunks(ActivityGeoCell.objects.filter(site_user=user))
+    delete_in_chunks(StravaActivity.objects.filter(site_user=user))
+    delete_in_chunks(ActivityPayload.objects.filter(site_user=user))
+    Gear.objects.filter(site_user=user).delete()
+    delete_in_chunks(DailyTotal.objects.filter(site_user=user))
+    # No activities point at the clusters anymore.
+    RouteCluster.objects.filter(site_user=user).delete()
+    delete_user_heatmap(user)
+    refresh_activity_summary(user, removed_types=StravaUser.objects.get(user=user).activity_types)
     # Now indicate that the user hasn't completed the initial download.
     su = user.stravauser
     su.has_completed_initial_download = False
@@ -329,6 +614,7 @@ def remove_user_strava_data(user, deauthorized_strava=False) :
         soc = user.social_auth
         strava_soc = soc.get(provider='strava')
         strava_soc.delete()
+        forget_strava_token(user)
     su.save()
     
 def compute_metrics(acts_qs) :
@@ -414,43 +700,40 @@ def compute_metrics(acts_qs) :
         summary_dict["max_hr_date"] = ("#", "")
     return summary_dict
     
-def suggest_similar_activities(request, *, elev_gain=None, distance=None, dist_fudge=0.1, elev_fudge=0.1, metric=False, activity_type="Ride", 
-                               activity_title_key=None, time_fudge=0.1, elapsed_time=None, moving_time=None, start_date=None, end_date=None) :
+def filter_strava_activities(user, *, elev_gain=None, distance=None, dist_fudge=0.1, elev_fudge=0.1, metric=False, activity_type=None,
+                             activity_title_key=None, time_fudge=0.1, elapsed_time=None, moving_time=None, start_date=None, end_date=None,
+                             bbox=None, near=None) :
     """
-    Take an elevation gain and/or a distance and return a list of URLs of your past Strava activities
-    that have similar elevation gain and/or distance.
+    Return a QuerySet of a user's activities that meet the search criteria.
 
-    The fudge factors let you define the degree of similarity. The defaults are 0.1.
-    The default units are feet of elevation gain and miles of distance, but if you set
-    the metric flag to True, the units are meters of elevation gain and kilometers of
-    distance. Finally, the default activity is Ride. To specify a different activity type,
-    set the activity_type parameter to it. Just make sure you name it the same as Strava does.
+    This is the filtering behind suggest_similar_activities, so anything else that takes
+    the search form's criteria (like the export) selects the same activities. Any criterion
+    left as None is ignored. If bbox or near is given, the QuerySet only holds the candidates
+    from the spatial index and still has to go through refine_activities_by_area.
 
     Args:
-        request (HttpRequest): the request that brought us to the view that called this helper
+        user (User): the owner of the activities
         elev_gain (float, optional): the elevation gain you want a suggestion for. Defaults to None.
         distance (float, optional): the distance you want a suggestion for. Defaults to None.
         dist_fudge (float, optional): defines what it means for a ride to have a similar distance to another. Defaults to 0.1.
         elev_fudge (float, optional): defines what it means for a ride to have a similar elevation gain to another. Defaults to 0.1.
         metric (bool, optional): flag that specifies whether to use the metric system. Defaults to False.
-        activity_type (str, optional): the activity type that you are interested in. Defaults to "Ride".
+        activity_type (list, optional): the activity types that you are interested in. Defaults to None.
         activity_title_key (str, optional): title of the Strava activity. Defaults to None.
         time_fudge (float, optional): how similar in duration two activities are. Defaults to 0.1.
         elapsed_time (float, optional): elapsed time of activity. Defaults to None.
         moving_time (float, optional): moving time of activity. Defaults to None.
         start_date (DateTime, optional): date to start searching from. Defaults to None.
-        end_date (_type_, optional): date to end the search. Defaults to None.
+        end_date (DateTime, optional): date to end the search. Defaults to None.
+        bbox (tuple, optional): only activities whose route passes through this (south, west, north, east) box. Defaults to None.
+        near (tuple, optional): only activities whose route passes within (lat, lng, radius in meters). Defaults to None.
 
     Returns:
-        list: list of URL's to Strava activities
+        QuerySet: the matching StravaActivities
     """
     
     # Start with all of the user's activites. that are of this type.
-    acts_qs = StravaActivity.objects.filter(site_user=request.user)
-    # You need to have something to search for. Otherwise just return None.
-    if (not elev_gain and not distance and not activity_type and not activity_title_key
-        and not moving_time and not start_date and not end_date) :
-        return None
+    acts_qs = StravaActivity.objects.filter(site_user=user)
     if activity_type :
         acts_qs = acts_qs.filter(type__in=activity_type)
     # Search for the title keyword
@@ -478,24 +761,80 @@ def suggest_similar_activities(request, *, elev_gain=None, distance=None, dist_f
     if moving_time :
         acts_qs = acts_qs.filter(moving_time_min__gte=(moving_time - time_fudge*moving_time), moving_time_min__lte=(moving_time + time_fudge*moving_time))
     if start_date :
-        acts_qs = acts_qs.filter(start_date_local__date__gte=start_date)
+        acts_qs = acts_qs.filter(local_date__gte=start_date)
     if end_date :
-        acts_qs = acts_qs.filter(start_date_local__date__lte=end_date)
+        acts_qs = acts_qs.filter(local_date__lte=end_date)
+    # Use the spatial index to narrow things down to activities that might pass through
+    # the place and then check each of those against its actual route.
+    if bbox or near :
+        acts_qs = filter_activities_by_area(acts_qs, user, bbox=bbox, near=near)
+    return acts_qs
+
+# The StravaActivity fields a search result shows.
+SEARCH_RESULT_FIELDS = ["activity_id", "name", "distance_miles", "elev_gain_ft", "total_elevation_gain_m",
+                        "elapsed_time_min", "moving_time_min", "start_date_local"]
+
+def suggest_similar_activities(request, *, elev_gain=None, distance=None, dist_fudge=0.1, elev_fudge=0.1, metric=False, activity_type="Ride", 
+                               activity_title_key=None, time_fudge=0.1, elapsed_time=None, moving_time=None, start_date=None, end_date=None,
+                               bbox=None, near=None) :
+    """
+    Take an elevation gain and/or a distance and return a list of URLs of your past Strava activities
+    that have similar elevation gain and/or distance.
+
+    The fudge factors let you define the degree of similarity. The defaults are 0.1.
+    The default units are feet of elevation gain and miles of distance, but if you set
+    the metric flag to True, the units are meters of elevation gain and kilometers of
+    distance. Finally, the default activity is Ride. To specify a different activity type,
+    set the activity_type parameter to it. Just make sure you name it the same as Strava does.
+
+    Args:
+        request (HttpRequest): the request that brought us to the view that called this helper
+        elev_gain (float, optional): the elevation gain you want a suggestion for. Defaults to None.
+        distance (float, optional): the distance you want a suggestion for. Defaults to None.
+        dist_fudge (float, optional): defines what it means for a ride to have a similar distance to another. Defaults to 0.1.
+        elev_fudge (float, optional): defines what it means for a ride to have a similar elevation gain to another. Defaults to 0.1.
+        metric (bool, optional): flag that specifies whether to use the metric system. Defaults to False.
+        activity_type (str, optional): the activity type that you are interested in. Defaults to "Ride".
+        activity_title_key (str, optional): title of the Strava activity. Defaults to None.
+        time_fudge (float, optional): how similar in duration two activities are. Defaults to 0.1.
+        elapsed_time (float, optional): elapsed time of activity. Defaults to None.
+        moving_time (float, optional): moving time of activity. Defaults to None.
+        start_date (DateTime, optional): date to start searching from. Defaults to None.
+        end_date (_type_, optional): date to end the search. Defaults to None.
+        bbox (tuple, optional): only activities whose route passes through this (south, west, north, east) box. Defaults to None.
+        near (tuple, optional): only activities whose route passes within (lat, lng, radius in meters). Defaults to None.
+
+    Returns:
+        list: list of URL's to Strava activities
+    """
+    
+    # You need to have something to search for. Otherwise just return None.
+    if (not elev_gain and not distance and not activity_type and not activity_title_key
+        and not moving_time and not start_date and not end_date and not bbox and not near) :
+        return None
+    acts_qs = filter_strava_activities(request.user, elev_gain=elev_gain, distance=distance, dist_fudge=dist_fudge, elev_fudge=elev_fudge,
+                                       metric=metric, activity_type=activity_type, activity_title_key=activity_title_key,
+                                       time_fudge=time_fudge, elapsed_time=elapsed_time, moving_time=moving_time,
+                                       start_date=start_date, end_date=end_date, bbox=bbox, near=near)
+    # Only load the fields the results show, a chunk at a time.
+    names = SEARCH_RESULT_FIELDS + (ACTIVITY_TRACK_FIELDS if bbox or near else [])
+    acts = acts_qs.only(*names).iterator(chunk_size=settings.SEARCH_CHUNK_SIZE)
+    if bbox or near :
+        acts = (a for a in acts if activity_passes_through(a, bbox=bbox, near=near))
         
     results_list = []
-    if len(acts_qs) > 0 :
-        for a in acts_qs :
-            info = {}
-            info["id"] = (str(a.activity_id))
-            info["name"] = a.name
-            a_dist = '{:,}'.format(round(a.distance_miles,2)) + " miles" if not metric else '{:,}'.format(round(a.distance_miles,2)) + " km"
-            a_elev = '{:,}'.format(round(a.elev_gain_ft,2)) + " feet" if not metric else '{:,}'.format(round(a.total_elevation_gain_m,2)) + " m"
-            info["dist"] = a_dist
-            info["elev"] = a_elev
-            info["elapsed"] = '{:,}'.format(int(a.elapsed_time_min))
-            info["moving"] = '{:,}'.format(int(a.moving_time_min))
-            info["date"] = a.start_date_local
-            results_list.append(info)
+    for a in acts :
+        info = {}
+        info["id"] = (str(a.activity_id))
+        info["name"] = a.name
+        a_dist = '{:,}'.format(round(a.distance_miles,2)) + " miles" if not metric else '{:,}'.format(round(a.distance_miles,2)) + " km"
+        a_elev = '{:,}'.format(round(a.elev_gain_ft,2)) + " feet" if not metric else '{:,}'.format(round(a.total_elevation_gain_m,2)) + " m"
+        info["dist"] = a_dist
+        info["elev"] = a_elev
+        info["elapsed"] = '{:,}'.format(int(a.elapsed_time_min))
+        info["moving"] = '{:,}'.format(int(a.moving_time_min))
+        info["date"] = a.start_date_local
+        results_list.append(info)
     return results_list
 
 def get_monthly_charts_data(request, act_type, metric) :
@@ -531,41 +870,42 @@ def get_monthly_charts_data(request, act_type, metric) :
     
     acts_qs = StravaActivity.objects.filter(site_user=request.user)
     acts_qs = acts_qs.filter(sport_type=act_type)
-    start_year = acts_qs.aggregate(Min("start_date")).get("start_date__min").year
-    end_year = acts_qs.aggregate(Max("start_date")).get("start_date__max").year
+    years_range = acts_qs.aggregate(Min("local_year"), Max("local_year"))
+    start_year = years_range["local_year__min"]
+    end_year = years_range["local_year__max"]
     labels = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
     # For each year sum the metric in question in each month
     datasets = []
     years = []
     for y in range(start_year, end_year+1) :
         years.append(y)
-        qs = acts_qs.filter(start_date__year=y)
+        qs = acts_qs.filter(local_year=y)
         if metric == "distance" :
             if request.user.stravauser.preferred_units == "imperial" :
-                qs = qs.values("start_date__month").annotate(miles_per_month=Sum('distance_miles'))
+                qs = qs.values("local_month").annotate(miles_per_month=Sum('distance_miles'))
             else :
-                qs = qs.values("start_date__month").annotate(km_per_month=Sum('distance_km'))
+                qs = qs.values("local_month").annotate(km_per_month=Sum('distance_km'))
         elif metric == "moving_time" :
-            qs = qs.values("start_date__month").annotate(time_per_month=Sum('moving_time_sec'))
+            qs = qs.values("local_month").annotate(time_per_month=Sum('moving_time_sec'))
         elif metric == "elevation_gain" :
             if request.user.stravauser.preferred_units == "imperial" :
-                qs = qs.values("start_date__month").annotate(feet_per_month=Sum('elev_gain_ft'))
+                qs = qs.values("local_month").annotate(feet_per_month=Sum('elev_gain_ft'))
             else :
-                qs = qs.values("start_date__month").annotate(meters_per_month=Sum('total_elevation_gain_m'))
+                qs = qs.values("local_month").annotate(meters_per_month=Sum('total_elevation_gain_m'))
         y_data_dict = {}
         for q in qs :
             if metric == "distance" :
                 if request.user.stravauser.preferred_units == "imperial" :
-                    y_data_dict[q["start_date__month"]] = round(q['miles_per_month'],0)
+                    y_data_dict[q["local_month"]] = round(q['miles_per_month'],0)
                 else :
-                    y_data_dict[q["start_date__month"]] = round(q['km_per_month'],0)
+                    y_data_dict[q["local_month"]] = round(q['km_per_month'],0)
             elif metric == "moving_time" :
-                y_data_dict[q["start_date__month"]] = round(q['time_per_month']/3600,0)
+                y_data_dict[q["local_month"]] = round(q['time_per_month']/3600,0)
             elif metric == "elevation_gain" :
                 if request.user.stravauser.preferred_units == "imperial" :
-                    y_data_dict[q["start_date__month"]] = round(q['feet_per_month'],0)
+                    y_data_dict[q["local_month"]] = round(q['feet_per_month'],0)
                 else :
-                    y_data_dict[q["start_date__month"]] = round(q['meters_per_month'],0)
+                    y_data_dict[q["local_month"]] = round(q['meters_per_month'],0)
         y_data = [y_data_dict[m] if m in y_data_dict else 0 for m in range(1,13) ]            
         datasets.append(y_data)    
     return JsonResponse(data={
@@ -608,8 +948,9 @@ def get_annual_chart_data(request, act_type, metric) :
     
     acts_qs = StravaActivity.objects.filter(site_user=request.user)
     acts_qs = acts_qs.filter(sport_type=act_type)
-    start_year = acts_qs.aggregate(Min("start_date")).get("start_date__min").year
-    end_year = acts_qs.aggregate(Max("start_date")).get("start_date__max").year
+    years_range = acts_qs.aggregate(Min("local_year"), Max("local_year"))
+    start_year = years_range["local_year__min"]
+    end_year = years_range["local_year__max"]
     labels = [ str(y) for y in range(start_year, end_year+1)]
     data_label = "Year"
     # For each year sum the metric in question 
@@ -617,17 +958,17 @@ def get_annual_chart_data(request, act_type, metric) :
     data = []
     if metric == "distance" :
         if request.user.stravauser.preferred_units == "imperial" :
-            acts_qs = acts_qs.values("start_date__year").annotate(metric_per_year=Sum('distance_miles')).order_by('start_date__year')
+            acts_qs = acts_qs.values("local_year").annotate(metric_per_year=Sum('distance_miles')).order_by('local_year')
         else :
-            acts_qs = acts_qs.values("start_date__year").annotate(metric_per_year=Sum('distance_km')).order_by('start_date__year')
+            acts_qs = acts_qs.values("local_year").annotate(metric_per_year=Sum('distance_km')).order_by('local_year')
     elif metric == "moving_time" :
-        acts_qs = acts_qs.values("start_date__year").annotate(metric_per_year=Sum('moving_time_sec')/3600).order_by('start_date__year')
+        acts_qs = acts_qs.values("local_year").annotate(metric_per_year=Sum('moving_time_sec')/3600).order_by('local_year')
         logger.debug("here's the dict: " + str(acts_qs))
     elif metric == "elevation_gain" :
         if request.user.stravauser.preferred_units == "imperial" :
-            acts_qs = acts_qs.values("start_date__year").annotate(metric_per_year=Sum('elev_gain_ft')).order_by('start_date__year')
+            acts_qs = acts_qs.values("local_year").annotate(metric_per_year=Sum('elev_gain_ft')).order_by('local_year')
         else :
-            acts_qs = acts_qs.values("start_date__year").annotate(metric_per_year=Sum('total_elevation_gain_m')).order_by('start_date__year')
+            acts_qs = acts_qs.values("local_year").annotate(metric_per_year=Sum('total_elevation_gain_m')).order_by('local_year')
 
     for a in acts_qs :
         data.append(a['metric_per_year'])
@@ -643,6 +984,93 @@ def get_annual_chart_data(request, act_type, metric) :
         'color': color
     })        
 
+def ytd_cumulative(dates, values, years, step=1, through=None) :
+    """
+    Turn daily totals into each year's running total by day of the year.
+
+    The days go into a dense days by years matrix, which is cumulatively summed down
+    each year in one go. Every year is laid out on a leap year calendar (non leap years
+    just have nothing on Feb 29) so the same date lines up across years.
+
+    Args:
+        dates (list): the dates (datetime.date) with any total, each at most once
+        values (list): the total on each date
+        years (list): the years to include, consecutive and in order
+        step (int, optional): keep every step-th day (and Dec 31). Defaults to 1.
+        through (date, optional): leave the running total of this date's year blank after it. Defaults to None.
+
+    Returns:
+        tuple: (the kept days as day of a leap year from 0, matrix of running totals with a row per kept day and
+               a column per year; nan where it's blank)
+    """
+    import numpy as np
+    days = np.arange(0, 366, step)
+    if days[-1] != 365 :
+        days = np.append(days, 365)
+    totals = np.zeros((366, len(years)))
+    if len(dates) :
+        # Going through ordinals is much quicker than having NumPy convert date objects.
+        epoch = datetime.date(1970, 1, 1).toordinal()
+        d = (np.fromiter((x.toordinal() for x in dates), dtype=np.int64, count=len(dates)) - epoch).astype("datetime64[D]")
+        year_start = d.astype("datetime64[Y]")
+        y = year_start.astype(int) + 1970
+        doy = (d - year_start).astype(int)
+        leap = (y % 4 == 0) & ((y % 100 != 0) | (y % 400 == 0))
+        doy += (~leap) & (doy >= 59)
+        totals[doy, y - years[0]] = values
+    cumulative = np.cumsum(totals, axis=0)
+    if through is not None and years and years[0] <= through.year <= years[-1] :
+        doy = through.timetuple().tm_yday - 1
+        if not calendar.isleap(through.year) and doy >= 59 :
+            doy += 1
+        cumulative[doy + 1:, through.year - years[0]] = np.nan
+    return days, cumulative[days]
+
+def get_ytd_chart_data(request, act_type, metric, step=None) :
+    """
+    Produce data for the year to date cumulative chart, with a line for each year.
+
+    Args:
+        request (HttpRequest): the request that brought us here
+        act_type (str): name of Strava activity
+        metric (str): the metric we will be charting (distance, elevation gain, moving time)
+        step (int, optional): days between points. Defaults to settings.YTD_CHART_STEP.
+
+    Returns:
+        JsonResponse: JsonResponse containing the chart data
+    """
+    step = step or settings.YTD_CHART_STEP
+    imperial = request.user.stravauser.preferred_units == "imperial"
+    title_text = "Year to Date " + act_type + " " + metric.replace("_", " ").title() + " Comparison"
+    if metric == "distance" :
+        total, scale_title = (Sum("distance_miles"), "Miles") if imperial else (Sum("distance_km"), "KM")
+    elif metric == "moving_time" :
+        total, scale_title = Sum("moving_time_sec") / 3600.0, "Hours"
+    elif metric == "elevation_gain" :
+        total, scale_title = (Sum("elev_gain_ft"), "Feet") if imperial else (Sum("total_elevation_gain_m"), "Meters")
+    else :
+        raise ValueError("Unknown metric " + metric)
+    # One grouped query for the daily totals of the whole history.
+    daily = (StravaActivity.objects.filter(site_user=request.user, sport_type=act_type)
+             .values("local_date").annotate(total=total).order_by().values_list("local_date", "total"))
+    dates, values = zip(*daily) if daily else ((), ())
+    years = list(range(min(dates).year, max(dates).year + 1)) if dates else []
+    days, cumulative = ytd_cumulative(dates, values, years, step, through=datetime.date.today())
+    labels = []
+    for day in days.tolist() :
+        d = datetime.date(2000, 1, 1) + datetime.timedelta(days=day)
+        labels.append(d.strftime("%b ") + str(d.day))
+    # Round in bulk and turn the blanks into nulls.
+    rounded = cumulative.round(1).T.tolist()
+    datasets = [[None if v != v else v for v in row] for row in rounded]
+    return JsonResponse(data={
+        'labels': labels,
+        'datasets' : datasets,
+        'years' : years,
+        'title_text' : title_text,
+        'scale_title' : scale_title + " so far this year",
+    })
+
 def get_base_context(request) :
     """
     Return a dictionary with some basic context info that every page needs.
@@ -675,7 +1103,7 @@ def get_base_context(request) :
 #         raise(e)
     
 #     page = 1
-#     url = "https://www.strava.com/api/v3/activities"
+#     url = settings.STRAVA_API_URL + "/activities"
 #     if not start_from :
 #         # Parse the start date by parsing it into a Datetime object.
 #         # Set the timezone to UTC
@@ -725,7 +1153,7 @@ def send_strava_webhook_subscription_request() :
     """Send a webhood subscription to Strava.
     """
 
-    subscribe_url = "https://www.strava.com/api/v3/push_subscriptions"
+    subscribe_url = settings.STRAVA_API_URL + "/push_subscriptions"
     callback_url = settings.STRAVA_CB_URL
     verify_token = settings.STRAVA_SUB_VERIFY_TOKEN
     payload = {'client_id': settings.SOCIAL_AUTH_STRAVA_KEY,
@@ -750,6 +1178,97 @@ def send_strava_webhook_subscription_request() :
             sub.sub_id = r["id"]
             sub.save()
             
+def remove_stored_routes(site_user, activity_ids, heatmap=True) :
+    """
+    Take the routes of activities we have stored off the user's heatmap and out of their
+    route clusters. Call this before saving new copies of activities we may already have,
+    so they aren't counted twice.
+
+    Args:
+        site_user (User): the owner of the activities
+        activity_ids (list): Strava ids of the activities. Ones we don't have are ignored.
+        heatmap (bool, optional): take them off the heatmap too. Defaults to True. Pass False
+            to do that later with the polylines this returns.
+
+    Returns:
+        list: the summary polylines of the stored activities
+    """
+    old = list(StravaActivity.objects.filter(site_user=site_user, activity_id__in=activity_ids)
+               .values_list("summary_polyline", "route_cluster_id"))
+    if heatmap :
+        add_polylines_to_heatmap(site_user, [p for p, _ in old], sign=-1)
+    for _, cluster_id in old :
+        remove_activity_from_cluster(cluster_id)
+    return [p for p, _ in old]
+
+
+def store_webhook_activity(site_user, r) :
+    """
+    Save an activity we fetched because a webhook told us about it, replacing any copy
+    we had, and put it in a route cluster. This is only the database work. The gear names
+    and heatmap are left to the caller (see save_webhook_activity).
+
+    Args:
+        site_user (User): the owner of the activity
+        r (dict): the activity as the Strava API returned it
+
+    Returns:
+        tuple: (the old copy's polylines to take off the heatmap, the polylines to add), or
+            None if the activity wasn't saved
+    """
+    logger.debug("Got the new activity with dict = " + str(r))
+    if not r.get("id") :
+        logger.debug("Handling still got a null id. Not saving the activity.")
+        return None
+    # If we already had this activity, take its old route out before adding the new one.
+    removed = remove_stored_routes(site_user, [r["id"]], heatmap=False)
+    sa = save_strava_activity(r, site_user)
+    assign_activity_to_cluster(sa)
+    # This may be an activity type we haven't seen before, so it may need a pie chart color.
+    add_pie_colors(site_user, [sa.sport_type])
+    return removed, [sa.summary_polyline]
+
+
+def save_webhook_activity(site_user, r) :
+    """
+    Save an activity we fetched because a webhook told us it was created.
+
+    Args:
+        site_user (User): the owner of the activity
+        r (dict): the activity as the Strava API returned it
+    """
+    stored = store_webhook_activity(site_user, r)
+    if stored is None :
+        return
+    removed, added = stored
+    fetch_gear_names(site_user)
+    add_polylines_to_heatmap(site_user, removed, sign=-1)
+    add_polylines_to_heatmap(site_user, added)
+    queue_page_warming(site_user)
+
+
+def delete_strava_activity(site_user, activity_id) :
+    """
+    Delete an activity that was deleted at Strava, along with everything derived from it.
+
+    Args:
+        site_user (User): the owner of the activity
+        activity_id (int): the Strava id of the activity
+    """
+    try :
+        act = StravaActivity.objects.get(site_user=site_user, activity_id=activity_id)
+    except StravaActivity.DoesNotExist as e :
+        # If the activity does not exit, log it, but don't worry.
+        logger.debug("Tried to delete an activity that doesn't exist.")
+    else :
+        # Delete the activity and take it off the heatmap.
+        act.delete()
+        update_rollups(site_user, removed=[rollup_row(act)])
+        add_polylines_to_heatmap(site_user, [act.summary_polyline], sign=-1)
+        remove_activity_from_cluster(act.route_cluster_id)
+    forget_payload(site_user, activity_id)
+
+
 def async_handle(event) :
     """
     Handle a webhook event in a separate thread (started in the calling function).
@@ -769,8 +1288,10 @@ def async_handle(event) :
                                 # (activity visibility set to Followers Only or Everyone). For app deauthorization events,
                                 # there is always an "authorized" : "false" key-value pair.
     # Check if any of those are None
-    u_id = UserSocialAuth.objects.filter(provider="strava", uid=owner_id)[0].user_id
-    site_user = User.objects.filter(id=u_id)[0]
+    site_user = get_webhook_owner(owner_id)
+    if site_user is None :
+        logger.debug("Got a webhook for athlete " + str(owner_id) + " who isn't one of our users.")
+        return
     
     # Deal with activities 
     if object_type == "activity" :
@@ -780,28 +1301,17 @@ def async_handle(event) :
             logger.debug("New event created at Strava")
             # Get the new activity.
             try:
-                check_and_refresh_access_token(site_user)
-                # We need to get the social auth info after checking the access token.
-                # Otherwise, it might have stale data.
-                strava_login = site_user.social_auth.get(provider='strava')
-                url = "https://www.strava.com/api/v3/activities/"+str(object_id)
-                payload = {'access_token': strava_login.extra_data["access_token"]}
-                r = requests.get(url, params = payload)
+                access_token = check_and_refresh_access_token(site_user)
+                url = settings.STRAVA_API_URL + "/activities/"+str(object_id)
+                payload = {'access_token': access_token}
+                r = strava_api_get(url, payload)
             except requests.exceptions.RequestException as e:
                 raise(e)
-            r = r.json()
-            logger.debug("Got the new activity with dict = " + str(r))
-            if not r.get("id") :
-                logger.debug("Handling still got a null id. Not saving the activity.")
-            else :
-                save_strava_activity(r, site_user)
-                # Also need to recompute pie chart colors because we may be
-                # downloading an activity we haven't seen before.
-                site_user.stravauser.pie_color_palette = compute_pie_colors(site_user)
-                site_user.stravauser.save()
+            save_webhook_activity(site_user, r.json())
         elif aspect_type == "update" :
             logger.debug("update to existing event")
             act = StravaActivity.objects.get(site_user=site_user, activity_id=object_id)
+            before = rollup_row(act)
             if updates.get("title") :
                 # Get the currently saved version of this activity
                 act.name=updates["title"]
@@ -809,16 +1319,17 @@ def async_handle(event) :
                 act.type=updates["type"]
                 act.sport_type=updates["type"]
             act.save()
+            # A new sport type moves the activity to another of its day's totals.
+            update_rollups(site_user, [before], [rollup_row(act)])
+            update_archived_payload(site_user, object_id, {"name" : act.name, "type" : act.type, "sport_type" : act.sport_type})
+            if updates.get("type") :
+                # Route clusters are per sport type so the activity may belong in a different one now.
+                remove_activity_from_cluster(act.route_cluster_id)
+                assign_activity_to_cluster(act)
+                add_pie_colors(site_user, [act.sport_type])
         elif aspect_type == "delete" :
             logger.debug("deleting existing activity")
-            try :
-                act = StravaActivity.objects.get(site_user=site_user, activity_id=object_id)
-            except StravaActivity.DoesNotExist as e :
-                # If the activity does not exit, log it, but don't worry.
-                logger.debug("Tried to delete an activity that doesn't exist.")
-            else :
-                # Delete the activity
-                act.delete()
+            delete_strava_activity(site_user, object_id)
     elif object_type == "athlete" :
         if aspect_type == "update" :
             logger.debug("Got an athlete update webhook")
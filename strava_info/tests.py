@@ -1,3 +1,1281 @@
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from unittest import mock
+from .models import StravaActivity
+from .routers import ReplicaRouter, start_routing, end_routing, REPLICA_DATABASE
+from .strava_helpers import ytd_cumulative, build_strava_activity
+from .page_cache_helpers import page_cache_key, bump_data_version, cache_page_per_user, queue_page_warming
+from .models import StravaUser
+from django.contrib.auth.models import User
+from .reconcile_helpers import month_windows, reconcile_user
+from django.db.migrations.executor import MigrationExecutor
+from .export_helpers import export_fields, parquet_type, parquet_schema, parquet_available, stream_activities_csv, stream_activities_parquet, EXPORT_EXCLUDED_FIELDS
+import csv
+from .heatmap_helpers import add_polylines_to_heatmap, heatmap_dir, _tile_lock, HEATMAP_LOCK_NAMESPACE
+from .strava_helpers import save_strava_activity, save_strava_data, remove_stored_routes, delete_strava_activity, async_handle
+from .route_helpers import assign_activity_to_cluster, cluster_user_routes, remove_activity_from_cluster
+from .bench_helpers import make_synthetic_activity, parse_sport_mix, create_synthetic_athlete
+from .models import RouteCluster, DailyTotal
+from .forms import StravaExportUploadForm
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.cache import cache
+from social_django.models import UserSocialAuth
+from .token_helpers import get_strava_access_token, forget_strava_token
+from .webhook_helpers import get_webhook_owner
+from .partition_helpers import partition_activities, get_partition_strategy, list_partitions
+from .models import ActivityGeoCell
+from .geo_helpers import decode_polyline, encode_polyline, latlng_to_geo_grid, geohash_from_grid, track_geohash_cells
+from .spatial_helpers import filter_activities_by_area, refine_activities_by_area
+from .bulk_import_helpers import export_row_to_result, parse_export_track, import_strava_export
+import gzip
+import struct
+from django.db import connection, connections, close_old_connections
+from django.core.signals import request_finished
+from django.test.utils import CaptureQueriesContext
+from .middleware import ViewMetrics, RequestMetricsMiddleware
+import asyncio
+import time
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+import threading
+import warnings
+from django.http import HttpResponse, StreamingHttpResponse
+from asgiref.sync import sync_to_async
+from django.test import RequestFactory
+import datetime
+import math
+import subprocess
+import tempfile
+import zipfile
+import io
+import random
+import sys
+import os
+from django.contrib.messages.storage.cookie import CookieStorage
+from .fake_strava import FakeStravaServer
+from .strava_helpers import download_strava_data, pie_color_pool, extend_pie_colors, add_pie_colors, delete_in_chunks, remove_user_strava_data, suggest_similar_activities, store_webhook_activity
+from .strava_client import AsyncStravaClient
+from .models import ActivityPayload, Gear
+from .payload_helpers import compress_payload, decompress_payload, update_archived_payload, forget_payload
+from .rederive_helpers import rederive_activities
+from django.db.models import Count, Sum
 
-# Create your tests here.
+# Modules that are slow to import and only needed on some code paths, so a
+# worker shouldn't load them just to boot.
+DEFERRED_MODULES = ["numpy", "PIL", "distinctipy", "httpx", "dateutil", "pytz"]
+
+# Generous ceiling on the total time (in ms) it takes to import the URLconf,
+# so a new top level import of something heavy gets noticed.
+STARTUP_IMPORT_BUDGET_MS = 1500
+
+
+def profile_startup_imports() :
+    """
+    Import the URLconf in a fresh interpreter under -X importtime.
+
+    Returns:
+        dict: module name -> self import time in microseconds
+    """
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get("DJANGO_SETTINGS_MODULE", "fitnessapp.settings"))
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import django; django.setup(); import fitnessapp.urls"],
+        cwd=settings.BASE_DIR, env=env, capture_output=True, text=True, check=True
+    )
+    times = {}
+    for line in proc.stderr.splitlines() :
+        # Lines look like "import time:       123 |        456 |   module.name"
+        if not line.startswith("import time:") or "self [us]" in line :
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(self_us)
+    return times
+
+
+class StartupImportTests(SimpleTestCase) :
+    @classmethod
+    def setUpClass(cls) :
+        super().setUpClass()
+        cls.import_times = profile_startup_imports()
+
+    def test_heavy_modules_are_deferred(self) :
+        for module in DEFERRED_MODULES :
+            with self.subTest(module=module) :
+                self.assertNotIn(module, self.import_times)
+
+    def test_startup_import_budget(self) :
+        total_ms = sum(self.import_times.values()) / 1000
+        self.assertLess(total_ms, STARTUP_IMPORT_BUDGET_MS)
+
+
+class ReplicaRouterTests(SimpleTestCase) :
+    def setUp(self) :
+        self.router = ReplicaRouter()
+        # Any stand in will do, the router only looks for the alias.
+        patcher = mock.patch.dict(settings.DATABASES, {REPLICA_DATABASE : settings.DATABASES["default"]})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def routed_read(self, model, use_replica, wrote=False) :
+        state, token = start_routing()
+        try :
+            state["use_replica"] = use_replica
+            if wrote :
+                self.router.db_for_write(model)
+            return self.router.db_for_read(model)
+        finally :
+            end_routing(token)
+
+    def test_analytics_reads_use_replica(self) :
+        self.assertEqual(self.routed_read(StravaActivity, True), REPLICA_DATABASE)
+
+    def test_other_reads_use_primary(self) :
+        self.assertEqual(self.routed_read(StravaActivity, False), "default")
+        self.assertEqual(self.routed_read(Session, True), "default")
+        # Outside a request, e.g. in a download thread.
+        self.assertEqual(self.router.db_for_read(StravaActivity), "default")
+
+    def test_reads_after_write_use_primary(self) :
+        self.assertEqual(self.routed_read(StravaActivity, True, wrote=True), "default")
+
+
+class YtdCumulativeTests(SimpleTestCase) :
+    def test_running_totals_line_up_by_date(self) :
+        dates = [datetime.date(2019, 1, 1), datetime.date(2019, 3, 1), datetime.date(2020, 2, 29), datetime.date(2020, 3, 1)]
+        days, cumulative = ytd_cumulative(dates, [1.0, 2.0, 4.0, 8.0], [2019, 2020])
+        self.assertEqual(len(days), 366)
+        # Mar 1 is day 60 of the leap year calendar in both years.
+        self.assertEqual(cumulative[59].tolist(), [1.0, 4.0])
+        self.assertEqual(cumulative[60].tolist(), [3.0, 12.0])
+        self.assertEqual(cumulative[-1].tolist(), [3.0, 12.0])
+
+    def test_step_and_through(self) :
+        days, cumulative = ytd_cumulative([datetime.date(2021, 1, 1)], [5.0], [2020, 2021], step=7,
+                                          through=datetime.date(2021, 1, 10))
+        self.assertEqual(days.tolist()[:3], [0, 7, 14])
+        self.assertEqual(days.tolist()[-1], 365)
+        self.assertEqual(cumulative[1].tolist(), [0.0, 5.0])
+        self.assertTrue(math.isnan(cumulative[2][1]))
+        self.assertEqual(cumulative[2][0], 0.0)
+
+
+class PageCacheTests(SimpleTestCase) :
+    def setUp(self) :
+        su = mock.Mock(pk=1, data_version=0, is_strava_verified=True, downloading=False, has_completed_initial_download=True,
+                       preferred_units="imperial")
+        self.user = mock.Mock(id=-1, username="cache-test", first_name="", is_authenticated=True, is_superuser=False, stravauser=su)
+        self.request = RequestFactory().get("/")
+        self.request.user = self.user
+        self.renders = 0
+
+    def view(self, request, act_type) :
+        self.renders += 1
+        return HttpResponse("page " + str(self.renders))
+
+    def test_key_follows_data_and_units(self) :
+        key = page_cache_key(self.request, "view", ("Ride",), {})
+        self.assertEqual(key, page_cache_key(self.request, "view", ("Ride",), {}))
+        self.assertNotEqual(key, page_cache_key(self.request, "view", ("Run",), {}))
+        self.user.stravauser.data_version += 1
+        bumped = page_cache_key(self.request, "view", ("Ride",), {})
+        self.assertNotEqual(key, bumped)
+        self.user.stravauser.preferred_units = "metric"
+        self.assertNotEqual(bumped, page_cache_key(self.request, "view", ("Ride",), {}))
+
+    def test_superusers_and_posts_arent_cached(self) :
+        post = RequestFactory().post("/")
+        post.user = self.user
+        self.assertIsNone(page_cache_key(post, "view", (), {}))
+        self.user.is_superuser = True
+        self.assertIsNone(page_cache_key(self.request, "view", (), {}))
+
+    def test_warm_requests_skip_the_view(self) :
+        view = cache_page_per_user(self.view)
+        self.assertEqual(view(self.request, "Ride").content, b"page 1")
+        self.assertEqual(view(self.request, "Ride").content, b"page 1")
+        self.user.stravauser.data_version += 1
+        self.assertEqual(view(self.request, "Ride").content, b"page 2")
+
+    def test_one_warm_up_per_burst(self) :
+        with mock.patch("strava_info.page_cache_helpers.threading.Timer") as timer, \
+             mock.patch("strava_info.page_cache_helpers.shared_cache_configured", return_value=True) :
+            queued = [queue_page_warming(self.user) for i in range(20)]
+        self.assertEqual(queued, [True] + [False] * 19)
+        self.assertEqual(timer.call_count, 1)
+
+    def test_no_warming_without_a_shared_cache(self) :
+        with mock.patch("strava_info.page_cache_helpers.threading.Timer") as timer :
+            self.assertFalse(queue_page_warming(self.user))
+        timer.assert_not_called()
+
+
+class DataVersionTests(TestCase) :
+    def test_saving_a_stale_profile_keeps_the_version(self) :
+        user = User.objects.create_user(username="version-test")
+        StravaUser.objects.create(user=user)
+        su = StravaUser.objects.get(user=user)
+        bump_data_version(user)
+        bump_data_version(user)
+        su.preferred_units = "metric"
+        su.save()
+        su.refresh_from_db()
+        self.assertEqual((su.data_version, su.preferred_units), (2, "metric"))
+
+
+class GearBackfillTests(TransactionTestCase) :
+    def setUp(self) :
+        cache.clear()
+        self.server = FakeStravaServer(40, seed=5).__enter__()
+        self.addCleanup(self.server.__exit__)
+        override = self.settings(STRAVA_API_URL=self.server.api_url, STRAVA_OAUTH_URL=self.server.oauth_url,
+                                 HEATMAP_TILE_DIR=tempfile.mkdtemp())
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def migrate(self, targets) :
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def test_reconcile_fills_in_gear_saved_before_the_migration(self) :
+        latest = MigrationExecutor(connection).loader.graph.leaf_nodes("strava_info")
+        old_apps = self.migrate([("strava_info", "0006_activity_payloads")])
+        self.addCleanup(self.migrate, latest)
+        # Activities downloaded before gear existed, with nothing in the payload archive.
+        user = User.objects.create_user(username="gear-backfill")
+        old_apps.get_model("strava_info", "StravaUser").objects.create(user_id=user.id, is_strava_verified=True,
+                                                                       has_completed_initial_download=True)
+        OldActivity = old_apps.get_model("strava_info", "StravaActivity")
+        fields = [f.attname for f in OldActivity._meta.concrete_fields if not f.primary_key]
+        OldActivity.objects.bulk_create([OldActivity(**{f : getattr(sa, f) for f in fields})
+                                         for sa, _ in (build_strava_activity(a, user) for _, a in self.server.activities.values())])
+        self.migrate(latest)
+        # The migration can't know the gear, so it doesn't make any up.
+        self.assertFalse(Gear.objects.filter(site_user=user).exists())
+        token = self.server.issue_token()
+        UserSocialAuth.objects.create(user=user, provider="strava", uid="5001",
+                                      extra_data=dict(token, auth_time=int(time.time()), expires=token["expires_in"]))
+        report = reconcile_user(User.objects.get(pk=user.pk), 500)
+        self.assertEqual(report["saved"], len(self.server.activities))
+        expected = {}
+        for _, a in self.server.activities.values() :
+            if a.get("gear_id") :
+                expected[a["gear_id"]] = expected.get(a["gear_id"], 0) + 1
+        self.assertEqual(dict(Gear.objects.filter(site_user=user).values_list("gear_id", "activity_count")), expected)
+        self.assertEqual(ActivityPayload.objects.filter(site_user=user).count(), len(self.server.activities))
+
+
+class ReconcileTests(SimpleTestCase) :
+    def test_month_windows(self) :
+        utc = datetime.timezone.utc
+        windows = month_windows(datetime.datetime(2022, 11, 15, tzinfo=utc), datetime.datetime(2023, 2, 1, tzinfo=utc))
+        self.assertEqual([(start.date().isoformat(), end.date().isoformat()) for start, end in windows],
+                         [("2023-02-01", "2023-03-01"), ("2023-01-01", "2023-02-01"), ("2022-12-01", "2023-01-01"), ("2022-11-01", "2022-12-01")])
+
+    def test_runs_take_turns_through_older_months(self) :
+        utc = datetime.timezone.utc
+        user = mock.Mock(stravauser=mock.Mock(reconcile_cursor=None))
+        checked = []
+
+        def check(user, start, end, calls_left) :
+            checked.append(start.strftime("%Y-%m"))
+            return {"api_calls" : 1, "checked" : True, "differed" : False, "saved" : 0, "deleted" : 0}
+
+        with mock.patch("strava_info.reconcile_helpers.reconcile_window", check), \
+             mock.patch("strava_info.reconcile_helpers.StravaActivity") as acts, \
+             mock.patch("strava_info.reconcile_helpers.timezone.now", return_value=datetime.datetime(2023, 6, 10, tzinfo=utc)), \
+             self.settings(RECONCILE_RECENT_MONTHS=2) :
+            acts.objects.filter.return_value.aggregate.return_value = {"start_date__min" : datetime.datetime(2023, 1, 3, tzinfo=utc)}
+            runs = []
+            for i in range(3) :
+                checked.clear()
+                reconcile_user(user, 4)
+                runs.append(list(checked))
+        self.assertEqual(runs, [["2023-06", "2023-05", "2023-04", "2023-03"],
+                                ["2023-06", "2023-05", "2023-02", "2023-01"],
+                                ["2023-06", "2023-05", "2023-04", "2023-03"]])
+
+
+class ParquetSchemaTests(SimpleTestCase) :
+    def test_every_exported_field_has_a_type(self) :
+        pa = mock.Mock()
+        for f in export_fields() :
+            self.assertIsNotNone(parquet_type(f, pa), f.name)
+
+    def test_dates_and_times(self) :
+        pa = mock.Mock()
+        fields = {f.name : f for f in export_fields()}
+        self.assertIs(parquet_type(fields["local_date"], pa), pa.date32.return_value)
+        self.assertIs(parquet_type(fields["start_date"], pa), pa.timestamp.return_value)
+        self.assertIs(parquet_type(fields["moving_time_sec"], pa), pa.int64.return_value)
+
+    @unittest.skipUnless(parquet_available(), "pyarrow isn't installed")
+    def test_schema_builds(self) :
+        import pyarrow as pa
+        schema = parquet_schema()
+        self.assertEqual(schema.names, [f.name for f in export_fields()])
+        self.assertEqual(schema.field("local_date").type, pa.date32())
+
+
+def synthetic_activities(count, seed=1) :
+    """
+    Make up some activities with routes around the same spot, as the Strava API returns them.
+    """
+    rng = random.Random(seed)
+    start = datetime.datetime(2023, 5, 1, 12, tzinfo=datetime.timezone.utc)
+    return [make_synthetic_activity(rng, i + 1, start + datetime.timedelta(days=i), "Ride", (40.0, -105.3)) for i in range(count)]
+
+
+def read_tiles(user) :
+    """
+    Return a user's heatmap tiles as a dict of path (relative to their directory) to counts.
+    """
+    import numpy as np
+    tiles = {}
+    for path in heatmap_dir(user).rglob("*.npz") :
+        with np.load(path) as f :
+            tiles[str(path.relative_to(heatmap_dir(user)))] = f["counts"]
+    return tiles
+
+
+class HeatmapTests(TestCase) :
+    def setUp(self) :
+        tile_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tile_dir.cleanup)
+        override = self.settings(HEATMAP_TILE_DIR=tile_dir.name, HEATMAP_MIN_ZOOM=3, HEATMAP_MAX_ZOOM=12)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.user = User.objects.create_user(username="heatmap-test")
+        StravaUser.objects.create(user=self.user)
+        self.polylines = [a["map"]["summary_polyline"] for a in synthetic_activities(4)]
+
+    def assertSameTiles(self, a, b) :
+        self.assertEqual(sorted(a), sorted(b))
+        for name in a :
+            self.assertTrue((a[name] == b[name]).all(), name)
+
+    def test_removing_undoes_adding(self) :
+        add_polylines_to_heatmap(self.user, self.polylines[2:])
+        alone = read_tiles(self.user)
+        add_polylines_to_heatmap(self.user, self.polylines[:2])
+        self.assertNotEqual(sorted(read_tiles(self.user)), [])
+        add_polylines_to_heatmap(self.user, self.polylines[:2], sign=-1)
+        self.assertSameTiles(read_tiles(self.user), alone)
+
+    def test_removing_everything_leaves_no_tiles(self) :
+        add_polylines_to_heatmap(self.user, self.polylines)
+        for p in self.polylines :
+            add_polylines_to_heatmap(self.user, [p], sign=-1)
+        self.assertEqual(read_tiles(self.user), {})
+
+    def test_saving_an_activity_again_counts_it_once(self) :
+        acts = synthetic_activities(2)
+        for a in acts :
+            assign_activity_to_cluster(save_strava_activity(a, self.user))
+        add_polylines_to_heatmap(self.user, self.polylines[:2])
+        once = read_tiles(self.user)
+        # What an update that gets an activity we already have again does.
+        remove_stored_routes(self.user, [acts[0]["id"]])
+        assign_activity_to_cluster(save_strava_activity(acts[0], self.user))
+        add_polylines_to_heatmap(self.user, [self.polylines[0]])
+        self.assertSameTiles(read_tiles(self.user), once)
+        self.assertEqual(sum(RouteCluster.objects.filter(site_user=self.user).values_list("activity_count", flat=True)), 2)
+
+
+@unittest.skipUnless(connection.vendor == "postgresql", "advisory locks are Postgres only")
+class TileLockTests(TransactionTestCase) :
+    def in_other_connection(self, work) :
+        """
+        Run work(cursor) on a connection of its own and return what it returns.
+        """
+        result = {}
+
+        def run() :
+            try :
+                with connection.cursor() as cursor :
+                    # Fail rather than hang if it's blocked.
+                    cursor.execute("SET lock_timeout = '2s'")
+                    result["value"] = work(cursor)
+            finally :
+                connections.close_all()
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        return result.get("value")
+
+    def try_tile_lock(self, cursor) :
+        cursor.execute("SELECT pg_try_advisory_lock(%s, %s)", [HEATMAP_LOCK_NAMESPACE, self.user.id])
+        return cursor.fetchone()[0]
+
+    def test_tiles_locked_without_blocking_profile_saves(self) :
+        self.user = User.objects.create_user(username="tile-lock-test")
+        StravaUser.objects.create(user=self.user)
+        with _tile_lock(self.user) :
+            self.assertFalse(self.in_other_connection(self.try_tile_lock))
+            saved = self.in_other_connection(lambda cursor : StravaUser.objects.filter(user=self.user).update(preferred_units="imperial"))
+            self.assertEqual(saved, 1)
+        self.assertTrue(self.in_other_connection(self.try_tile_lock))
+
+
+class DailyTotalTests(TestCase) :
+    def setUp(self) :
+        self.user = User.objects.create_user(username="daily-total-test")
+        StravaUser.objects.create(user=self.user)
+        self.act = synthetic_activities(1)[0]
+        self.day = datetime.date.fromisoformat(self.act["start_date_local"][:10])
+
+    def totals(self) :
+        return {(t.local_date, t.sport_type) : (round(t.distance_meters, 3), t.moving_time_sec, t.activity_count)
+                for t in DailyTotal.objects.filter(site_user=self.user)}
+
+    def test_saving_twice_counts_once(self) :
+        save_strava_activity(self.act, self.user)
+        save_strava_activity(self.act, self.user)
+        self.assertEqual(self.totals(), {(self.day, "Ride") : (round(self.act["distance"], 3), self.act["moving_time"], 1)})
+
+    def test_type_change_moves_the_activity(self) :
+        save_strava_activity(self.act, self.user)
+        event = {"aspect_type" : "update", "object_type" : "activity", "object_id" : self.act["id"], "owner_id" : 1,
+                 "updates" : {"type" : "Run"}}
+        with mock.patch("strava_info.strava_helpers.get_webhook_owner", return_value=self.user) :
+            async_handle(event)
+        self.assertEqual(self.totals(), {(self.day, "Run") : (round(self.act["distance"], 3), self.act["moving_time"], 1)})
+
+    def test_delete_drops_the_day(self) :
+        other = dict(self.act, id=self.act["id"] + 1, distance=1000.0, moving_time=300)
+        save_strava_activity(self.act, self.user)
+        save_strava_activity(other, self.user)
+        delete_strava_activity(self.user, self.act["id"])
+        self.assertEqual(self.totals(), {(self.day, "Ride") : (1000.0, 300, 1)})
+        delete_strava_activity(self.user, other["id"])
+        self.assertEqual(self.totals(), {})
+
+    def test_a_download_batch_bumps_the_version_once(self) :
+        acts = synthetic_activities(3)
+        save_strava_data(acts, self.user)
+        self.assertEqual(self.totals()[(self.day, "Ride")][2], 1)
+        self.assertEqual(DailyTotal.objects.filter(site_user=self.user).count(), 3)
+        self.assertEqual(StravaUser.objects.get(user=self.user).data_version, 1)
+
+
+def make_zip(files) :
+    """
+    Return the bytes of a zip archive holding files, a dict of name to contents.
+    """
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as zf :
+        for name, contents in files.items() :
+            zf.writestr(name, contents)
+    return buf.getvalue()
+
+
+class ExportUploadFormTests(SimpleTestCase) :
+    def form(self, data) :
+        return StravaExportUploadForm({}, {"export_file" : SimpleUploadedFile("export_1.zip", data)})
+
+    def test_takes_an_export(self) :
+        form = self.form(make_zip({"activities.csv" : "Activity ID\n", "activities/1.gpx" : ""}))
+        self.assertTrue(form.is_valid(), form.errors)
+        # The view copies the file from the start.
+        self.assertEqual(form.cleaned_data["export_file"].read(2), b"PK")
+
+    def test_rejects_a_zip_without_activities(self) :
+        self.assertFalse(self.form(make_zip({"profile.csv" : ""})).is_valid())
+
+    def test_rejects_something_else(self) :
+        self.assertFalse(self.form(b"not a zip at all").is_valid())
+
+
+class HomePageTests(TestCase) :
+    def setUp(self) :
+        cache.clear()
+        self.user = User.objects.create_user(username="home-page-test")
+        StravaUser.objects.create(user=self.user, is_strava_verified=True, has_completed_initial_download=True)
+        UserSocialAuth.objects.create(user=self.user, provider="strava", uid="1")
+        self.acts = synthetic_activities(7)
+        save_strava_data(self.acts, self.user)
+        self.client.force_login(self.user)
+
+    def test_reads_only_the_session_and_profile(self) :
+        with self.assertNumQueries(2) :
+            r = self.client.get("/")
+        self.assertEqual(r.status_code, 200)
+        self.assertContains(r, "strava.com/activities/7")
+        self.assertNotContains(r, "strava.com/activities/2\"")
+
+    def test_shows_a_rename(self) :
+        save_strava_activity(dict(self.acts[-1], name="Renamed ride"), self.user)
+        self.assertContains(self.client.get("/"), "Renamed ride")
+
+    def types(self) :
+        return StravaUser.objects.get(user=self.user).activity_types
+
+    def test_activity_types_kept_up_as_activities_come_and_go(self) :
+        # Saving only merges the new type in, without looking through the history.
+        with CaptureQueriesContext(connection) as queries :
+            save_strava_activity(dict(self.acts[0], id=100, type="Run", sport_type="Run"), self.user)
+        self.assertFalse([q for q in queries if "DISTINCT" in q["sql"]])
+        save_strava_activity(dict(self.acts[1], id=101, type="Run", sport_type="Run"), self.user)
+        self.assertEqual(self.types(), ["Ride", "Run"])
+        # A type stays until its last activity goes.
+        delete_strava_activity(self.user, 100)
+        self.assertEqual(self.types(), ["Ride", "Run"])
+        save_strava_activity(dict(self.acts[1], id=101, type="Walk", sport_type="Walk"), self.user)
+        self.assertEqual(self.types(), ["Ride", "Walk"])
+        remove_user_strava_data(self.user)
+        self.assertEqual(self.types(), [])
+
+
+class TokenTests(TestCase) :
+    def setUp(self) :
+        cache.clear()
+        self.user = User.objects.create_user(username="token-test")
+        self.soc = UserSocialAuth.objects.create(user=self.user, provider="strava", uid="2",
+                                                 extra_data={"access_token" : "first", "expires_at" : time.time() + 3600})
+
+    def change_token(self, token) :
+        # What a refresh or a reconnect in another process does.
+        self.soc.extra_data["access_token"] = token
+        self.soc.save()
+
+    def test_reads_the_record_without_a_shared_cache(self) :
+        with mock.patch("strava_info.token_helpers.shared_cache_configured", return_value=False) :
+            self.assertEqual(get_strava_access_token(self.user), "first")
+            self.change_token("second")
+            self.assertEqual(get_strava_access_token(self.user), "second")
+
+    def test_shared_cache_until_forgotten(self) :
+        with mock.patch("strava_info.token_helpers.shared_cache_configured", return_value=True) :
+            self.assertEqual(get_strava_access_token(self.user), "first")
+            self.change_token("second")
+            with self.assertNumQueries(0) :
+                self.assertEqual(get_strava_access_token(self.user), "first")
+            forget_strava_token(self.user)
+            self.assertEqual(get_strava_access_token(self.user), "second")
+
+
+class WebhookOwnerTests(TestCase) :
+    def setUp(self) :
+        cache.clear()
+        self.user = User.objects.create_user(username="webhook-owner-test")
+        self.other = User.objects.create_user(username="webhook-owner-test-2")
+        self.soc = UserSocialAuth.objects.create(user=self.user, provider="strava", uid="3")
+
+    def test_looks_up_each_time_without_a_shared_cache(self) :
+        with mock.patch("strava_info.webhook_helpers.shared_cache_configured", return_value=False) :
+            self.assertEqual(get_webhook_owner(3), self.user)
+            # Another process moving the athlete to another user doesn't fire our signal.
+            UserSocialAuth.objects.filter(id=self.soc.id).update(user=self.other)
+            self.assertEqual(get_webhook_owner(3), self.other)
+
+    def test_shared_cache_is_forgotten_on_disconnect(self) :
+        with mock.patch("strava_info.webhook_helpers.shared_cache_configured", return_value=True) :
+            self.assertEqual(get_webhook_owner(3), self.user)
+            with self.assertNumQueries(0) :
+                self.assertEqual(get_webhook_owner(3), self.user)
+            self.soc.delete()
+            self.assertIsNone(get_webhook_owner(3))
+
+
+@unittest.skipUnless(connection.vendor == "postgresql", "partitioning needs Postgres")
+class PartitionTests(TestCase) :
+    def setUp(self) :
+        self.user = User.objects.create_user(username="partition-test")
+        StravaUser.objects.create(user=self.user)
+        acts = synthetic_activities(3)
+        # Spread them over a few years so range partitioning has more than one partition to fill.
+        for i, a in enumerate(acts) :
+            a["start_date"] = a["start_date"].replace("2023", str(2020 + i), 1)
+            a["start_date_local"] = a["start_date_local"].replace("2023", str(2020 + i), 1)
+        save_strava_data(acts, self.user)
+
+    def rows(self) :
+        return list(StravaActivity.objects.filter(site_user=self.user).order_by("id")
+                    .values_list("id", "activity_id", "name", "start_date", "distance_meters", "summary_polyline"))
+
+    def check_round_trip(self, strategy) :
+        before = self.rows()
+        partition_activities(strategy, partitions=4, years_ahead=0)
+        self.assertEqual(get_partition_strategy(), strategy)
+        self.assertTrue(list_partitions())
+        self.assertEqual(self.rows(), before)
+        # New rows get new ids from the carried over sequence, and deletes still take the cells with them.
+        save_strava_data(synthetic_activities(4, seed=2)[3:], self.user)
+        self.assertEqual(len(set(r[0] for r in self.rows())), 4)
+        StravaActivity.objects.filter(site_user=self.user).delete()
+        self.assertFalse(ActivityGeoCell.objects.filter(site_user=self.user).exists())
+
+    def inbound_foreign_keys(self) :
+        with connection.cursor() as cursor :
+            cursor.execute("SELECT pg_get_constraintdef(oid) FROM pg_constraint WHERE confrelid = %s::regclass AND contype = 'f'",
+                           [StravaActivity._meta.db_table])
+            return [r[0] for r in cursor.fetchall()]
+
+    def test_hash(self) :
+        self.check_round_trip("hash")
+        # The geohash cells still can't point at activities that don't exist.
+        self.assertEqual(len(self.inbound_foreign_keys()), 1)
+        self.assertIn("(activity_id, site_user_id)", self.inbound_foreign_keys()[0])
+
+    def test_range_keeps_the_cells_foreign_key(self) :
+        # The cells have no start_date to point at a range partitioned table with, so it's refused.
+        before = self.rows()
+        with self.assertRaises(ValueError) :
+            partition_activities("range", partitions=4, years_ahead=0)
+        self.assertIsNone(get_partition_strategy())
+        self.assertEqual(self.rows(), before)
+        self.assertEqual(len(self.inbound_foreign_keys()), 1)
+
+    def test_dry_run_changes_nothing(self) :
+        statements = partition_activities("hash", partitions=4, dry_run=True)
+        self.assertTrue(any(s.startswith("DROP TABLE") for s in statements))
+        self.assertIsNone(get_partition_strategy())
+
+
+class SpatialTests(SimpleTestCase) :
+    def test_decodes_polylines(self) :
+        # The example from Google's description of the format.
+        points = decode_polyline("_p~iF~ps|U_ulLnnqC_mqNvxq`@")
+        self.assertEqual(points.round(5).tolist(), [[38.5, -120.2], [40.7, -120.95], [43.252, -126.453]])
+        self.assertEqual(decode_polyline(encode_polyline(points)).round(5).tolist(), points.round(5).tolist())
+        self.assertEqual(decode_polyline("").shape, (0, 2))
+
+    def test_geohash(self) :
+        col, row = latlng_to_geo_grid(57.64911, 10.40744, 11)
+        self.assertEqual(geohash_from_grid([int(col)], [int(row)], 11), ["u4pruydqqvj"])
+
+    def test_track_cells_include_the_ones_between_points(self) :
+        import numpy as np
+        # A straight line with no points in between still passes through the cells there.
+        points = np.array([[40.0, -105.5], [40.0, -104.5]])
+        cells = track_geohash_cells(points, 5)
+        middle = track_geohash_cells(np.array([[40.0, -105.0]]), 5)
+        self.assertIn(middle[0], cells)
+        # A cell at precision 5 is about 0.044 degrees of longitude across.
+        self.assertGreaterEqual(len(cells), 22)
+        self.assertEqual(len(cells), len(set(cells)))
+
+
+class AreaSearchTests(TestCase) :
+    def setUp(self) :
+        self.user = User.objects.create_user(username="area-search-test")
+        StravaUser.objects.create(user=self.user)
+        self.acts = synthetic_activities(3)
+        save_strava_data(self.acts, self.user)
+
+    def search(self, **area) :
+        qs = filter_activities_by_area(StravaActivity.objects.filter(site_user=self.user), self.user, **area)
+        return sorted(a.activity_id for a in refine_activities_by_area(qs, **area))
+
+    def test_box_around_a_route(self) :
+        points = decode_polyline(self.acts[0]["map"]["summary_polyline"])
+        lat, lng = points[len(points) // 2]
+        found = self.search(bbox=(lat - 0.001, lng - 0.001, lat + 0.001, lng + 0.001))
+        self.assertIn(self.acts[0]["id"], found)
+
+    def test_near_a_route(self) :
+        lat, lng = decode_polyline(self.acts[1]["map"]["summary_polyline"])[-1]
+        self.assertIn(self.acts[1]["id"], self.search(near=(lat, lng, 50)))
+
+    def test_nowhere_near(self) :
+        self.assertEqual(self.search(bbox=(-10.0, 20.0, -9.0, 21.0)), [])
+        self.assertEqual(self.search(near=(0.0, 0.0, 1000)), [])
+
+
+def repeat_activity(act, activity_id, jitter=0.0, **changes) :
+    """
+    Return a copy of a synthetic activity with a new id, its route nudged north by jitter degrees.
+    """
+    points = decode_polyline(act["map"]["summary_polyline"])
+    points[:, 0] += jitter
+    return dict(act, id=activity_id, map={"summary_polyline" : encode_polyline(points)}, **changes)
+
+
+class RouteClusterTests(TestCase) :
+    def setUp(self) :
+        self.user = User.objects.create_user(username="route-cluster-test")
+        StravaUser.objects.create(user=self.user)
+        a, b = synthetic_activities(2)
+        # The same ride three times, about 10 meters apart, another ride, and the first route run.
+        self.acts = [a, repeat_activity(a, 10, 0.0001), repeat_activity(a, 11, -0.0001), b,
+                     repeat_activity(a, 12, type="Run", sport_type="Run")]
+        self.expected = [1, 1, 3]
+
+    def counts(self) :
+        return sorted(RouteCluster.objects.filter(site_user=self.user).values_list("activity_count", flat=True))
+
+    def test_one_at_a_time(self) :
+        for act in self.acts :
+            assign_activity_to_cluster(save_strava_activity(act, self.user))
+        self.assertEqual(self.counts(), self.expected)
+        repeats = StravaActivity.objects.filter(site_user=self.user, activity_id__in=[a["id"] for a in self.acts[:3]])
+        self.assertEqual(len(set(repeats.values_list("route_cluster_id", flat=True))), 1)
+
+    def test_all_at_once_agrees(self) :
+        save_strava_data(self.acts, self.user)
+        cluster_user_routes(self.user)
+        self.assertEqual(self.counts(), self.expected)
+        self.assertFalse(StravaActivity.objects.filter(site_user=self.user, route_cluster=None).exists())
+
+    def test_empty_clusters_go(self) :
+        sa = save_strava_activity(self.acts[3], self.user)
+        cluster = assign_activity_to_cluster(sa)
+        remove_activity_from_cluster(cluster.id)
+        self.assertFalse(RouteCluster.objects.filter(id=cluster.id).exists())
+        # Activities without a route aren't clustered.
+        self.assertIsNone(assign_activity_to_cluster(save_strava_activity(dict(self.acts[3], id=20, map=None), self.user)))
+
+
+EXPORT_TRACK = [(40.0, -105.3), (40.001, -105.301), (40.002, -105.3)]
+
+EXPORT_CSV = (
+    "Activity ID,Activity Date,Activity Name,Activity Type,Elapsed Time,Distance,Filename,Moving Time,Distance,Elevation Gain\n"
+    "101,\"May 1, 2023, 6:30:00 PM\",Evening Ride,Ride,3700,20.5,activities/101.gpx,3600,20500.0,150\n"
+    "102,\"May 2, 2023, 7:00:00 AM\",Zwift,Virtual Ride,1800,15.0,,1800,15000.0,0\n"
+    "103,\"May 3, 2023, 7:00:00 AM\",Morning Run,Run,2000,5.0,activities/103.tcx.gz,1900,5000.0,20\n"
+)
+
+
+def export_gpx(points) :
+    trkpts = "".join('<trkpt lat="' + str(lat) + '" lon="' + str(lng) + '"></trkpt>' for lat, lng in points)
+    return '<?xml version="1.0"?><gpx xmlns="http://www.topografix.com/GPX/1/1"><trk><trkseg>' + trkpts + '</trkseg></trk></gpx>'
+
+
+def export_tcx(points) :
+    trackpoints = "".join("<Trackpoint><Position><LatitudeDegrees>" + str(lat) + "</LatitudeDegrees><LongitudeDegrees>" +
+                          str(lng) + "</LongitudeDegrees></Position></Trackpoint>" for lat, lng in points)
+    # Garmin's leading whitespace.
+    return "   \n<?xml version=\"1.0\"?><TrainingCenterDatabase><Track>" + trackpoints + "</Track></TrainingCenterDatabase>"
+
+
+def export_fit(points) :
+    """
+    Return a FIT file with a record message for each point, and nothing else.
+    """
+    # A definition of local message 0 as a record with position_lat and position_long.
+    body = bytes([0x40, 0, 0]) + struct.pack("<H", 20) + bytes([2, 0, 4, 0x85, 1, 4, 0x85])
+    for lat, lng in points :
+        body += bytes([0]) + struct.pack("<ii", round(lat * 2**31 / 180), round(lng * 2**31 / 180))
+    return bytes([14, 0x10]) + struct.pack("<HI", 2100, len(body)) + b".FIT" + b"\0\0" + body + b"\0\0"
+
+
+class BulkImportTests(TestCase) :
+    def setUp(self) :
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        override = self.settings(HEATMAP_TILE_DIR=tmp.name)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.zip_path = os.path.join(tmp.name, "export_1.zip")
+        with open(self.zip_path, "wb") as f :
+            f.write(make_zip({
+                "activities.csv" : EXPORT_CSV,
+                "activities/101.gpx" : export_gpx(EXPORT_TRACK),
+                "activities/103.tcx.gz" : gzip.compress(export_tcx(EXPORT_TRACK).encode()),
+                "activities/104.fit" : export_fit(EXPORT_TRACK),
+            }))
+        self.user = User.objects.create_user(username="bulk-import-test")
+        StravaUser.objects.create(user=self.user)
+
+    def test_csv_row(self) :
+        header = EXPORT_CSV.splitlines()[0].split(",")
+        values = ["102", "May 2, 2023, 7:00:00 AM", "Zwift", "Virtual Ride", "1800", "15.0", "", "1800", "15000.0", "0"]
+        row = {}
+        for col, v in zip(header, values) :
+            row.setdefault(col, []).append(v)
+        result = export_row_to_result(row)
+        self.assertEqual((result["id"], result["sport_type"], result["start_date"]), (102, "VirtualRide", "2023-05-02T07:00:00+00:00"))
+        # The second Distance column is in meters.
+        self.assertEqual((result["distance"], result["moving_time"]), (15000.0, 1800))
+
+    def test_tracks(self) :
+        for member in ("activities/101.gpx", "activities/103.tcx.gz", "activities/104.fit") :
+            track = parse_export_track(self.zip_path, member)
+            self.assertEqual(decode_polyline(track["map"]["summary_polyline"]).round(5).tolist(), [list(p) for p in EXPORT_TRACK], member)
+            self.assertEqual([round(v, 5) for v in track["start_latlng"]], [40.0, -105.3])
+        self.assertEqual(parse_export_track(self.zip_path, "activities/missing.gpx"), {})
+
+    def test_import(self) :
+        self.assertEqual(import_strava_export(self.user, self.zip_path, workers=1, batch_size=2), 3)
+        # Importing the same archive again replaces what the first import saved.
+        import_strava_export(self.user, self.zip_path, workers=1, batch_size=2)
+        acts = {a.activity_id : a for a in StravaActivity.objects.filter(site_user=self.user)}
+        self.assertEqual(sorted(acts), [101, 102, 103])
+        self.assertEqual(decode_polyline(acts[103].summary_polyline).round(5).tolist(), [list(p) for p in EXPORT_TRACK])
+        self.assertFalse(acts[102].summary_polyline)
+        self.assertEqual(acts[103].sport_type, "Run")
+        su = StravaUser.objects.get(user=self.user)
+        self.assertTrue(su.has_completed_initial_download)
+        self.assertEqual(su.activity_types, ["Ride", "Run", "VirtualRide"])
+        self.assertEqual(DailyTotal.objects.filter(site_user=self.user).count(), 3)
+
+    def test_upload_parses_in_a_few_spawned_processes(self) :
+        class InlineThread :
+            def __init__(self, target, args) :
+                self.run = lambda : target(*args)
+
+            def setDaemon(self, daemonic) :
+                pass
+
+            def start(self) :
+                self.run()
+
+        self.client.force_login(self.user)
+        with open(self.zip_path, "rb") as f :
+            upload = SimpleUploadedFile("export_1.zip", f.read())
+        with mock.patch("strava_info.views.threading", mock.Mock(Thread=InlineThread)), \
+             mock.patch("strava_info.bulk_import_helpers.ProcessPoolExecutor", wraps=ProcessPoolExecutor) as pool :
+            self.client.post("/strava_info/upload_strava_export", {"export_file" : upload})
+        kwargs = pool.call_args.kwargs
+        self.assertEqual(kwargs["max_workers"], settings.IMPORT_UPLOAD_WORKERS)
+        self.assertEqual(kwargs["mp_context"].get_start_method(), "spawn")
+        self.assertEqual(StravaActivity.objects.filter(site_user=self.user).count(), 3)
+
+
+class ExportTests(TestCase) :
+    def setUp(self) :
+        self.user = User.objects.create_user(username="export-test")
+        StravaUser.objects.create(user=self.user, is_strava_verified=True, has_completed_initial_download=True)
+        # Saved out of date order, so the export has to sort them.
+        self.acts = synthetic_activities(3)
+        save_strava_data(self.acts[::-1], self.user)
+        save_strava_activity(dict(self.acts[0], id=50, type="Run", sport_type="Run"), self.user)
+        self.client.force_login(self.user)
+
+    def read_csv(self, text) :
+        return list(csv.reader(io.StringIO(text)))
+
+    def test_csv(self) :
+        rows = self.read_csv("".join(stream_activities_csv(StravaActivity.objects.filter(site_user=self.user), chunk_size=2)))
+        self.assertEqual(rows[0], [f.name for f in export_fields()])
+        self.assertFalse(EXPORT_EXCLUDED_FIELDS & set(rows[0]))
+        ids = [int(r[rows[0].index("activity_id")]) for r in rows[1:]]
+        self.assertEqual(ids, [1, 50, 2, 3])
+
+    def test_view_exports_the_search(self) :
+        r = self.client.get("/strava_info/export_strava_data", {"format" : "csv", "activity_type" : "Run"})
+        self.assertEqual(r["Content-Disposition"], 'attachment; filename="strava_activities.csv"')
+        rows = self.read_csv(b"".join(r.streaming_content).decode())
+        self.assertEqual([r[rows[0].index("activity_id")] for r in rows[1:]], ["50"])
+
+    def test_parquet_needs_pyarrow(self) :
+        with mock.patch("strava_info.views.parquet_available", return_value=False) :
+            self.assertEqual(self.client.get("/strava_info/export_strava_data", {"format" : "parquet"}).status_code, 501)
+
+    @unittest.skipUnless(parquet_available(), "pyarrow isn't installed")
+    def test_parquet(self) :
+        import pyarrow.parquet as pq
+        data = b"".join(stream_activities_parquet(StravaActivity.objects.filter(site_user=self.user), chunk_size=2))
+        table = pq.read_table(io.BytesIO(data))
+        self.assertEqual(table.schema, parquet_schema())
+        self.assertEqual(table.column("activity_id").to_pylist(), [1, 50, 2, 3])
+
+    @unittest.skipUnless(parquet_available(), "pyarrow isn't installed")
+    def test_parquet_view_round_trips(self) :
+        import pyarrow.parquet as pq
+        with self.settings(EXPORT_CHUNK_SIZE=3) :
+            r = self.client.get("/strava_info/export_strava_data", {"format" : "parquet"})
+            data = b"".join(r.streaming_content)
+        self.assertEqual(r["Content-Type"], "application/vnd.apache.parquet")
+        parquet = pq.ParquetFile(io.BytesIO(data))
+        self.assertEqual(parquet.metadata.num_row_groups, 2)
+        # Every value reads back as it's stored.
+        fields = export_fields()
+        expected = [{f.name : f.value_from_object(a) for f in fields}
+                    for a in StravaActivity.objects.filter(site_user=self.user).order_by("start_date")]
+        self.assertEqual(parquet.read().to_pylist(), expected)
+
+
+def asgi_get(app, path, query="", cookies=None) :
+    """
+    Send a GET through an ASGI app, the way uvicorn does, and collect the response.
+
+    Returns:
+        (int, dict, list of bytes): the status, the headers and the body messages' bodies
+    """
+    scope = {"type" : "http", "asgi" : {"version" : "3.0"}, "http_version" : "1.1", "method" : "GET",
+             "scheme" : "http", "path" : path, "raw_path" : path.encode(), "query_string" : query.encode(),
+             "root_path" : "", "server" : ("testserver", 80), "client" : ("127.0.0.1", 12345),
+             "headers" : [(b"host", b"testserver")] + [(b"cookie", (k + "=" + v).encode()) for k, v in (cookies or {}).items()]}
+    sent = []
+
+    async def run() :
+        requested = asyncio.Event()
+
+        async def receive() :
+            if not requested.is_set() :
+                requested.set()
+                return {"type" : "http.request", "body" : b"", "more_body" : False}
+            # The client stays connected until the response is done.
+            await asyncio.Event().wait()
+
+        async def send(message) :
+            sent.append(message)
+
+        await app(scope, receive, send)
+
+    asyncio.run(run())
+    start = sent[0]
+    return start["status"], {k.decode().lower() : v.decode() for k, v in start["headers"]}, [m.get("body", b"") for m in sent[1:]]
+
+
+class AsgiExportTests(TransactionTestCase) :
+    def test_export_streams_under_asgi(self) :
+        from fitnessapp.asgi import application
+        user = User.objects.create_user(username="asgi-export-test")
+        StravaUser.objects.create(user=user, is_strava_verified=True, has_completed_initial_download=True)
+        save_strava_data(synthetic_activities(5), user)
+        self.client.force_login(user)
+        session = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+        with self.settings(EXPORT_CHUNK_SIZE=2), warnings.catch_warnings(record=True) as caught :
+            warnings.simplefilter("always")
+            status, headers, bodies = asgi_get(application, "/strava_info/export_strava_data", "format=csv",
+                                               {settings.SESSION_COOKIE_NAME : session})
+        # Django warns when it has to read a sync iterator into a list instead of streaming it.
+        self.assertFalse([w for w in caught if "synchronous iterators" in str(w.message)])
+        self.assertEqual(status, 200)
+        self.assertEqual(headers["content-type"], "text/csv")
+        # The header, three chunks of rows, then the empty closing message.
+        self.assertEqual(len(bodies), 5)
+        rows = list(csv.reader(io.StringIO(b"".join(bodies).decode())))
+        self.assertEqual([r[rows[0].index("activity_id")] for r in rows[1:]], ["1", "2", "3", "4", "5"])
+
+
+class RequestMetricsTests(TestCase) :
+    def test_summary(self) :
+        metrics = ViewMetrics(window=4)
+        for q in [1, 2, 3, 4, 100] :
+            metrics.record("v", {"queries" : q, "db_ms" : 1.0, "total_ms" : 2.0, "cpu_ms" : 1.0, "response_bytes" : None})
+        summary = metrics.summary()["v"]
+        # The first sample has dropped out of the window but still counts as a request.
+        self.assertEqual((summary["requests"], summary["window"]), (5, 4))
+        self.assertEqual((summary["queries"]["p50"], summary["queries"]["max"]), (4, 100))
+        self.assertEqual(summary["queries"]["histogram"], {2 : 1, 4 : 2, 128 : 1})
+        # Streamed responses have no size.
+        self.assertNotIn("response_bytes", summary)
+
+    def middleware_request(self, get_response) :
+        request = RequestFactory().get("/somewhere")
+        request.resolver_match = mock.Mock(view_name="test_view")
+        return RequestMetricsMiddleware(get_response), request
+
+    def test_counts_queries_and_warns_over_budget(self) :
+        def view(request) :
+            for _ in range(3) :
+                User.objects.exists()
+            return HttpResponse("hello")
+
+        metrics = ViewMetrics(window=10)
+        middleware, request = self.middleware_request(view)
+        with mock.patch("strava_info.middleware.view_metrics", metrics), self.settings(VIEW_QUERY_BUDGETS={"test_view" : 2}), \
+             self.assertLogs("strava_info.metrics", "INFO") as logs :
+            middleware(request)
+        sample = metrics.samples["test_view"][0]
+        self.assertEqual((sample["queries"], sample["response_bytes"]), (3, 5))
+        self.assertIn("query_budget_exceeded", logs.output[-1])
+
+    def test_async(self) :
+        async def view(request) :
+            return HttpResponse("hi")
+
+        metrics = ViewMetrics(window=10)
+        middleware, request = self.middleware_request(view)
+        with mock.patch("strava_info.middleware.view_metrics", metrics) :
+            response = asyncio.run(middleware(request))
+        self.assertEqual(response.content, b"hi")
+        self.assertEqual(metrics.samples["test_view"][0]["queries"], 0)
+
+    def test_async_counts_queries_on_other_threads(self) :
+        def query() :
+            try :
+                return User.objects.exists()
+            finally :
+                connection.close()
+
+        async def view(request) :
+            # Like a sync view under ASGI, which runs on a thread of its own.
+            await sync_to_async(query, thread_sensitive=False)()
+            return HttpResponse("hi")
+
+        metrics = ViewMetrics(window=10)
+        middleware, request = self.middleware_request(view)
+        with mock.patch("strava_info.middleware.view_metrics", metrics) :
+            asyncio.run(middleware(request))
+        self.assertEqual(metrics.samples["test_view"][0]["queries"], 1)
+
+    def test_streamed_response_counted_until_closed(self) :
+        def rows() :
+            for _ in range(2) :
+                yield str(User.objects.count())
+
+        def view(request) :
+            User.objects.exists()
+            return StreamingHttpResponse(rows())
+
+        # Closing a response would close the connection the test runs in, so stop that as the test client does.
+        request_finished.disconnect(close_old_connections)
+        self.addCleanup(request_finished.connect, close_old_connections)
+        metrics = ViewMetrics(window=10)
+        middleware, request = self.middleware_request(view)
+        with mock.patch("strava_info.middleware.view_metrics", metrics) :
+            response = middleware(request)
+            self.assertNotIn("test_view", metrics.samples)
+            self.assertEqual(b"".join(response), b"00")
+            response.close()
+            # Queries made after it's closed don't count.
+            User.objects.exists()
+        sample = metrics.samples["test_view"][0]
+        self.assertEqual((sample["queries"], sample["response_bytes"]), (3, None))
+
+
+class SyntheticAthleteTests(TestCase) :
+    def setUp(self) :
+        override = self.settings(HEATMAP_TILE_DIR=tempfile.mkdtemp())
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_parse_sport_mix(self) :
+        self.assertEqual(parse_sport_mix("Ride:6, Run:3,Swim:1"), {"Ride" : 0.6, "Run" : 0.3, "Swim" : 0.1})
+        # A sport without a weight counts once.
+        self.assertEqual(parse_sport_mix("Ride,Run"), {"Ride" : 0.5, "Run" : 0.5})
+
+    def history(self, user) :
+        return list(StravaActivity.objects.filter(site_user=user).order_by("activity_id")
+                    .values_list("activity_id", "sport_type", "start_date", "distance_meters", "summary_polyline"))
+
+    def test_same_seed_same_history(self) :
+        mix = parse_sport_mix("Ride:2,Run:1")
+        first = create_synthetic_athlete("bench1", num_activities=30, years=2, sport_mix=mix, seed=5)
+        second = create_synthetic_athlete("bench2", num_activities=30, years=2, sport_mix=mix, seed=5)
+        other = create_synthetic_athlete("bench3", num_activities=30, years=2, sport_mix=mix, seed=6)
+        history = self.history(first)
+        self.assertEqual(len(history), 30)
+        self.assertEqual(history, self.history(second))
+        self.assertNotEqual([h[1:] for h in history], [h[1:] for h in self.history(other)])
+        self.assertEqual({h[1] for h in history}, {"Ride", "Run"})
+        end = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)
+        self.assertTrue(all(end - datetime.timedelta(days=730) <= h[2] <= end for h in history))
+        su = StravaUser.objects.get(user=first)
+        self.assertTrue(su.has_completed_initial_download)
+        self.assertEqual(set(su.pie_color_palette), {"Ride", "Run"})
+
+
+class FakeStravaIngestTests(TestCase) :
+    def setUp(self) :
+        cache.clear()
+        self.server = FakeStravaServer(60, seed=3, rate_limit_every=2).__enter__()
+        self.addCleanup(self.server.__exit__)
+        override = self.settings(STRAVA_API_URL=self.server.api_url, STRAVA_OAUTH_URL=self.server.oauth_url,
+                                 STRAVA_RATE_LIMIT_WAIT=0, HEATMAP_TILE_DIR=tempfile.mkdtemp())
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_download(self) :
+        user = User.objects.create_user(username="ingest", password="ingest")
+        StravaUser.objects.create(user=user, is_strava_verified=True)
+        # The token has already expired, so the download has to refresh it first.
+        token = self.server.issue_token(ttl=-1)
+        UserSocialAuth.objects.create(user=user, provider="strava", uid="3001",
+                                      extra_data=dict(token, auth_time=int(time.time()) - 21600, expires=token["expires_in"]))
+        request = RequestFactory().get("/")
+        request.user = user
+        request._messages = CookieStorage(request)
+        with self.assertLogs("strava_info.strava_helpers", "WARNING") :
+            download_strava_data(request)
+        saved = set(StravaActivity.objects.filter(site_user=user).values_list("activity_id", flat=True))
+        self.assertEqual(saved, set(self.server.activities))
+        # Every call that was turned away with a 429 was made again.
+        self.assertGreater(self.server.calls["rate_limited"], 0)
+        self.assertEqual((self.server.calls["token"], self.server.calls["unauthorized"]), (1, 0))
+        self.assertTrue(StravaUser.objects.get(user=user).has_completed_initial_download)
+
+    def test_async_client_retries(self) :
+        token = self.server.issue_token()["access_token"]
+        activity_id = next(iter(self.server.activities))
+
+        async def fetch() :
+            client = AsyncStravaClient()
+            try :
+                return [await client.get_activity(token, activity_id) for _ in range(3)]
+            finally :
+                await client.aclose()
+
+        with self.assertLogs("strava_info.strava_client", "WARNING") :
+            fetched = asyncio.run(fetch())
+        self.assertEqual([a["id"] for a in fetched], [activity_id] * 3)
+        self.assertEqual(self.server.calls["rate_limited"], 2)
+
+
+class PieColorTests(TestCase) :
+    def test_pool(self) :
+        pool = pie_color_pool()
+        self.assertEqual(len(pool), settings.PIE_COLOR_POOL_SIZE)
+        self.assertEqual(len(set(pool)), len(pool))
+        self.assertEqual(pool[0], "#36A2EB")
+        # Seeded, so every process hands out the same colors.
+        pie_color_pool.cache_clear()
+        self.assertEqual(pie_color_pool(), pool)
+
+    def test_extend(self) :
+        pool = pie_color_pool()
+        palette, changed = extend_pie_colors({"Run" : pool[0]}, ["Swim", "Run", "Ride"])
+        # Run keeps its color and the new types get the next free ones in name order.
+        self.assertTrue(changed)
+        self.assertEqual(palette, {"Run" : pool[0], "Ride" : pool[1], "Swim" : pool[2]})
+        self.assertEqual(extend_pie_colors(palette, ["Ride"]), (palette, False))
+
+    def test_more_types_than_colors(self) :
+        palette = {"Type" + str(i) : c for i, c in enumerate(pie_color_pool())}
+        palette, changed = extend_pie_colors(palette, ["Ride", "Run"])
+        self.assertTrue(changed)
+        self.assertEqual(len(set(palette.values())), len(pie_color_pool()) + 2)
+
+    def test_add_pie_colors(self) :
+        user = User.objects.create_user(username="colors", password="colors")
+        StravaUser.objects.create(user=user)
+        add_pie_colors(user, ["Ride"])
+        su = StravaUser.objects.get(user=user)
+        self.assertEqual((su.pie_color_palette, su.data_version), ({"Ride" : pie_color_pool()[0]}, 1))
+        # Nothing new, so nothing is saved and cached pages stay good.
+        with self.assertNumQueries(0) :
+            add_pie_colors(user, ["Ride"])
+        self.assertEqual(StravaUser.objects.get(user=user).data_version, 1)
+
+
+class BoundedMemoryTests(TestCase) :
+    def setUp(self) :
+        override = self.settings(HEATMAP_TILE_DIR=tempfile.mkdtemp())
+        override.enable()
+        self.addCleanup(override.disable)
+        self.user = User.objects.create_user(username="bounded")
+        StravaUser.objects.create(user=self.user)
+        self.acts = synthetic_activities(10)
+        save_strava_data(self.acts, self.user)
+        self.other = User.objects.create_user(username="bounded-other")
+        StravaUser.objects.create(user=self.other)
+        save_strava_data(synthetic_activities(2), self.other)
+
+    def test_delete_in_chunks(self) :
+        qs = ActivityGeoCell.objects.filter(site_user=self.user)
+        cells = qs.count()
+        self.assertEqual(delete_in_chunks(qs, chunk_size=7), cells)
+        self.assertFalse(qs.exists())
+        self.assertTrue(ActivityGeoCell.objects.filter(site_user=self.other).exists())
+
+    def test_remove_user_strava_data(self) :
+        with self.settings(DELETE_CHUNK_SIZE=3) :
+            remove_user_strava_data(self.user)
+        for model in (StravaActivity, ActivityGeoCell, DailyTotal) :
+            self.assertFalse(model.objects.filter(site_user=self.user).exists())
+            self.assertTrue(model.objects.filter(site_user=self.other).exists())
+        self.assertFalse(StravaUser.objects.get(user=self.user).has_completed_initial_download)
+
+    def test_search_loads_only_what_it_shows(self) :
+        request = RequestFactory().get("/")
+        request.user = self.user
+        lat, lng = decode_polyline(self.acts[4]["map"]["summary_polyline"])[-1]
+        # One query, so nothing a result shows or the route check reads was left unloaded.
+        with self.settings(SEARCH_CHUNK_SIZE=3), self.assertNumQueries(1) :
+            everything = suggest_similar_activities(request, activity_type=None, start_date=datetime.date(2023, 1, 1))
+        with self.assertNumQueries(1) :
+            nearby = suggest_similar_activities(request, activity_type=None, near=(lat, lng, 50))
+        self.assertEqual(len(everything), 10)
+        self.assertIn(str(self.acts[4]["id"]), [r["id"] for r in nearby])
+
+
+class PayloadArchiveTests(TestCase) :
+    def setUp(self) :
+        override = self.settings(HEATMAP_TILE_DIR=tempfile.mkdtemp())
+        override.enable()
+        self.addCleanup(override.disable)
+        self.user = User.objects.create_user(username="archive")
+        StravaUser.objects.create(user=self.user)
+        self.acts = synthetic_activities(5)
+        save_strava_data(self.acts, self.user)
+
+    def archived(self, activity_id) :
+        return decompress_payload(ActivityPayload.objects.get(site_user=self.user, activity_id=activity_id).payload)
+
+    def test_round_trip(self) :
+        self.assertEqual(decompress_payload(compress_payload(self.acts[0])), self.acts[0])
+        self.assertEqual(self.archived(self.acts[2]["id"]), self.acts[2])
+
+    def test_update_and_forget(self) :
+        activity_id = self.acts[1]["id"]
+        update_archived_payload(self.user, activity_id, {"name" : "Renamed"})
+        self.assertEqual(self.archived(activity_id), dict(self.acts[1], name="Renamed"))
+        forget_payload(self.user, activity_id)
+        self.assertFalse(ActivityPayload.objects.filter(site_user=self.user, activity_id=activity_id).exists())
+        # Nothing archived, nothing to update.
+        update_archived_payload(self.user, activity_id, {"name" : "Again"})
+
+    def test_rederive(self) :
+        other = User.objects.create_user(username="archive-other")
+        StravaUser.objects.create(user=other)
+        save_strava_data(synthetic_activities(2), other)
+        update_archived_payload(self.user, self.acts[0]["id"], {"name" : "Renamed"})
+        # Throw away what was derived from the JSON.
+        StravaActivity.objects.update(distance_miles=0, summary_polyline="")
+        counts = rederive_activities(users=User.objects.filter(id=self.user.id), workers=1, chunk_size=2)
+        self.assertEqual(counts, {self.user.id : 5})
+        acts = {a.activity_id : a for a in StravaActivity.objects.filter(site_user=self.user)}
+        self.assertEqual(len(acts), 5)
+        for r in self.acts :
+            self.assertEqual(acts[r["id"]].summary_polyline, r["map"]["summary_polyline"])
+            self.assertGreater(acts[r["id"]].distance_miles, 0)
+        self.assertEqual(acts[self.acts[0]["id"]].name, "Renamed")
+        # Other users are left alone.
+        self.assertFalse(StravaActivity.objects.filter(site_user=other).exclude(distance_miles=0).exists())
+
+
+class GearTotalTests(TestCase) :
+    def setUp(self) :
+        override = self.settings(HEATMAP_TILE_DIR=tempfile.mkdtemp())
+        override.enable()
+        self.addCleanup(override.disable)
+        self.user = User.objects.create_user(username="gear")
+        StravaUser.objects.create(user=self.user)
+        self.acts = synthetic_activities(4)
+        save_strava_data(self.acts, self.user)
+
+    def assertTotalsMatch(self) :
+        """
+        Check the running totals against adding up the user's activities.
+        """
+        rows = (StravaActivity.objects.filter(site_user=self.user).values("gear_id")
+                .annotate(distance=Sum("distance_meters"), moving=Sum("moving_time_sec"), count=Count("id")))
+        expected = {r["gear_id"] : (r["distance"], r["moving"], r["count"]) for r in rows}
+        totals = {g.gear_id : g for g in Gear.objects.filter(site_user=self.user)}
+        for gear_id, gear in totals.items() :
+            distance, moving, count = expected.get(gear_id, (0.0, 0, 0))
+            self.assertAlmostEqual(gear.distance_meters, distance, places=3)
+            self.assertEqual((gear.moving_time_sec, gear.activity_count), (moving, count))
+        return totals
+
+    def test_save(self) :
+        totals = self.assertTotalsMatch()
+        self.assertEqual({g : t.activity_count for g, t in totals.items()}, {"b1" : 2, "b2" : 2})
+
+    def test_update(self) :
+        # The first ride was on b2. It turns out it was on b1 and a bit longer.
+        act = dict(self.acts[0], gear_id="b1", distance=self.acts[0]["distance"] + 1000)
+        store_webhook_activity(self.user, act)
+        self.assertEqual(self.assertTotalsMatch()["b1"].activity_count, 3)
+        # The same activity again changes nothing.
+        store_webhook_activity(self.user, act)
+        self.assertEqual(self.assertTotalsMatch()["b2"].activity_count, 1)
+        # Renaming it doesn't touch its gear.
+        with mock.patch("strava_info.strava_helpers.get_webhook_owner", return_value=self.user) :
+            async_handle({"aspect_type" : "update", "object_type" : "activity", "object_id" : act["id"], "owner_id" : 1,
+                          "updates" : {"title" : "Renamed"}})
+        self.assertEqual(self.assertTotalsMatch()["b1"].activity_count, 3)
+
+    def test_delete(self) :
+        for r in self.acts[:2] :
+            delete_strava_activity(self.user, r["id"])
+        totals = self.assertTotalsMatch()
+        self.assertEqual({g : t.activity_count for g, t in totals.items()}, {"b1" : 1, "b2" : 1})
+        # Deleting something we never had leaves the totals alone.
+        delete_strava_activity(self.user, 999)
+        self.assertTotalsMatch()
@@ -0,0 +1,174 @@
+from social_django.models import UserSocialAuth
+from .cache_helpers import shared_cache_configured
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction, connections
+import requests
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Access tokens we know are good are kept in the shared cache under this key plus the
+# user id, as (access token, expires_at), so we don't have to read the social auth
+# record on every API call. Every process sees a refresh or a forgotten token at once.
+_TOKEN_KEY = "strava_token:"
+
+# Only let one thread per user refresh at a time. Across processes the social
+# auth row lock does the same job.
+_user_locks = {}
+_user_locks_lock = threading.Lock()
+_refreshing = set()
+
+
+def _get_user_lock(user) :
+    """
+    Return the lock that guards refreshing a user's Strava tokens.
+
+    Args:
+        user (User): the user who owns the tokens
+
+    Returns:
+        Lock: the user's lock
+    """
+    with _user_locks_lock :
+        return _user_locks.setdefault(user.id, threading.Lock())
+
+
+def _expires_at(extra_data) :
+    # Older logins only have auth_time and expires.
+    return extra_data.get("expires_at") or extra_data.get("auth_time", 0) + extra_data.get("expires", 0)
+
+
+def _cache_token(user, access_token, expires_at) :
+    """
+    Keep a user's access token in the shared cache until it's too close to expiring to use.
+    Does nothing unless the cache is shared.
+    """
+    if not shared_cache_configured() :
+        return
+    timeout = expires_at - time.time() - settings.STRAVA_TOKEN_EXPIRY_MARGIN
+    if timeout > 0 :
+        cache.set(_TOKEN_KEY + str(user.id), (access_token, expires_at), timeout)
+
+
+def _known_token(user) :
+    """
+    Return the access token we have for a user, without refreshing it.
+
+    It comes from the shared cache if there is one. Otherwise it's read from the social
+    auth record, so a token another process refreshed or dropped is never used.
+
+    Returns:
+        tuple: (access token, expires_at), or None if we don't have one
+    """
+    if shared_cache_configured() :
+        return cache.get(_TOKEN_KEY + str(user.id))
+    extra_data = UserSocialAuth.objects.filter(user=user, provider="strava").values_list("extra_data", flat=True).first()
+    if not extra_data or not extra_data.get("access_token") :
+        return None
+    return (extra_data["access_token"], _expires_at(extra_data))
+
+
+def _refresh_token(user, ahead) :
+    """
+    Refresh a user's tokens if they expire within ahead seconds, and cache the access token.
+
+    The social auth row is locked while we do it. Whoever gets the lock second sees the
+    new expires_at and doesn't refresh again, so the refresh token never goes stale.
+
+    Args:
+        user (User): the user whose tokens to refresh
+        ahead (float): refresh if the access token expires within this many seconds
+
+    Returns:
+        str: a good access token
+    """
+    with transaction.atomic() :
+        strava_soc = UserSocialAuth.objects.select_for_update().get(user=user, provider="strava")
+        if _expires_at(strava_soc.extra_data) - time.time() <= ahead :
+            logger.debug("Refreshing Strava tokens for " + user.username)
+            # Make Strava auth API call with current refresh token
+            # and get the response that has the new token.
+            response = requests.post(
+                url = settings.STRAVA_OAUTH_URL + '/token',
+                data = {
+                    'client_id': settings.SOCIAL_AUTH_STRAVA_KEY,
+                    'client_secret': settings.SOCIAL_AUTH_STRAVA_SECRET,
+                    'grant_type': 'refresh_token',
+                    'refresh_token': strava_soc.extra_data['refresh_token']
+                }
+            )
+            response.raise_for_status()
+            # Replace the old strava_tokens with the response.
+            tokens = response.json()
+            strava_soc.extra_data["token_type"] = tokens["token_type"]
+            strava_soc.extra_data["access_token"] = tokens['access_token']
+            strava_soc.extra_data["auth_time"] = time.time()
+            strava_soc.extra_data["expires_at"] = tokens['expires_at']
+            strava_soc.extra_data["expires"] = tokens['expires_in']
+            strava_soc.extra_data["refresh_token"] = tokens['refresh_token']
+            strava_soc.save()
+        access_token = strava_soc.extra_data["access_token"]
+        _cache_token(user, access_token, _expires_at(strava_soc.extra_data))
+    return access_token
+
+
+def _background_refresh(user) :
+    try :
+        with _get_user_lock(user) :
+            _refresh_token(user, settings.STRAVA_TOKEN_REFRESH_AHEAD)
+    except Exception as e :
+        # The next call will try again in the foreground.
+        logger.warning("Background Strava token refresh failed for " + user.username + ": " + str(e))
+    finally :
+        with _user_locks_lock :
+            _refreshing.discard(user.id)
+        connections.close_all()
+
+
+def get_strava_access_token(user) :
+    """
+    Return a good Strava access token for a user, refreshing it if need be.
+
+    The token comes from the shared cache (or without one, the social auth record) while
+    it has more than STRAVA_TOKEN_EXPIRY_MARGIN seconds left. Once it's within STRAVA_TOKEN_REFRESH_AHEAD
+    seconds of expiring it's refreshed in the background, so callers rarely wait on Strava.
+
+    Args:
+        user (User): the user whose token we need
+
+    Raises:
+        RequestException: if the token needed refreshing and Strava couldn't do it
+
+    Returns:
+        str: the access token
+    """
+    cached = _known_token(user)
+    if cached and cached[1] - time.time() > settings.STRAVA_TOKEN_EXPIRY_MARGIN :
+        if cached[1] - time.time() <= settings.STRAVA_TOKEN_REFRESH_AHEAD :
+            with _user_locks_lock :
+                start = user.id not in _refreshing
+                _refreshing.add(user.id)
+            if start :
+                threading.Thread(target=_background_refresh, args=(user,), daemon=True).start()
+        return cached[0]
+    with _get_user_lock(user) :
+        # Another thread may have refreshed it while we waited.
+        cached = _known_token(user)
+        if cached and cached[1] - time.time() > settings.STRAVA_TOKEN_EXPIRY_MARGIN :
+            return cached[0]
+        return _refresh_token(user, settings.STRAVA_TOKEN_EXPIRY_MARGIN)
+
+
+def forget_strava_token(user) :
+    """
+    Drop a user's cached access token, e.g. because they deauthorized us. Without a
+    shared cache there's nothing to drop, since the token is read from the social auth
+    record every time.
+
+    Args:
+        user (User): the user whose token to drop
+    """
+    cache.delete(_TOKEN_KEY + str(user.id))
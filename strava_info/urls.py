@@ -7,10 +7,12 @@ urlpatterns = [
     #path('', views.strava_index, name='strava_index'),
     path('get_strava_data', views.get_strava_data, name='get_strava_data'),
     path('update_strava_data', views.update_strava_data, name='update_strava_data'),
+    path('upload_strava_export', views.upload_strava_export, name='upload_strava_export'),
     path('delete_strava_data', views.delete_strava_data, name='delete_strava_data'),
     path('analyze_activity_type/<str:act_type>', views.analyze_activity_type, name='analyze_activity_type'),
     path('switch_units', views.switch_units, name='switch_units'),
     path('search_strava_data', views.search_strava_data, name='search_strava_data'),
+    path('export_strava_data', views.export_strava_data, name='export_strava_data'),
     #path('charts/<str:act_type>/<str:metric>/<str:time_span>', views.charts, name='charts'),
     path('charts/<str:act_type>/<str:metric>', views.charts, name='charts'),
     path('annual_charts', views.annual_charts, name='annual_charts'),
@@ -19,8 +21,18 @@ urlpatterns = [
     #path('monthly_charts/<str:act_type>/<str:metric>', views.monthly_charts, name='monthly_charts'),
     #path('monthly_charts_data/<str:act_type>/<str:metric>', views.monthly_charts_data, name='monthly_charts_data'),
     path('charts_data/<str:act_type>/<str:metric>/<str:time_span>', views.charts_data, name='charts_data'),
+    path('calendar', views.calendar, name='calendar'),
+    path('calendar_data', views.calendar_data, name='calendar_data'),
     path('pie_chart_data', views.pie_chart_data, name='pie_chart_data'),
+    path('heatmap', views.heatmap, name='heatmap'),
+    path('heatmap_tile/<int:z>/<int:x>/<int:y>', views.heatmap_tile, name='heatmap_tile'),
+    path('routes', views.routes, name='routes'),
+    path('route/<int:cluster_id>', views.route, name='route'),
+    path('route_chart_data/<int:cluster_id>', views.route_chart_data, name='route_chart_data'),
+    path('gear', views.gear, name='gear'),
+    path('gear_service/<int:gear_id>', views.gear_service, name='gear_service'),
     path('strava_settings', views.strava_settings, name='strava_settings'),
+    path('request_metrics', views.request_metrics, name='request_metrics'),
     path('subscribe_to_strava_webhooks', views.subscribe_to_strava_webhooks, name='subscribe_to_strava_webhooks'),
     path('unsubscribe_strava_webhooks', views.unsubscribe_strava_webhooks, name='unsubscribe_strava_webhooks'),
     path('webhooks/'+settings.STRAVA_CB_LONG_PART, views.handle_strava_webhook, name='handle_strava_webhook'),
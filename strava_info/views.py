@@ -1,27 +1,40 @@
-from django.shortcuts import render, redirect
+from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.contrib import messages
 from django.db.models import Sum, Max, Min, Avg
-from django.http import JsonResponse, HttpResponse, HttpResponseForbidden
+from django.http import JsonResponse, HttpResponse, HttpResponseForbidden, HttpResponseBadRequest, HttpResponseNotAllowed, Http404, StreamingHttpResponse
+from django.urls import reverse
 import requests
-from .models import StravaUser, StravaActivity, WebhookSubscription
-from .forms import ImperialStravaSearchForm, MetricStravaSearchForm
+from .models import StravaActivity, StravaUser, WebhookSubscription, RouteCluster, Gear
+from .forms import ImperialStravaSearchForm, MetricStravaSearchForm, StravaExportUploadForm, GearServiceForm
 from django.conf import settings
-from dateutil import parser
-import pytz
 import django.template.loader as loader
 import threading
-from social_django.models import UserSocialAuth
 import logging
 import json
-from .strava_helpers import download_strava_data, remove_user_strava_data, compute_metrics, compute_pie_colors, get_strava_activity_type_list, suggest_similar_activities, check_and_refresh_access_token, save_strava_activity, save_strava_data, get_monthly_charts_data, get_annual_chart_data, get_base_context, send_strava_webhook_subscription_request, async_handle
+from .strava_helpers import download_strava_data, remove_user_strava_data, compute_metrics, compute_pie_colors, get_strava_activity_type_list, suggest_similar_activities, check_and_refresh_access_token, save_strava_activity, save_strava_data, get_recent_activities, get_monthly_charts_data, get_annual_chart_data, get_ytd_chart_data, get_base_context, send_strava_webhook_subscription_request, async_handle, filter_strava_activities
+from .heatmap_helpers import render_heatmap_tile
+from .gear_helpers import gear_service_status
+from .calendar_helpers import get_calendar_data
+from .page_cache_helpers import cache_page_per_user
+from .bulk_import_helpers import import_strava_export
+from .export_helpers import stream_activities_csv, stream_activities_parquet, parquet_available
+from .middleware import view_metrics
+from .webhook_helpers import get_webhook_subscription_id
+from .async_helpers import enqueue_webhook_event, iterate_in_thread
+from django.core.handlers.asgi import ASGIRequest
+from asgiref.sync import sync_to_async
+import tempfile
+import shutil
+import os
 
 #logging.basicConfig(format='%(asctime)s %(levelname)s:%(message)s', level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+@cache_page_per_user
 def index(request) :
     """Generate the home page of the site.
     
@@ -38,60 +51,29 @@ def index(request) :
     """
     user = request.user
     context = {}
-    # See if the user has logged in.
-    if user.is_authenticated :
-        # The user has logged in. Now see if they have done the Strava OAuth.
-        try :
-            soc = user.social_auth
-            strava_login = soc.get(provider='strava')
-        except UserSocialAuth.DoesNotExist as e :
-            # We know the user hasn't been through the OAuth process
-            # because we triggered the exception. No need to do anything.
-            pass
-        else :
-            # The user has been through the Strava OAuth process.
-            if strava_login :
-                # I want there to be an expires_at field so add it to the strava_login extra_data.
-                strava_login.extra_data["expires_at"] = strava_login.extra_data["auth_time"] + strava_login.extra_data["expires"]
-                strava_login.save()
-                # Now see if we have have created a stravauser yet for the user.
-                try :
-                    su = user.stravauser
-                    #It's possible that the user deauthorized and then reauthorized.
-                    su.is_strava_verified = True
-                except StravaUser.DoesNotExist as e :
-                    # We haven't created one yet, so do so and
-                    # set the verified flag to true.
-                    user.stravauser = StravaUser()
-                    user.stravauser.is_strava_verified = True
-                    #user.stravauser.token_type = strava_login.extra_data["token_type"]
-                    #user.stravauser.access_token = strava_login.extra_data['access_token']
-                    #user.stravauser.expires_at = strava_login.extra_data['expires_at']
-                    #user.stravauser.expires_in = strava_login.extra_data['expires']
-                    #user.stravauser.refresh_token = strava_login.extra_data['refresh_token']
-                    user.stravauser.save()
-                finally :
-                    # Now that we have a stravauser for sure
-                    su = user.stravauser
-                    # Check if the su has been through Strava OAuth and has completed the initial download.
-                    if su.is_strava_verified and su.has_completed_initial_download :
-                        # Get the five (or fewer) most recent activities so that we can display them on the homepage.
-                        all_acts = StravaActivity.objects.filter(site_user=user)
-                        num2word = {0:"zero", 1:"one", 2:"two", 3:"three", 4:"four", 5:"five"}
-                        most_recent = all_acts.order_by('-start_date')[0:5]
-                        context = get_base_context(request)
-                        context["most_recent"] = most_recent
-                        context["num_recent"] = num2word[len(most_recent)]
-                        # For Super user only:
-                        if user.is_superuser :
-                            # Figure out if we've subscribed to Strava webhooks yet.
-                            all_subs = WebhookSubscription.objects.filter(service="Strava")
-                            if all_subs :
-                                sub_id = all_subs[0].sub_id
-                                context["strava_web_subscribed"] = True
-                                context["strava_web_sub_id"] = sub_id
-                            else :
-                                context["strava_web_subscribed"] = False
+    # See if the user has logged in and done the Strava OAuth. Everything the OAuth
+    # needs saved was saved once when they connected (see pipeline.save_strava_connection),
+    # and the request's user comes with their StravaUser and Strava login, so this page
+    # only reads. Everything it shows is on the StravaUser, so it makes no queries of its own.
+    if user.is_authenticated and user.strava_auth is not None :
+        su = getattr(user, "stravauser", None)
+        # Check if the su has been through Strava OAuth and has completed the initial download.
+        if su is not None and su.is_strava_verified and su.has_completed_initial_download :
+            # Get the five (or fewer) most recent activities so that we can display them on the homepage.
+            num2word = {0:"zero", 1:"one", 2:"two", 3:"three", 4:"four", 5:"five"}
+            most_recent = get_recent_activities(su)
+            context = get_base_context(request)
+            context["most_recent"] = most_recent
+            context["num_recent"] = num2word[len(most_recent)]
+            # For Super user only:
+            if user.is_superuser :
+                # Figure out if we've subscribed to Strava webhooks yet.
+                sub = WebhookSubscription.objects.filter(service="Strava").first()
+                if sub :
+                    context["strava_web_subscribed"] = True
+                    context["strava_web_sub_id"] = sub.sub_id
+                else :
+                    context["strava_web_subscribed"] = False
     return render(request, 'strava_info/index.html', context)
             
 
@@ -165,6 +147,51 @@ def update_strava_data(request) :
         su.save()
     return redirect('index')
 
+def _import_and_clean_up(user, zip_path) :
+    """
+    Import a Strava export archive and delete it afterwards. Runs in its own thread.
+    """
+    try :
+        import_strava_export(user, zip_path, workers=settings.IMPORT_UPLOAD_WORKERS)
+    finally :
+        os.remove(zip_path)
+        # The import clears this when it finishes, but not if it failed part way.
+        StravaUser.objects.filter(user=user).update(downloading=False)
+
+@login_required
+def upload_strava_export(request) :
+    """
+    Import the user's history from a Strava bulk export archive they upload.
+
+    This is much faster than downloading through the Strava API and doesn't use any
+    of the API rate limit. Like the download, the import runs in a separate thread.
+
+    Args:
+        request (HttpRequest): the request that brought us to this view
+
+    Returns:
+        HttpResponse: redirect to the index page if POST, otherwise the upload page
+    """
+    if request.method == "POST" :
+        form = StravaExportUploadForm(request.POST, request.FILES)
+        if form.is_valid() :
+            # Django deletes its copy of the upload when the request ends so keep our own.
+            with tempfile.NamedTemporaryFile(suffix=".zip", delete=False) as f :
+                for chunk in form.cleaned_data["export_file"].chunks() :
+                    f.write(chunk)
+            # Mark the import as started before the thread can finish it. Only this field,
+            # so nothing else on the profile is written back.
+            StravaUser.objects.filter(user=request.user).update(downloading=True)
+            t = threading.Thread(target=_import_and_clean_up, args=[request.user, f.name])
+            t.setDaemon(True)
+            t.start()
+            return redirect('index')
+    else :
+        form = StravaExportUploadForm()
+    context = get_base_context(request)
+    context["form"] = form
+    return render(request, 'strava_info/upload_strava_export.html', context)
+
 @login_required
 def delete_strava_data(request) :
     """
@@ -189,6 +216,7 @@ def delete_strava_data(request) :
 
 
 @login_required
+@cache_page_per_user
 def analyze_activity_type(request, act_type) :
     """
     Compute various statistics about one of the User's activity types.
@@ -206,8 +234,9 @@ def analyze_activity_type(request, act_type) :
     # Get all of the user's Strava activites that are of this type.
     all_acts = StravaActivity.objects.filter(site_user=request.user, sport_type=act_type)
     # Get the first and last year, the user has been on Strava
-    first_year = all_acts.aggregate(Min('start_date')).get('start_date__min').year
-    last_year = all_acts.aggregate(Max('start_date')).get('start_date__max').year
+    years_range = all_acts.aggregate(Min('local_year'), Max('local_year'))
+    first_year = years_range['local_year__min']
+    last_year = years_range['local_year__max']
     
     # Get the basic context needed by all pages in the app.
     context = get_base_context(request)
@@ -216,7 +245,7 @@ def analyze_activity_type(request, act_type) :
     context["act_type"] = act_type
     context["year_list"] = []
     for y in range(first_year, last_year+1) :
-        year_acts = all_acts.filter(start_date__year=y)
+        year_acts = all_acts.filter(local_year=y)
         year_dict = compute_metrics(year_acts)
         year_dict["year"] = y
         context["year_list"].append(year_dict)
@@ -283,6 +312,39 @@ def switch_units(request) :
     su.save()
     return redirect(request.META.get('HTTP_REFERER')) 
 
+def _search_form(request) :
+    """
+    Return the search form for the user's units bound to the request's query string.
+    """
+    type_list = get_strava_activity_type_list(request.user)
+    if request.user.stravauser.preferred_units == "imperial" :
+        return ImperialStravaSearchForm(request.GET, type_choices=type_list)
+    return MetricStravaSearchForm(request.GET, type_choices=type_list)
+
+def _search_criteria(request, form) :
+    """
+    Turn a valid search form into keyword arguments for filter_strava_activities and suggest_similar_activities.
+    """
+    met = False if request.user.stravauser.preferred_units == "imperial" else True
+    near = None
+    if form.cleaned_data['radius'] is not None :
+        # The search helpers want the radius in meters.
+        radius_m = float(form.cleaned_data['radius']) * (1000 if met else 1609.344)
+        near = (form.cleaned_data['near_lat'], form.cleaned_data['near_lng'], radius_m)
+    return {
+        "elev_gain" : float(form.cleaned_data['elev_gain']) if form.cleaned_data['elev_gain'] else None,
+        "distance" : float(form.cleaned_data['distance']) if form.cleaned_data['distance'] else None,
+        "metric" : met,
+        "activity_type" : form.cleaned_data['activity_type'],
+        "activity_title_key" : form.cleaned_data["activity_title"],
+        "elapsed_time" : form.cleaned_data['elapsed_time_min'],
+        "moving_time" : form.cleaned_data['moving_time_min'],
+        "start_date" : form.cleaned_data['start_date'],
+        "end_date" : form.cleaned_data['end_date'],
+        "bbox" : form.cleaned_data['bounding_box'],
+        "near" : near,
+    }
+
 @login_required
 def search_strava_data(request) :
     """
@@ -298,24 +360,11 @@ def search_strava_data(request) :
     context = get_base_context(request)
     results = []
     type_list = get_strava_activity_type_list(request.user)
-    if request.user.stravauser.preferred_units == "imperial" :
-        form = ImperialStravaSearchForm(request.GET, type_choices=type_list)
-    else :
-        form = MetricStravaSearchForm(request.GET, type_choices=type_list)
+    form = _search_form(request)
     # Do the search if the search form is valid.
     # Otherwise, generate a clean form and send it to the search page.
     if form.is_valid() :
-        title_key = form.cleaned_data["activity_title"]  
-        d = float(form.cleaned_data['distance']) if form.cleaned_data['distance'] else None
-        elev = float(form.cleaned_data['elev_gain']) if form.cleaned_data['elev_gain'] else None
-        act_type = form.cleaned_data['activity_type']
-        elapsed_min = form.cleaned_data['elapsed_time_min']
-        moving_min = form.cleaned_data['moving_time_min']
-        met = False if request.user.stravauser.preferred_units == "imperial" else True
-        start_date = form.cleaned_data['start_date']
-        end_date = form.cleaned_data['end_date']
-        results = suggest_similar_activities(request, elev_gain=elev, distance=d, metric=met, activity_type=act_type, activity_title_key=title_key,
-                                             elapsed_time=elapsed_min, moving_time=moving_min, start_date=start_date, end_date=end_date)
+        results = suggest_similar_activities(request, **_search_criteria(request, form))
     elif request.user.stravauser.preferred_units == "imperial" :
         form = ImperialStravaSearchForm(type_choices=type_list)
     else :
@@ -323,6 +372,44 @@ def search_strava_data(request) :
     context['form'] = form
     context["results"] = results
     return render(request, 'strava_info/search_strava_data.html', context)
+
+@login_required
+def export_strava_data(request) :
+    """
+    Stream the user's activities as a CSV or Parquet file.
+
+    Takes the same query string as the search page (plus format=csv or format=parquet)
+    so a search can be exported as is. The rows are streamed straight from the
+    database so memory stays flat however many activities there are.
+
+    Args:
+        request (HttpRequest): the request that brought us to this view
+
+    Returns:
+        StreamingHttpResponse: the file
+    """
+    form = _search_form(request)
+    if not form.is_valid() :
+        return HttpResponseBadRequest("Invalid search criteria")
+    criteria = _search_criteria(request, form)
+    acts_qs = filter_strava_activities(request.user, **criteria)
+    area = {"bbox" : criteria["bbox"], "near" : criteria["near"]}
+    if request.GET.get("format", "csv") == "parquet" :
+        if not parquet_available() :
+            return HttpResponse("Parquet exports aren't available on this server. Try CSV.", status=501)
+        chunks = stream_activities_parquet(acts_qs, **area)
+        content_type = "application/vnd.apache.parquet"
+        filename = "strava_activities.parquet"
+    else :
+        chunks = stream_activities_csv(acts_qs, **area)
+        content_type = "text/csv"
+        filename = "strava_activities.csv"
+    # Under ASGI the file has to come out through an async iterator or Django reads all of it first.
+    if isinstance(request, ASGIRequest) :
+        chunks = iterate_in_thread(chunks)
+    response = StreamingHttpResponse(chunks, content_type=content_type)
+    response["Content-Disposition"] = 'attachment; filename="' + filename + '"'
+    return response
     
 
 # @login_required
@@ -393,10 +480,11 @@ def charts(request, act_type, metric) :
     context["metric"] = metric
     context["type_list"] = get_strava_activity_type_list(request.user)
     context["metrics"] = ["distance", "moving_time", "elevation_gain"]
-    context["time_spans"] = ["monthly", "annual"]
+    context["time_spans"] = ["monthly", "annual", "ytd"]
     return render(request, 'strava_info/charts.html', context)
 
 @login_required
+@cache_page_per_user
 def charts_data(request, act_type, metric, time_span) :
     """
     Produce data for bar charts.
@@ -405,7 +493,8 @@ def charts_data(request, act_type, metric, time_span) :
         request (HttpRequest): the request that brought us here
         act_type (str): name of Strava activity
         metric (str): the metric we will be charting (distance, elevation gain, moving time)
-        time_span (str): annual or monthly
+        time_span (str): annual, monthly or ytd (year to date running totals). For ytd, ?step=n
+            asks for a point every n days.
 
     Returns:
         JsonResponse: JsonResponse containing the chart data
@@ -419,11 +508,52 @@ def charts_data(request, act_type, metric, time_span) :
         resp = get_monthly_charts_data(request, act_type, metric)
         logger.debug("Monthly bar req response = " + str(resp.content))
         return resp
+    elif time_span == "ytd" :
+        try :
+            step = int(request.GET.get("step", settings.YTD_CHART_STEP))
+        except ValueError :
+            return HttpResponseBadRequest("Bad step")
+        if not 1 <= step <= 31 :
+            return HttpResponseBadRequest("Bad step")
+        try :
+            return get_ytd_chart_data(request, act_type, metric, step)
+        except ValueError :
+            return HttpResponseBadRequest("Bad metric")
     else :
         return None
+
+@login_required
+def calendar(request) :
+    """
+    Render the calendar of the user's daily totals.
+
+    Args:
+        request (HttpRequest): the request that brought us here
+
+    Returns:
+        HttpResponse: the calendar page
+    """
+    context = get_base_context(request)
+    context["metrics"] = ["distance", "moving_time", "count"]
+    return render(request, 'strava_info/calendar.html', context)
+
+@login_required
+def calendar_data(request) :
+    """
+    Produce the daily totals of the user's whole history for the calendar.
+
+    Args:
+        request (HttpRequest): the request that brought us here
+
+    Returns:
+        JsonResponse: per sport type arrays of days since an epoch and each day's totals
+    """
+    data = get_calendar_data(request.user, request.user.stravauser.preferred_units == "imperial")
+    return JsonResponse(data, json_dumps_params={"separators" : (",", ":")})
         
 
 @login_required
+@cache_page_per_user
 def pie_chart_data(request) :
     """
     Produce json data for pie charts.
@@ -470,12 +600,13 @@ def annual_charts(request) :
     # We're going to want a pie chart for each year. That means we are going to create
     # a canvas in the html for each year. Get the list of years.
     acts_qs = StravaActivity.objects.filter(site_user=request.user)
-    year_list = sorted(acts_qs.values_list("start_date__year", flat=True).distinct(), reverse=True)
+    year_list = list(acts_qs.values_list("local_year", flat=True).distinct().order_by("-local_year"))
     context["year_list"] = year_list
     return render(request, 'strava_info/piecharts.html', context)
 
     
 @login_required
+@cache_page_per_user
 def annual_pie_chart_data(request, year) :
     """
     Generate the Json data for a pie charts for a particular year.
@@ -488,7 +619,7 @@ def annual_pie_chart_data(request, year) :
         JsonResponse: Json data for the pie chart
     """
     
-    acts_qs = StravaActivity.objects.filter(site_user=request.user, start_date__year=year)
+    acts_qs = StravaActivity.objects.filter(site_user=request.user, local_year=year)
     # For each activity type sum the moving time for that activity and compute the percentage that is of the whole.
     all_moving_time = acts_qs.aggregate(Sum('moving_time_sec')).get('moving_time_sec__sum')
     acts_qs = acts_qs.values("sport_type").annotate(total_moving_time=Sum('moving_time_sec'))
@@ -511,6 +642,174 @@ def annual_pie_chart_data(request, year) :
         'colors' : colors
     })
     
+@login_required
+def heatmap(request) :
+    """
+    Render the heatmap page.
+    
+    The page only loads pre-rendered tiles so it stays fast no matter how many
+    activities the user has.
+
+    Args:
+        request (HttpRequest): the request that brought us to this view
+
+    Returns:
+        HttpResponse: the heatmap page
+    """
+    context = get_base_context(request)
+    # Leaflet wants a URL template with {z}/{x}/{y} in it.
+    context["tile_url"] = reverse('strava_info:heatmap_tile', args=[0, 0, 0]).replace("0/0/0", "{z}/{x}/{y}")
+    context["min_zoom"] = settings.HEATMAP_MIN_ZOOM
+    context["max_zoom"] = settings.HEATMAP_MAX_ZOOM
+    return render(request, 'strava_info/heatmap.html', context)
+
+@login_required
+def heatmap_tile(request, z, x, y) :
+    """
+    Return one of the user's heatmap tiles as a PNG.
+
+    Args:
+        request (HttpRequest): the request that brought us to this view
+        z (int): zoom level
+        x (int): tile column
+        y (int): tile row
+
+    Returns:
+        HttpResponse: the PNG image
+    """
+    if not (settings.HEATMAP_MIN_ZOOM <= z <= settings.HEATMAP_MAX_ZOOM) or x >= (1 << z) or y >= (1 << z) :
+        raise Http404("No such tile")
+    response = HttpResponse(render_heatmap_tile(request.user, z, x, y), content_type="image/png")
+    # Tiles change when new activities arrive so only let the browser hang on to them for a bit.
+    response["Cache-Control"] = "private, max-age=300"
+    return response
+
+@login_required
+def routes(request) :
+    """
+    Render the list of routes the user has done more than once.
+
+    Args:
+        request (HttpRequest): the request that brought us to this view
+
+    Returns:
+        HttpResponse: the routes page
+    """
+    context = get_base_context(request)
+    imperial = request.user.stravauser.preferred_units == "imperial"
+    route_list = []
+    for c in RouteCluster.objects.filter(site_user=request.user, activity_count__gte=2).order_by('-activity_count') :
+        dist = c.distance_meters * 0.000621371 if imperial else c.distance_meters / 1000
+        route_list.append({"id" : c.id, "name" : c.name, "sport_type" : c.sport_type, "count" : c.activity_count,
+                           "dist" : '{:,}'.format(round(dist, 1)) + (" miles" if imperial else " km")})
+    context["route_list"] = route_list
+    return render(request, 'strava_info/routes.html', context)
+
+@login_required
+def route(request, cluster_id) :
+    """
+    Render the page for one repeated route with every effort on it and the best one.
+
+    Args:
+        request (HttpRequest): the request that brought us to this view
+        cluster_id (int): id of the RouteCluster
+
+    Returns:
+        HttpResponse: the route page
+    """
+    cluster = get_object_or_404(RouteCluster, id=cluster_id, site_user=request.user)
+    imperial = request.user.stravauser.preferred_units == "imperial"
+    context = get_base_context(request)
+    context["route"] = cluster
+    efforts = []
+    for a in cluster.activities.order_by('-start_date') :
+        efforts.append({"id" : a.activity_id, "name" : a.name, "date" : a.start_date_local,
+                        "moving" : '{:,}'.format(round(a.moving_time_min, 1)),
+                        "speed" : '{:,}'.format(round(a.average_speed_mph if imperial else a.average_speed_kph, 2))})
+    context["efforts"] = efforts
+    context["best"] = cluster.activities.order_by('moving_time_sec').first()
+    context["speed_units"] = "mph" if imperial else "kph"
+    return render(request, 'strava_info/route.html', context)
+
+@login_required
+def route_chart_data(request, cluster_id) :
+    """
+    Produce json data for the time trend chart on a route's page.
+
+    Args:
+        request (HttpRequest): the request that brought us to this view
+        cluster_id (int): id of the RouteCluster
+
+    Returns:
+        JsonResponse: Json data for the line chart
+    """
+    cluster = get_object_or_404(RouteCluster, id=cluster_id, site_user=request.user)
+    labels = []
+    data = []
+    for d, t in cluster.activities.order_by('start_date').values_list('start_date_local', 'moving_time_min') :
+        labels.append(d.strftime("%Y-%m-%d"))
+        data.append(round(t, 1))
+    return JsonResponse(data={
+        'labels' : labels,
+        'data' : data,
+        'title_text' : "Moving time on " + cluster.name,
+        'scale_title' : "Minutes",
+        'color' : request.user.stravauser.pie_color_palette.get(cluster.sport_type)
+    })
+
+@login_required
+def gear(request) :
+    """
+    Render the user's bikes and shoes with their totals and which ones are due for service.
+
+    Args:
+        request (HttpRequest): the request that brought us to this view
+
+    Returns:
+        HttpResponse: the gear page
+    """
+    context = get_base_context(request)
+    imperial = request.user.stravauser.preferred_units == "imperial"
+    to_units = 0.000621371 if imperial else 0.001
+    gear_list = []
+    for g in Gear.objects.filter(site_user=request.user, activity_count__gt=0).order_by('-distance_meters') :
+        since, status = gear_service_status(g)
+        gear_list.append({"id" : g.id, "name" : g.name or g.gear_id, "count" : g.activity_count,
+                          "dist" : '{:,}'.format(round(g.distance_meters * to_units, 1)),
+                          "hours" : '{:,}'.format(round(g.moving_time_sec / 3600, 1)),
+                          "since" : '{:,}'.format(round(since * to_units, 1)),
+                          "interval" : round(g.service_interval_m * to_units) if g.service_interval_m else "",
+                          "status" : status})
+    context["gear_list"] = gear_list
+    context["due"] = [g["name"] for g in gear_list if g["status"] == "due"]
+    context["dist_units"] = "miles" if imperial else "km"
+    return render(request, 'strava_info/gear.html', context)
+
+@login_required
+@require_http_methods(["POST"])
+def gear_service(request, gear_id) :
+    """
+    Set a piece of gear's service interval or record that it was just serviced.
+
+    Args:
+        request (HttpRequest): the request that brought us to this view
+        gear_id (int): id of the Gear
+
+    Returns:
+        HttpResponse: redirect back to the gear page
+    """
+    g = get_object_or_404(Gear, id=gear_id, site_user=request.user)
+    form = GearServiceForm(request.POST)
+    if not form.is_valid() :
+        return HttpResponseBadRequest("Bad service interval")
+    interval = form.cleaned_data["service_interval"]
+    to_meters = 1609.344 if request.user.stravauser.preferred_units == "imperial" else 1000
+    g.service_interval_m = float(interval) * to_meters if interval else None
+    if form.cleaned_data["serviced"] :
+        g.serviced_at_m = g.distance_meters
+    g.save(update_fields=["service_interval_m", "serviced_at_m"])
+    return redirect('strava_info:gear')
+
 @login_required
 def strava_settings(request) :
     """
@@ -525,6 +824,22 @@ def strava_settings(request) :
     context = get_base_context(request)
     return render(request, 'strava_info/strava_settings.html', context)
 
+@login_required
+def request_metrics(request) :
+    """
+    Show superusers the recent per-view request metrics this process has recorded.
+
+    Args:
+        request (HttpRequest): the request that brought us to this view
+
+    Returns:
+        JsonResponse: percentiles and histograms of each metric for each view
+    """
+    if not request.user.is_superuser :
+        return HttpResponseForbidden()
+    return JsonResponse(view_metrics.summary())
+
+
 @login_required 
 def subscribe_to_strava_webhooks(request) :
     """
@@ -564,7 +879,7 @@ def unsubscribe_strava_webhooks(request) :
         all_subs = WebhookSubscription.objects.filter(service="Strava")
         for sub in all_subs :
             sub_id = sub.sub_id
-            unsub_url = "https://www.strava.com/api/v3/push_subscriptions/"+str(sub_id)
+            unsub_url = settings.STRAVA_API_URL + "/push_subscriptions/"+str(sub_id)
             payload = {'client_id': settings.SOCIAL_AUTH_STRAVA_KEY,
                        'client_secret': settings.SOCIAL_AUTH_STRAVA_SECRET,
                        'id' : sub_id}
@@ -582,12 +897,13 @@ def unsubscribe_strava_webhooks(request) :
     return redirect('index')
         
 
-@require_http_methods(["GET", "POST"])
-@csrf_exempt
-def handle_strava_webhook(request) :
+async def handle_strava_webhook(request) :
     """
     Handle an incoming Strava webhook
 
+    This is an async view so under ASGI it doesn't hold a thread. Events are handed
+    to the background webhook loop and we answer Strava straight away.
+
     Args:
         request (HttpRequest): request for this view
 
@@ -596,6 +912,9 @@ def handle_strava_webhook(request) :
     """
     
     logger.debug("Handle webhook got this request " + str(request))
+    # Django's view decorators can't wrap async views yet, so do their jobs here.
+    if request.method not in ("GET", "POST") :
+        return HttpResponseNotAllowed(["GET", "POST"])
     if request.method == "GET" :
         # We're dealing with a response to our request for a
         # subscription. These are the only GET requests
@@ -618,18 +937,18 @@ def handle_strava_webhook(request) :
     else :
         # We're dealing with a post which is an indication of
         # a webhook event.
-        all_subs = WebhookSubscription.objects.filter(service="Strava")
-        sub_id = all_subs[0].sub_id
+        sub_id = await sync_to_async(get_webhook_subscription_id)()
         #event = request.POST
         event = json.loads(request.body)
         logger.debug("  body = " + str(event))
-        if not event.get("subscription_id") or event["subscription_id"] != sub_id :
+        if not sub_id or not event.get("subscription_id") or event["subscription_id"] != sub_id :
             logger.debug("Handle not allowing")
             return HttpResponseForbidden("Post not allowed")
         # We've come this far so handle the webhook.
-        t = threading.Thread(target=async_handle, args=[event])
-        t.setDaemon(True)
-        t.start()
+        enqueue_webhook_event(event)
         return HttpResponse('success')
+
+# Strava can't send a CSRF token.
+handle_strava_webhook.csrf_exempt = True
     
 
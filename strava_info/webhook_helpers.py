@@ -0,0 +1,76 @@
+from .models import WebhookSubscription
+from .cache_helpers import shared_cache_configured
+from social_django.models import UserSocialAuth
+from django.conf import settings
+from django.core.cache import cache
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Webhook events only carry the athlete id, so the mapping to our users and the
+# subscription id are cached to keep lookups off the webhook path. Both are
+# forgotten when they change (see signals.py). That only reaches every process if the
+# cache is shared, so otherwise they're looked up each time. Both lookups are on
+# unique indexes or tiny tables, so that's cheap.
+_OWNER_KEY = "strava_webhook_owner:"
+_SUBSCRIPTION_KEY = "strava_webhook_subscription_id"
+
+
+def get_webhook_owner(owner_id) :
+    """
+    Return the user who connected the Strava athlete a webhook event is about.
+
+    Args:
+        owner_id (int): the Strava athlete id from the event
+
+    Returns:
+        User: the user, or None if no user has connected that athlete
+    """
+    key = _OWNER_KEY + str(owner_id)
+    shared = shared_cache_configured()
+    user = cache.get(key) if shared else None
+    if user is None :
+        # (provider, uid) is unique, so this is an index lookup.
+        strava_login = UserSocialAuth.objects.filter(provider="strava", uid=str(owner_id)).select_related("user").first()
+        if not strava_login :
+            return None
+        user = strava_login.user
+        if shared :
+            cache.set(key, user, settings.WEBHOOK_LOOKUP_CACHE_TIMEOUT)
+    return user
+
+
+def forget_webhook_owner(owner_id) :
+    """
+    Drop the cached user for a Strava athlete, e.g. because they connected or disconnected.
+
+    Args:
+        owner_id (int): the Strava athlete id
+    """
+    cache.delete(_OWNER_KEY + str(owner_id))
+
+
+def get_webhook_subscription_id() :
+    """
+    Return the id of our Strava webhook subscription.
+
+    Returns:
+        int: the subscription id, or None if we haven't subscribed
+    """
+    shared = shared_cache_configured()
+    sub_id = cache.get(_SUBSCRIPTION_KEY) if shared else None
+    if sub_id is None :
+        sub = WebhookSubscription.objects.filter(service="Strava").first()
+        if not sub :
+            return None
+        sub_id = sub.sub_id
+        if shared :
+            cache.set(_SUBSCRIPTION_KEY, sub_id, settings.WEBHOOK_LOOKUP_CACHE_TIMEOUT)
+    return sub_id
+
+
+def forget_webhook_subscription_id() :
+    """
+    Drop the cached subscription id because we subscribed or unsubscribed.
+    """
+    cache.delete(_SUBSCRIPTION_KEY)